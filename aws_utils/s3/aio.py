@@ -0,0 +1,151 @@
+"""asyncio facade of s3_utils, for services running an event loop (python 3 only).
+
+This is not asyncio-native I/O: boto is blocking, so every call of an
+AsyncS3 runs the matching s3_utils function on a thread of the thread pool of
+the AsyncS3, which it keeps busy until its requests complete, and returns an
+asyncio Future of its result, to be awaited (or yielded from) by a coroutine.
+It only keeps the event loop free while the requests are made. Buckets
+passed by name are the process-wide pooled ones of
+aws_utils.s3.connections, so the threads share their HTTP connection pool
+and bucket handles instead of opening their own; a boto Bucket passed as is
+uses its own connection.
+
+The thread pool bounds the number of calls in flight: calls made while all
+its threads are busy wait in its queue. Cancelling the future of such a call
+removes it from the queue before it sends anything; a call which has already
+started can't be interrupted, its request completes and its result is dropped.
+
+Example:
+    s3 = AsyncS3(max_concurrency=64)
+
+    async def load_features(paths):
+        return await s3.load_pickles('feature-store', paths)
+"""
+import asyncio
+import functools
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_utils.s3 import s3_utils
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_MAX_CONCURRENCY = 32
+
+
+def _delete_key(bucket, path):
+    s3_utils.get_bucket(bucket).delete_key(path)
+
+
+class AsyncS3(object):
+    """Runs s3_utils functions on a bounded thread pool, returning asyncio futures, see the module documentation
+
+    Every method returns an asyncio.Future and accepts a bucket as a boto Bucket or as a name.
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, loop=None):
+        """
+        Args:
+            max_concurrency (int): maximum number of calls running at the same time
+            loop (asyncio.AbstractEventLoop): the loop the futures belong to, by default the current event loop
+        """
+        self.max_concurrency = max_concurrency
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self, wait=True):
+        """Stops the thread pool, calls made afterwards raise RuntimeError
+
+        Args:
+            wait (bool): wait for the calls already started to complete
+        """
+        self._executor.shutdown(wait=wait)
+
+    def run(self, func, *args, **kwargs):
+        """Runs any blocking function on the thread pool
+
+        Returns:
+            asyncio.Future: of the result of func(*args, **kwargs)
+        """
+        loop = self._loop or asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def _gather(self, func, bucket, paths, **kwargs):
+        return asyncio.gather(*[self.run(func, bucket, path, **kwargs) for path in paths])
+
+    def get(self, bucket, path, compressed=False):
+        """Future of the content of a key, see s3_utils.get_from_s3"""
+        return self.run(s3_utils.get_from_s3, bucket, path, compressed=compressed)
+
+    def get_many(self, bucket, paths, compressed=False):
+        """Future of the list of the contents of several keys, in the order of paths
+
+        Cancelling it cancels the gets which haven't started yet.
+        """
+        return self._gather(s3_utils.get_from_s3, bucket, paths, compressed=compressed)
+
+    def save(self, bucket, path, data, compress=False):
+        """Future of the upload of some data, see s3_utils.save_to_s3"""
+        return self.run(s3_utils.save_to_s3, bucket, path, data, compress=compress)
+
+    def exists(self, bucket, path):
+        """Future of whether a key exists, see s3_utils.path_exists"""
+        return self.run(s3_utils.path_exists, bucket, path)
+
+    def head_many(self, bucket, paths):
+        """Future of the aws_utils.s3.metadata.KeyMetadata of several keys, see s3_utils.get_files_metadata
+
+        The keys are looked up with a single call, which uses its own threads and listings of shared folders.
+
+        Returns:
+            asyncio.Future: of a dict path -> KeyMetadata
+        """
+        return self.run(s3_utils.get_files_metadata, bucket, paths)
+
+    def list(self, bucket, directory):
+        """Future of the names of the keys under a prefix, see s3_utils.get_contents_of_directory"""
+        return self.run(s3_utils.get_contents_of_directory, directory, bucket=bucket)
+
+    def delete(self, bucket, path):
+        """Future of the deletion of a key, and of that key only"""
+        return self.run(_delete_key, bucket, path)
+
+    def delete_prefix(self, bucket, path):
+        """Future of the deletion of all the keys under a prefix, see s3_utils.delete_path
+
+        A prefix isn't a directory: deleting 'dir/a' deletes 'dir/ab' as well, and the 'dir/a_$folder$' marker.
+
+        Returns:
+            asyncio.Future: of a list of boto.s3.multidelete.Error, the keys which could not be deleted
+        """
+        return self.run(s3_utils.delete_path, bucket, path)
+
+    def load_pickle(self, bucket, path):
+        """Future of the object pickled in a key, see s3_utils.load_pickle_from_s3"""
+        return self.run(s3_utils.load_pickle_from_s3, bucket, path)
+
+    def load_pickles(self, bucket, paths):
+        """Future of the list of the objects pickled in several keys, in the order of paths
+
+        Cancelling it cancels the loads which haven't started yet.
+        """
+        return self._gather(s3_utils.load_pickle_from_s3, bucket, paths)
+
+    def save_pickle(self, bucket, path, data):
+        """Future of the upload of a pickled object, see s3_utils.save_pickle_to_s3"""
+        return self.run(s3_utils.save_pickle_to_s3, bucket, path, data)
+
+    def load_json(self, bucket, path, compressed=False):
+        """Future of the list of the records of a JSON lines key, see s3_utils.load_jsonfile_from_s3"""
+        return self.run(s3_utils.load_jsonfile_from_s3, bucket, path, compressed=compressed)
+
+    def save_json(self, bucket, path, items, **kwargs):
+        """Future of the upload of records as a JSON lines key, see s3_utils.save_jsonfile_to_s3"""
+        return self.run(s3_utils.save_jsonfile_to_s3, bucket, path, items, **kwargs)
@@ -0,0 +1,68 @@
+"""Helpers to run many small S3 requests on a pool of threads."""
+from collections import deque
+from itertools import islice
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+DEFAULT_NUM_WORKERS = 8
+
+
+def bounded_map(func, iterable, num_workers=DEFAULT_NUM_WORKERS, max_pending=None, ordered=True):
+    """Lazily applies func to every item of iterable using a pool of threads.
+
+    At most max_pending calls are queued or running at any time, so the input is consumed at the pace of the
+    workers and a huge (or endless) iterable never gets materialised. If a call raises, the exception is re-raised
+    to the consumer and the calls still pending are cancelled.
+
+    Args:
+        func (function): called with a single item
+        iterable (iterable): items to process
+        num_workers (int): number of threads
+        max_pending (int): maximum number of submitted but not consumed calls, defaults to twice num_workers
+        ordered (bool): if True results are yielded in input order, otherwise as soon as they are ready
+
+    Returns:
+        generator: the results of func
+    """
+    max_pending = max_pending or 2 * num_workers
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    pending = deque()
+    try:
+        for item in iterable:
+            if len(pending) >= max_pending:
+                if ordered:
+                    yield pending.popleft().result()
+                else:
+                    for result in _pop_completed(pending):
+                        yield result
+            pending.append(executor.submit(func, item))
+
+        while pending:
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                for result in _pop_completed(pending):
+                    yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _pop_completed(pending):
+    """Waits for at least one of the pending futures and removes the completed ones from the deque."""
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    results = []
+    for future in done:
+        pending.remove(future)
+        results.append(future.result())
+    return results
+
+
+def chunked(iterable, size):
+    """Lazily groups the items of iterable in lists of size items, the last one possibly shorter"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
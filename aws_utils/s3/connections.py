@@ -0,0 +1,187 @@
+"""Process-wide registry of reusable S3 connections and bucket handles.
+
+Opening a boto connection and validating a bucket costs a TLS handshake and a
+HEAD request, so instead of paying that on every call we keep one connection
+per process and one validated Bucket per bucket name, as well as one boto3 S3
+client per region and per boto connection listed with boto3. They are shared by every thread, e.g. the bounded_map
+workers of a transfer: boto takes an HTTP connection from the thread safe
+pool of the S3Connection for each request and boto3 clients are thread safe,
+so worker threads don't pay a connection and a HEAD request of their own.
+Bucket handles unused for longer than ``BUCKET_IDLE_TIMEOUT`` seconds are
+dropped, and the whole registry is discarded when we detect we are running in
+a forked child, as sockets must not be shared between processes.
+"""
+import logging
+import os
+import threading
+import time
+
+import boto
+import boto3
+from boto.s3.connection import OrdinaryCallingFormat
+from botocore.client import Config
+
+# python version backwards compatibility
+try:
+    from ConfigParser import DuplicateSectionError
+except ImportError:
+    from configparser import DuplicateSectionError
+
+
+logger = logging.getLogger(__name__)
+S3_HOST = 's3.amazonaws.com'
+BUCKET_IDLE_TIMEOUT = 5 * 60
+
+_lock = threading.RLock()
+_registry = {
+    'pid': None,
+    'connection': None,
+    'buckets': {},  # bucket name -> (Bucket, last used timestamp)
+    'clients': {},  # region name, or the credentials and endpoint of a boto connection -> boto3 client
+}
+
+
+def setup_boto():
+    try:
+        boto.config.add_section("Boto")
+    except DuplicateSectionError:
+        pass
+    boto.config.set("Boto", "metadata_service_num_attempts", "20")
+
+
+def _check_pid():
+    """Drop everything inherited from a parent process.
+
+    Must be called with the lock held.
+    """
+    pid = os.getpid()
+    if _registry['pid'] != pid:
+        if _registry['pid'] is not None:
+            logger.debug("Fork detected (pid %s -> %s), discarding S3 connections", _registry['pid'], pid)
+        _registry['pid'] = pid
+        _registry['connection'] = None
+        _registry['buckets'] = {}
+        _registry['clients'] = {}
+
+
+def _evict_idle(now):
+    """Remove bucket handles which have not been used recently.
+
+    Must be called with the lock held.
+    """
+    buckets = _registry['buckets']
+    for name, (_, last_used) in list(buckets.items()):
+        if now - last_used > BUCKET_IDLE_TIMEOUT:
+            logger.debug("Evicting idle bucket handle %s", name)
+            del buckets[name]
+
+
+def get_connection():
+    """Returns the S3 connection shared by this process, creating it if needed
+
+    Returns:
+        boto.s3.connection.S3Connection
+    """
+    with _lock:
+        _check_pid()
+        if _registry['connection'] is None:
+            setup_boto()
+            _registry['connection'] = boto.connect_s3(host=S3_HOST, calling_format=OrdinaryCallingFormat())
+        return _registry['connection']
+
+
+def get_client(region_name=None):
+    """Returns the boto3 S3 client shared by this process for the given region, creating it if needed
+
+    boto3 clients are thread safe, so a single one (and its pool of HTTP connections) is used by all threads.
+
+    Args:
+        region_name (str): e.g. 'us-east-1', if None the default region of the environment is used
+
+    Returns:
+        botocore.client.S3
+    """
+    with _lock:
+        _check_pid()
+        clients = _registry['clients']
+        if region_name not in clients:
+            clients[region_name] = boto3.session.Session().client('s3', region_name=region_name)
+        return clients[region_name]
+
+
+def get_bucket_client(bucket):
+    """Returns a boto3 S3 client with the credentials and endpoint of the connection of a boto Bucket
+
+    So that what is done with boto3 on a bucket (e.g. listing it) reaches the same account and endpoint as what is
+    done with boto. Clients are shared like the ones of get_client, a new one is only created when the credentials
+    of the connection change (e.g. temporary credentials being refreshed).
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+
+    Returns:
+        botocore.client.S3
+    """
+    connection = bucket.connection
+    provider = connection.provider
+    path_style = isinstance(connection.calling_format, OrdinaryCallingFormat)
+    key = (provider.access_key, provider.secret_key, provider.security_token, connection.host, connection.port,
+           connection.is_secure, path_style)
+    with _lock:
+        _check_pid()
+        clients = _registry['clients']
+        if key not in clients:
+            # the default host is left to boto3, which then follows the region of each bucket
+            endpoint_url = None if connection.host == S3_HOST else '{}://{}:{}'.format(
+                connection.protocol, connection.host, connection.port)
+            clients[key] = boto3.session.Session().client(
+                's3', aws_access_key_id=provider.access_key, aws_secret_access_key=provider.secret_key,
+                aws_session_token=provider.security_token, endpoint_url=endpoint_url,
+                use_ssl=connection.is_secure,
+                config=Config(s3={'addressing_style': 'path'}) if path_style else None)
+        return clients[key]
+
+
+def get_pooled_bucket(bucket_name):
+    """Returns a validated Bucket for the given name, reusing a previous one if possible
+
+    The bucket is validated without holding the lock, so a slow validation doesn't hold up the other threads.
+
+    Args:
+        bucket_name (str): name of the bucket we want to load
+
+    Returns:
+        Bucket
+    """
+    with _lock:
+        now = time.time()
+        _check_pid()
+        _evict_idle(now)
+
+        buckets = _registry['buckets']
+        if bucket_name in buckets:
+            bucket = buckets[bucket_name][0]
+            buckets[bucket_name] = (bucket, now)
+            return bucket
+        connection = get_connection()
+
+    bucket = connection.get_bucket(bucket_name)
+
+    with _lock:
+        _check_pid()
+        buckets = _registry['buckets']
+        if bucket_name in buckets:
+            # validated by another thread in the meantime
+            bucket = buckets[bucket_name][0]
+        elif _registry['connection'] is not connection:
+            # the registry was reset in the meantime, don't pool a bucket of the old connection
+            return bucket
+        buckets[bucket_name] = (bucket, time.time())
+        return bucket
+
+
+def reset_connections():
+    """Forget all pooled connections and buckets, e.g. after credentials change."""
+    with _lock:
+        _registry['pid'] = None
+        _check_pid()
@@ -0,0 +1,210 @@
+"""Parallel reads of datasets partitioned by day, e.g. production/output/year=2017/month=05/day=30/part-00000.gz
+
+The day partitions of a date range are listed concurrently, days without any
+partition are skipped, and the files found are read on a bounded pool of
+threads. Each reader thread streams the records of its file (see
+aws_utils.s3.streaming) and hands them over in batches through a bounded
+queue, blocking while the queue is full. So at most
+
+    max_pending files x max_batches batches x batch_size records
+
+are held in memory, whatever the size of the files, and a backfill over months
+of partitions runs at the pace of the consumer.
+
+Records come in date order, then file order within a day, unless ordered is
+False in which case they come batch by batch as the files are read.
+
+Example:
+    for record in iter_dataset(bucket, 'production/output/', date(2017, 3, 1), date(2017, 5, 30)):
+        ...
+"""
+import logging
+import posixpath
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from concurrent.futures import ThreadPoolExecutor
+
+# python version backwards compatibility
+try:
+    from Queue import Full, Queue
+except ImportError:
+    from queue import Full, Queue
+
+from aws_utils.s3.concurrency import DEFAULT_NUM_WORKERS, bounded_map
+from aws_utils.s3.listing import DELIMITER, iter_key_records
+from aws_utils.s3.streaming import iter_json_from_s3
+
+
+logger = logging.getLogger(__name__)
+DATE_PREFIX = 'year={:04}/month={:02}/day={:02}/'
+LIST_NUM_WORKERS = 16
+BATCH_SIZE = 1000
+MAX_BATCHES = 4
+# seconds a reader blocked on a full queue waits before checking whether the consumer went away
+PUT_TIMEOUT = 0.1
+_END = object()
+
+
+class DatasetFile(namedtuple('DatasetFile', ['date', 'record'])):
+    """A file of a dataset
+
+    Attributes:
+        date (date): day of the partition holding the file
+        record (aws_utils.s3.listing.KeyRecord): the listed key
+    """
+    __slots__ = ()
+
+
+def is_data_file(record):
+    """Returns False for folder placeholders and hidden or hadoop marker files, e.g. _SUCCESS or part-00000.crc"""
+    name = posixpath.basename(record.name)
+    return bool(name) and not name.startswith(('_', '.')) and not name.endswith('$folder$')
+
+
+def read_json_lines(bucket, path):
+    """Streams the records of a JSON lines file, gzip decompressed if its name ends with .gz"""
+    return iter_json_from_s3(bucket, path, compressed=path.endswith('.gz'))
+
+
+def iter_days(from_date, to_date):
+    """Yields every day from from_date to to_date, both included
+
+    Args:
+        from_date (date or datetime):
+        to_date (date or datetime):
+
+    Returns:
+        generator of date
+    """
+    if isinstance(from_date, datetime):
+        from_date = from_date.date()
+    if isinstance(to_date, datetime):
+        to_date = to_date.date()
+    if from_date > to_date:
+        raise ValueError('The start date {} is > the end date {}'.format(from_date, to_date))
+    for offset in range((to_date - from_date).days + 1):
+        yield from_date + timedelta(days=offset)
+
+
+def list_dataset_files(bucket, base_path, from_date, to_date, prefix_tmpl=DATE_PREFIX, file_filter=is_data_file,
+                       num_workers=LIST_NUM_WORKERS):
+    """Lists the day partitions of a date range concurrently
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        base_path (str): path holding the partitions, e.g. 'production/output/'
+        from_date (date or datetime): first day, included
+        to_date (date or datetime): last day, included
+        prefix_tmpl (str): format of the partition of a day below base_path, given its year, month and day
+        file_filter (function): called with the KeyRecord of every key, only the keys it returns True for are kept
+        num_workers (int): number of days listed at the same time
+
+    Returns:
+        generator of DatasetFile, in date order then key order
+    """
+    if base_path and not base_path.endswith(DELIMITER):
+        base_path += DELIMITER
+
+    def list_day(day):
+        prefix = base_path + prefix_tmpl.format(day.year, day.month, day.day)
+        files = [DatasetFile(day, record) for record in iter_key_records(bucket, prefix) if file_filter(record)]
+        if not files:
+            logger.debug('No partition for %s under s3://%s/%s', day, bucket.name, prefix)
+        return files
+
+    for files in bounded_map(list_day, iter_days(from_date, to_date), num_workers=num_workers):
+        for dataset_file in files:
+            yield dataset_file
+
+
+def iter_dataset(bucket, base_path, from_date, to_date, prefix_tmpl=DATE_PREFIX, read=read_json_lines,
+                 file_filter=is_data_file, num_workers=DEFAULT_NUM_WORKERS, max_pending=None, ordered=True,
+                 list_num_workers=LIST_NUM_WORKERS, batch_size=BATCH_SIZE, max_batches=MAX_BATCHES):
+    """Streams the records of all the files of the day partitions of a date range, reading files concurrently
+
+    See the module documentation for the memory held. Closing the generator stops the readers.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        base_path (str): path holding the partitions, e.g. 'production/output/'
+        from_date (date or datetime): first day, included
+        to_date (date or datetime): last day, included
+        prefix_tmpl (str): format of the partition of a day below base_path, given its year, month and day
+        read (function): called with bucket and the path of a file, returns an iterable of its records, best a
+            generator so that the file is streamed. Defaults to JSON lines, see read_json_lines
+        file_filter (function): called with the KeyRecord of every key, only the keys it returns True for are read
+        num_workers (int): number of files read at the same time
+        max_pending (int): maximum number of files being read or whose records are not all consumed yet, defaults
+            to twice num_workers
+        ordered (bool): if True records come in date then file order, otherwise batch by batch as they are read
+        list_num_workers (int): number of days listed at the same time
+        batch_size (int): number of records handed over at once by a reader
+        max_batches (int): number of batches a reader gets ahead of the consumer before blocking
+
+    Returns:
+        generator of records
+    """
+    files = list_dataset_files(bucket, base_path, from_date, to_date, prefix_tmpl=prefix_tmpl,
+                               file_filter=file_filter, num_workers=list_num_workers)
+    max_pending = max_pending or 2 * num_workers
+    stopped = threading.Event()
+    # unordered, all the readers share a queue and the records of any file are consumed as they come
+    shared = None if ordered else Queue(max_pending * max_batches)
+    # index of the file -> (future of its reader, queue of its batches), in file order
+    pending = OrderedDict()
+
+    def put(queue, item):
+        """Puts an item in a queue, unless the consumer went away. Returns whether it was put"""
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except Full:
+                pass
+        return False
+
+    def read_file(index, dataset_file, queue):
+        batch = []
+        try:
+            for record in read(bucket, dataset_file.record.name):
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    if not put(queue, (index, batch)):
+                        return
+                    batch = []
+        finally:
+            # the records read before an error come first, the consumer then gets the exception from the future
+            if batch:
+                put(queue, (index, batch))
+            put(queue, (index, _END))
+
+    def consume_file():
+        """Yields records until a file is read completely, the first file if ordered"""
+        queue = shared if shared is not None else pending[next(iter(pending))][1]
+        while True:
+            index, batch = queue.get()
+            if batch is _END:
+                pending.pop(index)[0].result()
+                return
+            for record in batch:
+                yield record
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        for index, dataset_file in enumerate(files):
+            if len(pending) >= max_pending:
+                for record in consume_file():
+                    yield record
+            queue = shared if shared is not None else Queue(max_batches)
+            pending[index] = (executor.submit(read_file, index, dataset_file, queue), queue)
+
+        while pending:
+            for record in consume_file():
+                yield record
+    finally:
+        stopped.set()
+        for future, _ in pending.values():
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,201 @@
+"""Read-through cache of S3 objects on the local disk, shared by the processes of a host.
+
+Each cached object is a single file of the cache directory, holding a JSON
+header line (bucket, path and etag of the object) followed by its content.
+A read sends a conditional GET with the cached etag (If-None-Match): S3
+answers 304 Not Modified without a body if the object didn't change, and the
+new content otherwise.
+
+Entries are written to a temporary file which is renamed over the entry once
+complete and checked against the Content-Length (and the MD5 etag of objects
+not uploaded in parts), so readers never see a partial entry and don't need
+any lock, and a truncated download is never revalidated as current. A
+lock file (flock) serialises the writers when they evict entries: once the
+cache is bigger than its maximum size, the least recently used entries (the
+ones whose files were least recently written or read) are deleted.
+
+Example:
+    cache = DiskCache('/var/cache/s3', max_size=10 * 1024 ** 3)
+    load_pickle_from_s3(bucket, 'lookups/domains.pkl', cache=cache)
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from boto.exception import S3ResponseError
+
+from aws_utils.s3.transfer import READ_CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_MAX_SIZE = 1024 ** 3
+LOCK_FILENAME = '.lock'
+TMP_PREFIX = '.tmp-'
+# temporary files older than this were left behind by dead processes
+TMP_MAX_AGE = 60 * 60
+
+
+class DiskCache(object):
+    """Cache of S3 objects in a local directory, see the module documentation
+
+    Several processes can use the same directory, each with its own DiskCache.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """
+        Args:
+            directory (str): created if needed
+            max_size (int): total size in bytes of the entries above which the least recently used ones are evicted
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+
+    def _entry_path(self, bucket_name, path):
+        digest = hashlib.sha1('{}/{}'.format(bucket_name, path).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.directory, LOCK_FILENAME), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_entry(self, entry_path, bucket_name, path):
+        """Returns the etag and the content of an entry, (None, None) if there is no valid entry"""
+        try:
+            with open(entry_path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                if header.get('bucket') != bucket_name or header.get('path') != path:
+                    return None, None
+                return header['etag'], f.read()
+        except (IOError, OSError, ValueError, KeyError):
+            return None, None
+
+    def get(self, bucket, path):
+        """Returns the content of an object, from the cache if it didn't change since it was cached
+
+        Args:
+            bucket (boto.s3.bucket.Bucket):
+            path (str): path of the object within the bucket
+
+        Returns:
+            bytes
+        """
+        entry_path = self._entry_path(bucket.name, path)
+        etag, data = self._read_entry(entry_path, bucket.name, path)
+
+        key = bucket.new_key(path)
+        try:
+            key.open_read(headers={'If-None-Match': etag} if etag else None)
+        except S3ResponseError as e:
+            if e.status != 304:
+                raise
+            logger.debug('s3://%s/%s not modified, read from %s', bucket.name, path, entry_path)
+            try:
+                os.utime(entry_path, None)
+            except OSError:
+                # evicted in the meantime, it is cached again next time
+                pass
+            return data
+
+        f = tempfile.NamedTemporaryFile(dir=self.directory, prefix=TMP_PREFIX, delete=False)
+        try:
+            with f:
+                try:
+                    f.write(json.dumps({'bucket': bucket.name, 'path': path, 'etag': key.etag}).encode('utf-8'))
+                    f.write(b'\n')
+                    start = f.tell()
+                    # Key.read drops the response once it is exhausted
+                    encryption = key.resp.getheader('x-amz-server-side-encryption')
+                    md5 = hashlib.md5()
+                    for chunk in iter(lambda: key.read(READ_CHUNK_SIZE), b''):
+                        md5.update(chunk)
+                        f.write(chunk)
+                finally:
+                    key.close(fast=True)
+                f.flush()
+
+                written = f.tell() - start
+                if key.size is not None and written != key.size:
+                    raise IOError('s3://{}/{} was truncated, read {} of {} bytes'.format(
+                        bucket.name, path, written, key.size))
+                # the etag of multipart and KMS encrypted objects is not the MD5 of their content
+                if '-' not in key.etag and encryption != 'aws:kms' and key.etag.strip('"') != md5.hexdigest():
+                    raise IOError('s3://{}/{} was corrupted, its MD5 is not its etag {}'.format(
+                        bucket.name, path, key.etag))
+
+                with self._lock():
+                    os.rename(f.name, entry_path)
+                    self._evict()
+                logger.debug('s3://%s/%s cached in %s', bucket.name, path, entry_path)
+
+                # read back through the open file, which is still readable if the entry was evicted in the meantime
+                f.seek(start)
+                return f.read()
+        except Exception:
+            try:
+                os.remove(f.name)
+            except OSError:
+                # renamed already
+                pass
+            raise
+
+    def invalidate(self, bucket_name, path):
+        """Drops the entry of an object, if any"""
+        with self._lock():
+            try:
+                os.remove(self._entry_path(bucket_name, path))
+            except OSError:
+                pass
+
+    def _entries(self):
+        """Returns the (mtime, size, path) of every entry, and deletes the abandoned temporary files"""
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            entry_path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(entry_path)
+                if name.startswith(TMP_PREFIX):
+                    if now - stat.st_mtime > TMP_MAX_AGE:
+                        os.remove(entry_path)
+                elif name != LOCK_FILENAME:
+                    entries.append((stat.st_mtime, stat.st_size, entry_path))
+            except OSError:
+                # deleted by another process
+                continue
+        return entries
+
+    @property
+    def size(self):
+        """Total size in bytes of the entries"""
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Deletes the least recently used entries until the cache fits in max_size, the lock must be held"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total -= size
+            logger.debug('Evicted %s (%d bytes)', entry_path, size)
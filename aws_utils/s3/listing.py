@@ -0,0 +1,246 @@
+"""Lightweight listings of S3 prefixes.
+
+boto builds a full Key object (a dict of some thirty attributes) for every
+listed key, which adds up to gigabytes on prefixes holding millions of keys.
+Listings here go through the ListObjectsV2 paginator of a boto3 client with
+the credentials and endpoint of the bucket's boto connection, whose pages are
+plain dicts, straight into KeyRecord tuples of name, size, etag and last
+modified date, or for the biggest listings into KeyColumns, arrays holding
+each field of all the keys.
+
+Listing with a delimiter groups every key sharing the part of its name up to
+the next delimiter into a single common prefix, so the immediate children of
+a prefix (see iter_directory) are listed in a number of requests
+proportional to the number of children, rather than to the number of keys
+below the prefix.
+"""
+import calendar
+import time
+from array import array
+from collections import namedtuple
+
+from aws_utils.s3.connections import get_bucket_client
+
+
+DELIMITER = '/'
+LIST_PAGE_SIZE = 1000
+# 'q' (long long) only exists in python 3
+SIZE_TYPECODE = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class KeyRecord(namedtuple('KeyRecord', ['name', 'size', 'etag', 'last_modified'])):
+    """A listed key, with the attributes of boto.s3.key.Key a listing sets
+
+    Attributes:
+        name (str): also available as key, like boto.s3.key.Key
+        size (int): in bytes
+        etag (str): with its quotes, e.g. '"9a0364b9e99bb480dd25e1f0284c8555"'
+        last_modified (str): ISO 8601 date, e.g. '2017-05-30T12:00:00.000Z'
+    """
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self.name
+
+
+class KeyColumns(object):
+    """Column oriented listing: one array per attribute of the listed keys
+
+    Sizes and modification times (as milliseconds since the epoch) are kept in compact arrays of numbers, so a
+    listing costs little more than its names and etags. Use record(i) or iteration to get KeyRecords back.
+    """
+    __slots__ = ('names', 'sizes', 'etags', 'mtimes')
+
+    def __init__(self):
+        self.names = []
+        self.sizes = array(SIZE_TYPECODE)
+        self.etags = []
+        self.mtimes = array(SIZE_TYPECODE)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for i in range(len(self.names)):
+            yield self.record(i)
+
+    def append(self, name, size, etag, last_modified):
+        self.names.append(name)
+        self.sizes.append(size)
+        self.etags.append(etag)
+        self.mtimes.append(parse_timestamp(last_modified))
+
+    def record(self, i):
+        """Returns the KeyRecord of the i-th key"""
+        return KeyRecord(self.names[i], self.sizes[i], self.etags[i], format_timestamp(self.mtimes[i]))
+
+    @property
+    def total_size(self):
+        return sum(self.sizes)
+
+
+class DirectoryListing(namedtuple('DirectoryListing', ['directories', 'files'])):
+    """The immediate children of a prefix, see list_directory
+
+    Attributes:
+        directories (list of str): names of the sub directories, relative to the prefix and without delimiter
+        files (list of KeyRecord): keys directly under the prefix
+    """
+    __slots__ = ()
+
+
+def parse_timestamp(last_modified):
+    """Returns the milliseconds since the epoch of an S3 ISO 8601 date, e.g. '2017-05-30T12:00:00.000Z'"""
+    s = last_modified
+    seconds = calendar.timegm((int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                               0, 0, 0))
+    millis = int(s[20:23]) if s[19:20] == '.' else 0
+    return seconds * 1000 + millis
+
+
+def format_timestamp(milliseconds):
+    """Returns the S3 ISO 8601 date of some milliseconds since the epoch, see parse_timestamp"""
+    seconds, millis = divmod(milliseconds, 1000)
+    return '{}.{:03d}Z'.format(time.strftime(ISO_FORMAT, time.gmtime(seconds)), millis)
+
+
+def format_datetime(last_modified):
+    """Returns the S3 ISO 8601 date of a datetime listed by boto3, as found in KeyRecords"""
+    return format_timestamp(calendar.timegm(last_modified.utctimetuple()) * 1000 + last_modified.microsecond // 1000)
+
+
+def iter_pages(bucket, prefix, delimiter=None, page_size=LIST_PAGE_SIZE):
+    """Yields each page of a listing as the ListObjectsV2 response of boto3
+
+    The keys of a page are its 'Contents' dicts, each with 'Key', 'Size', 'ETag' and 'LastModified' items, and its
+    common prefixes are the 'Prefix' items of its 'CommonPrefixes' dicts. Key names are listed URL encoded (and
+    decoded by boto3), so any key name can be listed.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket): listed with the boto3 client of its connection, see
+            connections.get_bucket_client
+        prefix (str):
+        delimiter (str): if set, keys with the delimiter after the prefix are grouped in common prefixes
+        page_size (int): number of keys and common prefixes per request, at most 1000
+
+    Returns:
+        generator of dict
+    """
+    kwargs = {'Bucket': bucket.name, 'Prefix': prefix, 'PaginationConfig': {'PageSize': page_size}}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    for page in get_bucket_client(bucket).get_paginator('list_objects_v2').paginate(**kwargs):
+        yield page
+
+
+def to_record(obj):
+    """Returns the KeyRecord of a 'Contents' dict of a listing page, see iter_pages"""
+    return KeyRecord(obj['Key'], obj['Size'], obj.get('ETag'), format_datetime(obj['LastModified']))
+
+
+def iter_key_records(bucket, prefix, page_size=LIST_PAGE_SIZE):
+    """Yields the keys under a prefix as they are listed, a page at a time is held in memory
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str):
+        page_size (int): number of keys per request
+
+    Returns:
+        generator of KeyRecord
+    """
+    for page in iter_pages(bucket, prefix, page_size=page_size):
+        for obj in page.get('Contents', []):
+            yield to_record(obj)
+
+
+def list_key_columns(bucket, prefix, page_size=LIST_PAGE_SIZE):
+    """Lists all the keys under a prefix in the compact KeyColumns form
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str):
+        page_size (int): number of keys per request
+
+    Returns:
+        KeyColumns
+    """
+    columns = KeyColumns()
+    for page in iter_pages(bucket, prefix, page_size=page_size):
+        for obj in page.get('Contents', []):
+            columns.append(obj['Key'], obj['Size'], obj.get('ETag'), format_datetime(obj['LastModified']))
+    return columns
+
+
+def iter_directory(bucket, prefix, delimiter=DELIMITER, index=None):
+    """Yields the immediate children of a prefix, following the pagination of the listing
+
+    Within each page of the listing files come before sub directories, each in lexicographic order.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): e.g. 'production/output/segments/', children are everything between the prefix and the next
+            delimiter
+        delimiter (str):
+        index (aws_utils.s3.listing_index.ListingIndex): if set the children are read from this index rather than
+            listed
+
+    Returns:
+        generator of (name, record) pairs, name being relative to the prefix. record is None for sub directories, a
+        KeyRecord otherwise
+    """
+    if index is not None:
+        for child in index.iter_directory(bucket.name, prefix, delimiter=delimiter):
+            yield child
+        return
+
+    for page in iter_pages(bucket, prefix, delimiter=delimiter):
+        for obj in page.get('Contents', []):
+            record = to_record(obj)
+            if record.name != prefix:
+                yield record.name[len(prefix):], record
+        for common_prefix in page.get('CommonPrefixes', []):
+            name = common_prefix['Prefix'][len(prefix):-len(delimiter)]
+            if name:
+                yield name, None
+
+
+def list_directory(bucket, prefix, delimiter=DELIMITER, index=None):
+    """Lists the immediate children of a prefix, see iter_directory
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): e.g. 'production/output/segments/'
+        delimiter (str):
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the children from
+
+    Returns:
+        DirectoryListing: files keep their full key, e.g. listing 'logs/' with keys 'logs/2017/a.gz' and
+            'logs/b.gz' gives directories ['2017'] and files [KeyRecord(name='logs/b.gz', ...)]
+    """
+    directories = []
+    files = []
+    for name, record in iter_directory(bucket, prefix, delimiter=delimiter, index=index):
+        if record is None:
+            directories.append(name)
+        else:
+            files.append(record)
+    return DirectoryListing(directories, files)
+
+
+def list_subdirectories(bucket, prefix, delimiter=DELIMITER, index=None):
+    """Returns the names of the sub directories of a prefix, relative to it and in lexicographic order
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): e.g. 'production/output/year=2017/'
+        delimiter (str):
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the children from
+
+    Returns:
+        list of str: e.g. ['month=01', 'month=02']
+    """
+    return [name for name, record in iter_directory(bucket, prefix, delimiter=delimiter, index=index)
+            if record is None]
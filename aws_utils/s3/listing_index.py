@@ -0,0 +1,326 @@
+"""Persistent local index of S3 listings, stored in SQLite.
+
+Listing a prefix holding millions of keys takes minutes, and schedulers ask
+the same questions about the same prefixes every few minutes. A ListingIndex
+keeps the key, size, etag and last modified date of every key under the
+prefixes it has listed (its roots), and answers listing queries for a root or
+anything below it from the local database.
+
+Roots are refreshed incrementally: keys are listed in lexicographic order, so
+only the keys after the last one seen (S3 StartAfter) have to be listed to
+pick up new ones. That is enough for prefixes which only grow by new part
+files or new date partitions, but deleted, overwritten or out of order keys
+are only noticed when a root is listed again from scratch, which happens once
+its listing is older than the index TTL.
+
+Listings are written a page at a time, each page in its own short transaction
+along with the last key listed, so queries from other threads and processes
+are not blocked by a long listing and an interrupted refresh resumes where it
+stopped. A full listing goes to a staging table, which replaces the keys of
+the root once it is complete.
+
+Example:
+    index = ListingIndex('/var/tmp/s3_listings.db', ttl=3600)
+    get_latest_year_month_day_prefix('s3n://bucket/production/output/', index=index)
+"""
+import logging
+import sqlite3
+import threading
+import time
+
+from aws_utils.s3.connections import get_client
+from aws_utils.s3.listing import DELIMITER, KeyRecord, format_datetime
+
+# python version backwards compatibility
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_TTL = 60 * 60
+DEFAULT_REFRESH_INTERVAL = 30
+LIST_PAGE_SIZE = 1000
+FETCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    last_key TEXT,
+    listed_at REAL NOT NULL,
+    refreshed_at REAL NOT NULL,
+    PRIMARY KEY (bucket, prefix)
+);
+CREATE TABLE IF NOT EXISTS keys (
+    bucket TEXT NOT NULL,
+    root TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    PRIMARY KEY (bucket, root, name)
+);
+CREATE TABLE IF NOT EXISTS staged_roots (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    last_key TEXT,
+    listed_at REAL NOT NULL,
+    PRIMARY KEY (bucket, prefix)
+);
+CREATE TABLE IF NOT EXISTS staged_keys (
+    bucket TEXT NOT NULL,
+    root TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    PRIMARY KEY (bucket, root, name)
+);
+"""
+
+
+# keys are read back from the index as listing records
+IndexedKey = KeyRecord
+
+
+def _prefix_upper_bound(prefix):
+    """Returns the smallest string greater than every string starting with prefix, None for the empty prefix"""
+    if isinstance(prefix, bytes):
+        prefix = prefix.decode('utf-8')
+    if not prefix:
+        return None
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+class ListingIndex(object):
+    """Local index of the keys under some S3 prefixes, see the module documentation
+
+    A single index can be shared by several threads, and several processes can use the same database file.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, refresh_interval=DEFAULT_REFRESH_INTERVAL, region_name=None):
+        """
+        Args:
+            path (str): path of the SQLite database, created if needed. ':memory:' gives an index which is not
+                persisted
+            ttl (int): seconds after which a root is listed again from scratch
+            refresh_interval (int): seconds during which queries are answered without listing new keys after a
+                refresh, 0 to look for new keys on every query
+            region_name (str): region of the boto3 client used for listings, see connections.get_client
+        """
+        self.path = path
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.region_name = region_name
+        self._lock = threading.RLock()
+        # serialise the refreshes of each root, (bucket name, prefix) -> Lock
+        self._refresh_locks = {}
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _list_pages(self, bucket_name, prefix, start_after):
+        kwargs = {'Bucket': bucket_name, 'Prefix': prefix, 'PaginationConfig': {'PageSize': LIST_PAGE_SIZE}}
+        if start_after:
+            kwargs['StartAfter'] = start_after
+        paginator = get_client(self.region_name).get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            contents = page.get('Contents', [])
+            if contents:
+                yield contents
+
+    def _insert_page(self, table, bucket_name, prefix, page):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?, ?)'.format(table),
+            [(bucket_name, prefix, obj['Key'], obj['Size'], obj.get('ETag'), format_datetime(obj['LastModified']))
+             for obj in page])
+
+    def refresh(self, bucket_name, prefix, full=False):
+        """Lists the keys added under a root since its last refresh, making prefix a root if it isn't one yet
+
+        The root is listed from scratch if it is new, if its listing is older than the TTL or if full is True.
+
+        Args:
+            bucket_name (str):
+            prefix (str):
+            full (bool): list every key again, dropping the ones which don't exist anymore
+
+        Returns:
+            int: number of keys listed
+        """
+        with self._lock:
+            refresh_lock = self._refresh_locks.setdefault((bucket_name, prefix), threading.Lock())
+
+        with refresh_lock:
+            now = time.time()
+            with self._lock:
+                row = self._db.execute('SELECT last_key, listed_at FROM roots WHERE bucket = ? AND prefix = ?',
+                                       (bucket_name, prefix)).fetchone()
+            full = full or row is None or now - row[1] > self.ttl
+            count = self._full_refresh(bucket_name, prefix, now) if full else \
+                self._incremental_refresh(bucket_name, prefix, row[0], now)
+
+            logger.debug('Listed %d keys under s3://%s/%s (%s refresh)', count, bucket_name, prefix,
+                         'full' if full else 'incremental')
+            return count
+
+    def _incremental_refresh(self, bucket_name, prefix, last_key, now):
+        count = 0
+        for page in self._list_pages(bucket_name, prefix, last_key):
+            with self._lock, self._db:
+                self._insert_page('keys', bucket_name, prefix, page)
+                self._db.execute('UPDATE roots SET last_key = ? WHERE bucket = ? AND prefix = ?',
+                                 (page[-1]['Key'], bucket_name, prefix))
+            count += len(page)
+
+        with self._lock, self._db:
+            self._db.execute('UPDATE roots SET refreshed_at = ? WHERE bucket = ? AND prefix = ?',
+                             (now, bucket_name, prefix))
+        return count
+
+    def _full_refresh(self, bucket_name, prefix, now):
+        with self._lock:
+            row = self._db.execute('SELECT last_key, listed_at FROM staged_roots WHERE bucket = ? AND prefix = ?',
+                                   (bucket_name, prefix)).fetchone()
+        if row is not None and now - row[1] <= self.ttl:
+            # an interrupted full refresh, carry on from its last page
+            last_key, listed_at = row
+        else:
+            last_key, listed_at = None, now
+            with self._lock, self._db:
+                self._db.execute('DELETE FROM staged_keys WHERE bucket = ? AND root = ?', (bucket_name, prefix))
+                self._db.execute('INSERT OR REPLACE INTO staged_roots VALUES (?, ?, ?, ?)',
+                                 (bucket_name, prefix, None, listed_at))
+
+        count = 0
+        for page in self._list_pages(bucket_name, prefix, last_key):
+            last_key = page[-1]['Key']
+            with self._lock, self._db:
+                self._insert_page('staged_keys', bucket_name, prefix, page)
+                self._db.execute('UPDATE staged_roots SET last_key = ? WHERE bucket = ? AND prefix = ?',
+                                 (last_key, bucket_name, prefix))
+            count += len(page)
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM keys WHERE bucket = ? AND root = ?', (bucket_name, prefix))
+            self._db.execute('INSERT INTO keys SELECT * FROM staged_keys WHERE bucket = ? AND root = ?',
+                             (bucket_name, prefix))
+            self._db.execute('DELETE FROM staged_keys WHERE bucket = ? AND root = ?', (bucket_name, prefix))
+            self._db.execute('DELETE FROM staged_roots WHERE bucket = ? AND prefix = ?', (bucket_name, prefix))
+            self._db.execute('INSERT OR REPLACE INTO roots VALUES (?, ?, ?, ?, ?)',
+                             (bucket_name, prefix, last_key, listed_at, now))
+        return count
+
+    def invalidate(self, bucket_name, prefix=None):
+        """Forgets a root, or all the roots of a bucket if prefix is None"""
+        with self._lock, self._db:
+            for keys, roots in (('keys', 'roots'), ('staged_keys', 'staged_roots')):
+                if prefix is None:
+                    self._db.execute('DELETE FROM {} WHERE bucket = ?'.format(keys), (bucket_name,))
+                    self._db.execute('DELETE FROM {} WHERE bucket = ?'.format(roots), (bucket_name,))
+                else:
+                    self._db.execute('DELETE FROM {} WHERE bucket = ? AND root = ?'.format(keys), (bucket_name, prefix))
+                    self._db.execute('DELETE FROM {} WHERE bucket = ? AND prefix = ?'.format(roots),
+                                     (bucket_name, prefix))
+
+    def _longest_root(self, bucket_name, prefix):
+        """Returns the (prefix, listed_at, refreshed_at) row of the longest root containing prefix, or None"""
+        with self._lock:
+            rows = self._db.execute('SELECT prefix, listed_at, refreshed_at FROM roots WHERE bucket = ?',
+                                    (bucket_name,)).fetchall()
+        roots = [row for row in rows if prefix.startswith(row[0])]
+        return max(roots, key=lambda row: len(row[0])) if roots else None
+
+    def _root_for(self, bucket_name, prefix):
+        """Returns the longest root containing prefix, refreshed if needed, or makes prefix a new root"""
+        # refreshed without holding self._lock, so that listings of other roots and reads aren't blocked meanwhile,
+        # the refresh lock of the root is enough to serialise refreshes
+        row = self._longest_root(bucket_name, prefix)
+        if row is None:
+            self.refresh(bucket_name, prefix)
+        else:
+            root, listed_at, refreshed_at = row
+            now = time.time()
+            if now - refreshed_at >= self.refresh_interval or now - listed_at > self.ttl:
+                self.refresh(bucket_name, root)
+
+        # another thread may have made a longer root containing prefix meanwhile
+        return self._longest_root(bucket_name, prefix)[0]
+
+    def _fetch(self, bucket_name, root, start, after, end):
+        """Returns up to FETCH_SIZE keys of a root with start <= name < end and name > after, in name order"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT name, size, etag, last_modified FROM keys '
+                'WHERE bucket = ? AND root = ? AND name >= ? AND name > ? AND (? IS NULL OR name < ?) '
+                'ORDER BY name LIMIT ?',
+                (bucket_name, root, start, after, end, end, FETCH_SIZE)).fetchall()
+        return [IndexedKey(*row) for row in rows]
+
+    def iter_keys(self, bucket_name, prefix):
+        """Yields every key under a prefix in lexicographic order, like a recursive listing
+
+        Args:
+            bucket_name (str):
+            prefix (str):
+
+        Returns:
+            generator of IndexedKey
+        """
+        root = self._root_for(bucket_name, prefix)
+        end = _prefix_upper_bound(prefix)
+        after = ''
+        while True:
+            keys = self._fetch(bucket_name, root, prefix, after, end)
+            for key in keys:
+                yield key
+            if len(keys) < FETCH_SIZE:
+                return
+            after = keys[-1].name
+
+    def iter_directory(self, bucket_name, prefix, delimiter=DELIMITER):
+        """Yields the immediate children of a prefix, like listing.iter_directory but in lexicographic order
+
+        The keys of each sub directory are skipped over rather than read.
+
+        Args:
+            bucket_name (str):
+            prefix (str):
+            delimiter (str):
+
+        Returns:
+            generator of (name, key) pairs, name being relative to the prefix. key is None for sub directories, an
+            IndexedKey otherwise
+        """
+        root = self._root_for(bucket_name, prefix)
+        end = _prefix_upper_bound(prefix)
+        start, after = prefix, ''
+        while True:
+            keys = self._fetch(bucket_name, root, start, after, end)
+            skipped = False
+            for key in keys:
+                name = key.name[len(prefix):]
+                if delimiter in name:
+                    directory = name[:name.index(delimiter)]
+                    if directory:
+                        yield directory, None
+                    start = _prefix_upper_bound(prefix + directory + delimiter)
+                    skipped = True
+                    break
+                if name:
+                    yield name, key
+                after = key.name
+
+            if not skipped and len(keys) < FETCH_SIZE:
+                return
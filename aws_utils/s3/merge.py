@@ -0,0 +1,199 @@
+"""Planning of the multipart parts used to concatenate many S3 keys into one.
+
+Every part but the last must be between MIN_PART_SIZE and MAX_PART_SIZE and an
+upload can't have more than MAX_PARTS parts. Within those limits each key big
+enough to be a part on its own is either copied server side or downloaded and
+uploaded again, whichever is estimated to be faster: a server side copy moves
+no bytes through the client but has a higher fixed cost than a GET (see
+download_cost and copy_cost). Smaller keys have to be downloaded and grouped
+together. When a group of small keys is followed by a big key and is still too
+small, it can be topped up with the head of that key, so that only those few
+bytes are downloaded and the rest of the key is copied. If the parts don't fit
+in MAX_PARTS, the keys are planned again with bigger parts.
+"""
+import math
+from collections import namedtuple
+
+from aws_utils.s3.transfer import MAX_PART_SIZE, MAX_PARTS, MIN_PART_SIZE
+
+COPY = 'copy'
+DOWNLOAD = 'download'
+# rough figures for the cost model: bytes per second downloaded (and as many uploaded again) by the client, bytes
+# per second of a server side UploadPartCopy, and the fixed seconds each GET or copy request costs
+CLIENT_BANDWIDTH = 50 * (1024 ** 2)
+COPY_BANDWIDTH = 200 * (1024 ** 2)
+GET_LATENCY = 0.05
+COPY_LATENCY = 0.5
+
+
+def download_cost(size):
+    """Estimated seconds to download size bytes of a key and upload them again as part of a part"""
+    return GET_LATENCY + 2.0 * size / CLIENT_BANDWIDTH
+
+
+def copy_cost(size, max_part_size=MAX_PART_SIZE):
+    """Estimated seconds to copy size bytes of a key server side, in as many parts as max_part_size requires"""
+    return COPY_LATENCY * math.ceil(size / float(max_part_size)) + float(size) / COPY_BANDWIDTH
+
+
+class Segment(namedtuple('Segment', ['key', 'start', 'end'])):
+    """A byte range of a key, both ends inclusive"""
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.end - self.start + 1
+
+    @property
+    def is_whole_key(self):
+        return self.start == 0 and self.end == self.key.size - 1
+
+
+class MergePart(object):
+    """One part of the merged object, either copied server side from a single segment or assembled by downloading
+    one or more segments"""
+
+    def __init__(self, kind, segments):
+        self.kind = kind
+        self.segments = segments
+        self.size = sum(segment.size for segment in segments)
+
+    def explain(self):
+        if self.kind == COPY:
+            segment = self.segments[0]
+            return 'copy {} bytes {}-{} ({} bytes)'.format(segment.key.name, segment.start, segment.end, self.size)
+        return 'download {} segments from {} to {} ({} bytes)'.format(
+            len(self.segments), self.segments[0].key.name, self.segments[-1].key.name, self.size)
+
+
+class MergePlan(object):
+    """The ordered list of parts needed to merge some keys, see plan_merge"""
+
+    def __init__(self, parts, part_size, copy_threshold):
+        self.parts = parts
+        self.part_size = part_size
+        self.copy_threshold = copy_threshold
+
+    def __iter__(self):
+        return iter(self.parts)
+
+    def __len__(self):
+        return len(self.parts)
+
+    @property
+    def total_size(self):
+        return sum(part.size for part in self.parts)
+
+    @property
+    def copied_bytes(self):
+        return sum(part.size for part in self.parts if part.kind == COPY)
+
+    @property
+    def downloaded_bytes(self):
+        return sum(part.size for part in self.parts if part.kind == DOWNLOAD)
+
+    @property
+    def requests(self):
+        """Number of S3 requests needed to fetch the data, one per copied part and one per downloaded segment"""
+        return sum(1 if part.kind == COPY else len(part.segments) for part in self.parts)
+
+    def explain(self):
+        """Returns a human readable description of the plan"""
+        if self.copy_threshold is None:
+            copies = 'keys are copied server side when it is estimated to be faster'
+        else:
+            copies = 'keys of {} bytes or more are copied server side'.format(self.copy_threshold)
+        lines = ['{} parts of at least {} bytes, {}: {} bytes copied, {} bytes downloaded in {} requests'.format(
+            len(self.parts), self.part_size, copies, self.copied_bytes, self.downloaded_bytes, self.requests)]
+        for num, part in enumerate(self.parts, 1):
+            lines.append('part {}: {}'.format(num, part.explain()))
+        return '\n'.join(lines)
+
+
+def plan_merge(keys, min_part_size=MIN_PART_SIZE, max_part_size=MAX_PART_SIZE, max_parts=MAX_PARTS,
+               copy_threshold=None):
+    """Plans the parts of a multipart upload concatenating the given keys, in order.
+
+    Args:
+        keys (list): objects with a name and a size, e.g. boto.s3.key.Key
+        min_part_size (int): minimum size of every part but the last one
+        max_part_size (int): maximum size of a part
+        max_parts (int): maximum number of parts
+        copy_threshold (int): if set, keys of at least this size are always copied server side rather than
+            downloaded, instead of comparing the estimated costs. Keys smaller than the part size are never copied,
+            the part size being raised above min_part_size when needed to stay within max_parts.
+
+    Returns:
+        MergePlan
+
+    Raises:
+        ValueError: if the keys can't be merged within max_parts parts of at most max_part_size
+    """
+    total_size = sum(key.size for key in keys)
+    part_size = max(min_part_size, int(math.ceil(total_size / float(max_parts))))
+    while part_size <= max_part_size:
+        parts = _plan_parts(keys, part_size, max_part_size, copy_threshold)
+        if len(parts) <= max_parts:
+            return MergePlan(parts, part_size, None if copy_threshold is None else max(copy_threshold, part_size))
+        # copied keys are parts on their own, bigger parts make the smaller ones grouped with their neighbours
+        part_size = int(math.ceil(part_size * len(parts) / float(max_parts)))
+    raise ValueError('{} bytes can\'t be merged in at most {} parts of at most {} bytes'.format(
+        total_size, max_parts, max_part_size))
+
+
+def _should_copy(key_size, missing, part_size, max_part_size, copy_threshold):
+    """Whether the key should be copied server side, after topping up the current group with its first missing
+    bytes"""
+    rest = key_size - missing
+    if rest < part_size:
+        return False
+    if copy_threshold is not None:
+        return rest >= copy_threshold
+    topping_up = download_cost(missing) if missing else 0
+    return topping_up + copy_cost(rest, max_part_size) < download_cost(key_size)
+
+
+def _plan_parts(keys, part_size, max_part_size, copy_threshold):
+    """Returns the list of MergeParts of the keys, see plan_merge"""
+    parts = []
+    group = []
+    group_size = [0]
+
+    def add_to_group(segment):
+        group.append(segment)
+        group_size[0] += segment.size
+        if group_size[0] >= part_size:
+            flush_group()
+
+    def flush_group():
+        if group:
+            parts.append(MergePart(DOWNLOAD, list(group)))
+            del group[:]
+            group_size[0] = 0
+
+    for key in keys:
+        start = 0
+        missing = part_size - group_size[0] if group else 0
+        if _should_copy(key.size, missing, part_size, max_part_size, copy_threshold):
+            if missing:
+                add_to_group(Segment(key, 0, missing - 1))
+                start = missing
+            _add_copy_parts(parts, key, start, max_part_size)
+            continue
+
+        # the key (or what's left of it) is downloaded, splitting it if it doesn't fit in the current part
+        while start < key.size:
+            size = min(key.size - start, max_part_size - group_size[0])
+            add_to_group(Segment(key, start, start + size - 1))
+            start += size
+    flush_group()
+    return parts
+
+
+def _add_copy_parts(parts, key, start, max_part_size):
+    """Adds copy parts for the key from start onwards, split in even ranges no bigger than max_part_size"""
+    remaining = key.size - start
+    count = int(math.ceil(remaining / float(max_part_size)))
+    size = int(math.ceil(remaining / float(count)))
+    for offset in range(start, key.size, size):
+        parts.append(MergePart(COPY, [Segment(key, offset, min(offset + size, key.size) - 1)]))
@@ -0,0 +1,120 @@
+"""Existence, size and etag of many S3 keys at once.
+
+Keys are looked up with HEAD requests on a pool of threads. When many of the
+keys are in the same folder, e.g. the part files written by a job, listing
+the prefix they share returns the metadata of up to 1000 keys per request, so
+such groups are listed instead. A listing gives up after a number of pages
+proportional to the number of keys it is meant to find, in case the prefix
+holds many more keys than we are interested in, and the keys it didn't reach
+are then looked up one by one.
+"""
+import logging
+import os
+from collections import namedtuple
+
+from aws_utils.s3.concurrency import bounded_map
+
+logger = logging.getLogger(__name__)
+HEAD_NUM_WORKERS = 16
+LIST_PAGE_SIZE = 1000
+# a listing is worth it if each page of 1000 keys saves at least this many HEAD requests
+LIST_MIN_KEYS = 50
+
+
+class KeyMetadata(namedtuple('KeyMetadata', ['name', 'exists', 'size', 'etag'])):
+    """Metadata of a key, size and etag are None if it doesn't exist"""
+    __slots__ = ()
+
+    @classmethod
+    def from_key(cls, name, key):
+        if key is None:
+            return cls(name, False, None, None)
+        return cls(name, True, key.size, key.etag)
+
+
+def _group_by_folder(paths):
+    groups = {}
+    for path in paths:
+        groups.setdefault(path.rsplit('/', 1)[0] if '/' in path else '', []).append(path)
+    return groups.values()
+
+
+def _list_group(bucket, paths):
+    """Lists the prefix shared by paths, within a budget of pages
+
+    Returns:
+        tuple: {path: KeyMetadata} of the paths whose metadata is known, list of the paths the listing didn't reach
+    """
+    paths = sorted(paths)
+    wanted = set(paths)
+    prefix = os.path.commonprefix(paths)
+    max_listed = max(1, len(paths) // LIST_MIN_KEYS) * LIST_PAGE_SIZE
+
+    found = {}
+    listed = 0
+    last_name = None
+    for key in bucket.list(prefix=prefix):
+        if key.name in wanted:
+            found[key.name] = KeyMetadata.from_key(key.name, key)
+        last_name = key.name
+        listed += 1
+        if key.name >= paths[-1] or listed >= max_listed:
+            break
+    else:
+        # the listing is complete, anything not found doesn't exist
+        last_name = paths[-1]
+
+    unreached = []
+    for path in paths:
+        if path not in found:
+            if last_name is not None and path <= last_name:
+                found[path] = KeyMetadata.from_key(path, None)
+            else:
+                unreached.append(path)
+    logger.debug('Listed %d keys under %s for %d paths, %d left to look up', listed, prefix, len(paths),
+                 len(unreached))
+    return found, unreached
+
+
+def head_keys(bucket, paths, num_workers=HEAD_NUM_WORKERS, use_listing=True):
+    """Returns the metadata of many keys, looking them up concurrently
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        paths (iterable of str): paths within the bucket
+        num_workers (int): number of HEAD requests (or listings) sent at the same time
+        use_listing (bool): if False every key is looked up with a HEAD request, even when listing their folder
+            would be cheaper
+
+    Returns:
+        dict: {path: KeyMetadata}
+    """
+    metadata = {}
+    to_list = []
+    to_head = []
+    for group in _group_by_folder(set(paths)):
+        if use_listing and len(group) >= LIST_MIN_KEYS:
+            to_list.append(group)
+        else:
+            to_head.extend(group)
+
+    for found, unreached in bounded_map(lambda group: _list_group(bucket, group), to_list, num_workers=num_workers):
+        metadata.update(found)
+        to_head.extend(unreached)
+
+    for key_metadata in bounded_map(lambda path: head_key(bucket, path), to_head, num_workers=num_workers):
+        metadata[key_metadata.name] = key_metadata
+    return metadata
+
+
+def head_key(bucket, path):
+    """Returns the KeyMetadata of a single key with a HEAD request
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path within the bucket
+
+    Returns:
+        KeyMetadata
+    """
+    return KeyMetadata.from_key(path, bucket.get_key(path))
@@ -0,0 +1,225 @@
+"""In-process cache of the objects loaded from S3, e.g. unpickled models or parsed JSON.
+
+Entries are keyed by bucket, path and variant, the variant telling apart the
+objects loaded differently from the same key (e.g. with or without
+decompression), and remember the etag of the object they were loaded from.
+Within its TTL an entry is returned straight away; past it the etag of the
+object is checked with a HEAD request, and the object is only downloaded and
+loaded again if the etag changed.
+
+The memory budget is counted in bytes of the S3 objects, which is only a
+proxy of the memory the loaded objects take. Once the budget is exceeded the
+least recently used entries are dropped.
+
+A background refresher can check the etags of all the entries periodically
+and swap in the new versions of the objects which changed, so callers never
+wait on S3 as long as the refresh interval is shorter than the TTL.
+
+Cached objects are shared by all the callers, they must not be modified.
+
+Example:
+    models = ObjectCache(max_size=2 * 1024 ** 3, ttl=300)
+    models.start_refresher(60)
+    load_pickle_from_s3(bucket, 'models/latest/model.pkl', object_cache=models)
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from aws_utils.s3.metadata import head_key, head_keys
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_MAX_SIZE = 512 * (1024 ** 2)
+DEFAULT_TTL = 60
+
+
+class _Entry(object):
+    __slots__ = ('bucket', 'load', 'value', 'etag', 'size', 'validated_at')
+
+    def __init__(self, bucket, load, value, etag, size, validated_at):
+        self.bucket = bucket
+        self.load = load
+        self.value = value
+        self.etag = etag
+        self.size = size
+        self.validated_at = validated_at
+
+
+class ObjectCache(object):
+    """Cache of loaded S3 objects, see the module documentation
+
+    A single cache can be shared by several threads.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        """
+        Args:
+            max_size (int): budget in bytes of S3 objects, objects bigger than that are loaded but not cached
+            ttl (int): seconds during which an entry is used without checking the etag of its object, 0 to check it
+                on every get
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        # (bucket name, path, variant) -> _Entry, least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        # cache key -> [lock held while the object is loaded, number of threads holding or waiting for it], dropped
+        # once no thread needs it anymore
+        self._loading = {}
+        self._refresher = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _touch(self, cache_key):
+        """Returns the entry of cache_key, making it the most recently used, or None"""
+        with self._lock:
+            entry = self._entries.pop(cache_key, None)
+            if entry is not None:
+                self._entries[cache_key] = entry
+            return entry
+
+    @contextmanager
+    def _loading_lock(self, cache_key):
+        """Held while the object of cache_key is loaded, so it is only loaded once at a time"""
+        with self._lock:
+            loading = self._loading.setdefault(cache_key, [threading.Lock(), 0])
+            loading[1] += 1
+        try:
+            with loading[0]:
+                yield
+        finally:
+            with self._lock:
+                loading[1] -= 1
+                if not loading[1]:
+                    del self._loading[cache_key]
+
+    def get(self, bucket, path, load, variant=None):
+        """Returns the object loaded from a key, loading it only if it isn't cached or changed since
+
+        Args:
+            bucket (boto.s3.bucket.Bucket):
+            path (str): path of the object within the bucket
+            load (function): called with bucket and path to download and load the object
+            variant (hashable): tells apart the loads of the same key returning different objects, e.g. the
+                options of load. Each variant is cached on its own
+
+        Returns:
+            the object returned by load
+        """
+        cache_key = (bucket.name, path, variant)
+        entry = self._touch(cache_key)
+        if entry is not None and time.time() - entry.validated_at < self.ttl:
+            return entry.value
+
+        with self._loading_lock(cache_key):
+            # another thread may have loaded it in the meantime
+            entry = self._touch(cache_key)
+            if entry is not None and time.time() - entry.validated_at < self.ttl:
+                return entry.value
+
+            metadata = head_key(bucket, path)
+            if entry is not None and entry.etag == metadata.etag:
+                entry.validated_at = time.time()
+                return entry.value
+
+            value = load(bucket, path)
+            self._store(cache_key, _Entry(bucket, load, value, metadata.etag, metadata.size or 0, time.time()))
+            logger.debug('Loaded s3://%s/%s (etag %s)', bucket.name, path, metadata.etag)
+            return value
+
+    def _store(self, cache_key, entry):
+        with self._lock:
+            previous = self._entries.pop(cache_key, None)
+            if previous is not None:
+                self.size -= previous.size
+            if entry.size > self.max_size:
+                return
+            self._entries[cache_key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+                logger.debug('Evicted s3://%s/%s (%d bytes)', evicted_key[0], evicted_key[1], evicted.size)
+
+    def invalidate(self, bucket_name, path):
+        """Drops the entries of an object, if any, whatever their variant"""
+        with self._lock:
+            for cache_key in [k for k in self._entries if k[:2] == (bucket_name, path)]:
+                self.size -= self._entries.pop(cache_key).size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def refresh(self):
+        """Checks the etags of all the entries and loads again the objects which changed
+
+        Entries whose object was deleted are dropped. Entries which can't be refreshed are kept as they are.
+        """
+        with self._lock:
+            by_bucket = {}
+            for cache_key, entry in self._entries.items():
+                by_bucket.setdefault(cache_key[0], (entry.bucket, []))[1].append((cache_key, entry))
+
+        for bucket_name, (bucket, entries) in by_bucket.items():
+            paths = sorted(set(cache_key[1] for cache_key, _ in entries))
+            try:
+                metadata = head_keys(bucket, paths)
+            except Exception:
+                logger.exception('Unable to check the etags of %d objects of %s', len(paths), bucket_name)
+                continue
+
+            for cache_key, entry in entries:
+                path = cache_key[1]
+                if not metadata[path].exists:
+                    self.invalidate(bucket_name, path)
+                elif metadata[path].etag == entry.etag:
+                    entry.validated_at = time.time()
+                else:
+                    try:
+                        with self._loading_lock(cache_key):
+                            value = entry.load(bucket, path)
+                    except Exception:
+                        logger.exception('Unable to refresh s3://%s/%s', bucket_name, path)
+                        continue
+                    with self._lock:
+                        # not swapped in if it was evicted or invalidated in the meantime
+                        if self._entries.get(cache_key) is entry:
+                            self._store(cache_key, _Entry(bucket, entry.load, value, metadata[path].etag,
+                                                          metadata[path].size, time.time()))
+                    logger.info('Refreshed s3://%s/%s (etag %s)', bucket_name, path, metadata[path].etag)
+
+    def _refresh_forever(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Refresh of the object cache failed')
+
+    def start_refresher(self, interval):
+        """Starts a daemon thread calling refresh every interval seconds
+
+        Args:
+            interval (int): seconds between the end of a refresh and the start of the next one
+        """
+        if self._refresher is not None:
+            raise RuntimeError('The refresher is already running')
+        self._stop.clear()
+        self._refresher = threading.Thread(target=self._refresh_forever, args=(interval,),
+                                           name='object-cache-refresher')
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def stop_refresher(self):
+        """Stops the refresher thread, waiting for the refresh in progress if any"""
+        if self._refresher is not None:
+            self._stop.set()
+            self._refresher.join()
+            self._refresher = None
@@ -0,0 +1,132 @@
+"""Discovery of the year=YYYY/month=MM/day=DD/ date partitions under an S3 prefix.
+
+Rather than listing every key below the prefix, the hierarchy is walked with
+delimiter listings (see aws_utils.s3.listing): the years first, then the
+months of a single year and the days of a single month. Walking from the most
+recent year down, the latest partition is usually found in three listings, a
+year or month without any day partition just falls back to the previous one.
+Ranges of dates only descend into the years and months they overlap.
+"""
+import re
+from datetime import date
+from itertools import islice
+
+from aws_utils.s3.listing import DELIMITER, iter_directory
+
+YEAR_PATTERN = re.compile(r'year=(\d{4})')
+MONTH_PATTERN = re.compile(r'month=(\d{2})')
+DAY_PATTERN = re.compile(r'day=(\d{2})')
+# a partition anywhere in a key name, however deep below the listed prefix
+NESTED_PARTITION_PATTERN = re.compile(r'.*year=(\d{4}).*month=(\d{2}).*day=(\d{2})')
+
+
+def _partition_values(bucket, prefix, pattern, directories_only=True, index=None):
+    """Returns {partition value: child name} for the children of prefix matching pattern"""
+    values = {}
+    for name, key in iter_directory(bucket, prefix, index=index):
+        if directories_only and key is not None:
+            continue
+        match = pattern.match(name)
+        if match:
+            values.setdefault(int(match.group(1)), name)
+    return values
+
+
+def iter_partitions(bucket, prefix, from_date=None, to_date=None, reverse=False, index=None):
+    """Lazily yields the dates of the partitions under a prefix, listing only what is needed
+
+    Years and months are folders, days can be folders or keys, e.g. both 'year=2017/month=05/day=30/part-00000'
+    and 'year=2017/month=05/day=30' are partitions for the 30th of May 2017.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): path holding the year= folders, e.g. 'production/output/'
+        from_date (date): if set, earlier partitions are skipped
+        to_date (date): if set, later partitions are skipped
+        reverse (bool): if True the most recent partitions come first
+        index (aws_utils.s3.listing_index.ListingIndex): if set the partitions are read from this index rather than
+            listed
+
+    Returns:
+        generator of date
+    """
+    if prefix and not prefix.endswith(DELIMITER):
+        prefix += DELIMITER
+    from_date = from_date or date.min
+    to_date = to_date or date.max
+
+    years = _partition_values(bucket, prefix, YEAR_PATTERN, index=index)
+    for year in sorted(years, reverse=reverse):
+        if not from_date.year <= year <= to_date.year:
+            continue
+
+        year_prefix = prefix + years[year] + DELIMITER
+        months = _partition_values(bucket, year_prefix, MONTH_PATTERN, index=index)
+        for month in sorted(months, reverse=reverse):
+            if not (from_date.year, from_date.month) <= (year, month) <= (to_date.year, to_date.month):
+                continue
+
+            days = _partition_values(bucket, year_prefix + months[month] + DELIMITER, DAY_PATTERN,
+                                     directories_only=False, index=index)
+            for day in sorted(days, reverse=reverse):
+                partition = date(year, month, day)
+                if from_date <= partition <= to_date:
+                    yield partition
+
+
+def has_partitions(bucket, prefix, index=None):
+    """Whether a prefix holds year= folders, i.e. whether iter_partitions can find partitions under it"""
+    if prefix and not prefix.endswith(DELIMITER):
+        prefix += DELIMITER
+    return bool(_partition_values(bucket, prefix, YEAR_PATTERN, index=index))
+
+
+def find_nested_partitions(names):
+    """Yields the date of the partition found anywhere in each key name having one
+
+    Unlike iter_partitions this needs every key name to be listed, but the year= folders can be at any depth.
+
+    Args:
+        names (iterable of str): e.g. ['output/partner=1/year=2017/month=05/day=30/part-00000']
+
+    Returns:
+        generator of date
+    """
+    for name in names:
+        match = NESTED_PARTITION_PATTERN.search(name)
+        if match:
+            year, month, day = match.groups()
+            yield date(int(year), int(month), int(day))
+
+
+def get_latest_partitions(bucket, prefix, count=1, index=None):
+    """Returns the dates of the most recent partitions under a prefix
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): path holding the year= folders
+        count (int): maximum number of partitions returned
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the partitions from
+
+    Returns:
+        list of date: most recent first
+    """
+    return list(islice(iter_partitions(bucket, prefix, reverse=True, index=index), count))
+
+
+def get_partitions_in_range(bucket, prefix, from_date, to_date, index=None):
+    """Returns the dates of the partitions under a prefix between two dates, both included
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): path holding the year= folders
+        from_date (date):
+        to_date (date):
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the partitions from
+
+    Returns:
+        list of date: in chronological order
+    """
+    if from_date > to_date:
+        raise ValueError('The start date {} is > the end date {}'.format(from_date, to_date))
+    return list(iter_partitions(bucket, prefix, from_date=from_date, to_date=to_date, index=index))
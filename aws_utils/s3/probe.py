@@ -0,0 +1,46 @@
+"""Cheap existence checks of keys under S3 prefixes.
+
+Checking whether a prefix holds some data usually only needs its first few
+keys, so rather than listing pages of 1000 keys we ask for a small page first
+and only grow the page size when none of the keys matched. The listing stops
+at the first matching key.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+FIRST_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 1000
+PAGE_SIZE_GROWTH = 10
+
+
+def _page_sizes(first_page_size, max_page_size):
+    size = first_page_size
+    while True:
+        yield size
+        size = min(size * PAGE_SIZE_GROWTH, max_page_size)
+
+
+def find_first_key(bucket, prefix, predicate=None, first_page_size=FIRST_PAGE_SIZE, max_page_size=MAX_PAGE_SIZE):
+    """Returns the first key under a prefix accepted by predicate, listing as few keys as possible
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): path within the bucket
+        predicate (function): called with each boto.s3.key.Key, if None the first key is returned
+        first_page_size (int): number of keys listed by the first request, each following request lists
+            PAGE_SIZE_GROWTH times more keys
+        max_page_size (int): maximum number of keys listed by a request, S3 never returns more than 1000
+
+    Returns:
+        boto.s3.key.Key or None
+    """
+    marker = ''
+    for page_size in _page_sizes(first_page_size, max_page_size):
+        page = bucket.get_all_keys(prefix=prefix, max_keys=page_size, marker=marker)
+        for key in page:
+            if predicate is None or predicate(key):
+                return key
+        if not page.is_truncated or not len(page):
+            return None
+        marker = page[-1].name
+        logger.debug('No matching key in the first %s keys under %s, listing more', page_size, prefix)
@@ -0,0 +1,146 @@
+"""Listing of the S3 keys whose name matches a regex.
+
+Two things make this cheaper than filtering bucket.list():
+
+* a pattern anchored at the start of the key name, e.g.
+  '^production/output/part-\\d+$', can only match keys starting with its
+  literal prefix ('production/output/part-'), so only those are listed;
+* the listing pages are plain dicts and the pattern is tried on each name,
+  a boto Key object is only built for the keys matching it rather than for
+  every key listed.
+"""
+import re
+
+from boto.s3.key import Key
+
+from aws_utils.s3.listing import LIST_PAGE_SIZE, format_datetime, iter_pages
+
+# python version backwards compatibility
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+# characters with a special meaning outside of character classes
+METACHARACTERS = frozenset('.^$*+?{}[]|()\\')
+# quantifiers allowing zero repetitions, the character before them is optional
+OPTIONAL_QUANTIFIERS = frozenset('*?{')
+
+
+def _has_top_level_branch(pattern):
+    """Whether pattern has a | outside of any group or character class, i.e. whether it is an alternative of
+    several patterns"""
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            i += 1
+        elif char == '[':
+            # a ] right after the opening [ (or [^) is a literal
+            i += 2 if pattern[i + 1:i + 2] == '^' else 1
+            i += 1 if pattern[i:i + 1] == ']' else 0
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def _scan_literal_prefix(pattern):
+    """Returns the literal characters pattern starts with, up to its first metacharacter or special escape"""
+    chars = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        size = 1
+        if char == '\\':
+            # escaped punctuation is a literal, escaped letters and digits are classes, anchors or references
+            char = pattern[i + 1:i + 2]
+            if not char or char.isalnum():
+                break
+            size = 2
+        elif char in METACHARACTERS:
+            break
+        following = pattern[i + size:i + size + 1]
+        if following in OPTIONAL_QUANTIFIERS:
+            break
+        chars.append(char)
+        if following == '+':
+            break
+        i += size
+    return ''.join(chars)
+
+
+def literal_prefix(pattern):
+    """Returns the literal text every match of a pattern starts with, if matches must start at the beginning
+
+    The pattern string is scanned up to its first metacharacter, so the prefix can be shorter than what every
+    match starts with (e.g. it stops at groups) but never longer.
+
+    Args:
+        pattern (re.RegexObject): e.g. re.compile('^production/output/part-\\d+')
+
+    Returns:
+        str: e.g. 'production/output/part-', None if the pattern isn't anchored at the beginning of the string
+    """
+    if pattern.flags & re.IGNORECASE:
+        return None
+    text = pattern.pattern
+    if not isinstance(text, text_type):
+        text = text.decode('latin-1')
+
+    if text.startswith('\\A'):
+        rest = text[2:]
+    elif text.startswith('^') and not pattern.flags & re.MULTILINE:
+        rest = text[1:]
+    else:
+        return None
+    if _has_top_level_branch(text):
+        return None
+
+    # whitespace and comments are ignored in verbose patterns
+    prefix = '' if pattern.flags & re.VERBOSE else _scan_literal_prefix(rest)
+    return prefix if isinstance(pattern.pattern, text_type) else prefix.encode('latin-1')
+
+
+def _to_key(bucket, obj):
+    key = Key(bucket, obj['Key'])
+    key.size = obj['Size']
+    key.etag = obj.get('ETag')
+    key.last_modified = format_datetime(obj['LastModified'])
+    key.storage_class = obj.get('StorageClass')
+    return key
+
+
+def iter_matching_keys(bucket, prefix, pattern, page_size=LIST_PAGE_SIZE):
+    """Lazily yields the keys under a prefix whose name matches a pattern (anywhere, as with pattern.search)
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): 'production/output/'
+        pattern (re.RegexObject): matched against the whole key name, if anchored at the beginning (with ^ or \\A)
+            only the keys starting with its literal prefix are listed
+        page_size (int): number of keys per listing request
+
+    Returns:
+        generator of boto.s3.key.Key
+    """
+    anchored_prefix = literal_prefix(pattern)
+    if anchored_prefix is not None:
+        if anchored_prefix.startswith(prefix):
+            prefix = anchored_prefix
+        elif not prefix.startswith(anchored_prefix):
+            return
+
+    search = pattern.search
+    for page in iter_pages(bucket, prefix, page_size=page_size):
+        for obj in page.get('Contents', []):
+            if search(obj['Key']):
+                yield _to_key(bucket, obj)
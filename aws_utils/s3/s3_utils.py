@@ -1,12 +1,9 @@
 import gzip
 import json
+import os
 from io import BytesIO
 import logging
 import boto
-import boto3 as boto3
-import smart_open
-import re
-from datetime import date
 from boto.exception import S3ResponseError, AWSConnectionError
 from botocore.exceptions import ClientError
 from boto.s3.connection import OrdinaryCallingFormat
@@ -15,20 +12,25 @@ from retrying import retry
 from boto.s3.bucket import Bucket
 from dateutil import rrule
 
+from aws_utils.s3 import serialization
+from aws_utils.s3.connections import S3_HOST, get_client, get_pooled_bucket, setup_boto
+from aws_utils.s3.concurrency import DEFAULT_NUM_WORKERS, bounded_map, chunked
+from aws_utils.s3.datasets import DATE_PREFIX, LIST_NUM_WORKERS, is_data_file, iter_dataset, read_json_lines
+from aws_utils.s3.listing import iter_directory, iter_key_records
+from aws_utils.s3.merge import COPY, plan_merge
+from aws_utils.s3.metadata import HEAD_NUM_WORKERS, head_key, head_keys
+from aws_utils.s3.partitions import find_nested_partitions, has_partitions, iter_partitions
+from aws_utils.s3.probe import find_first_key
+from aws_utils.s3.regex_listing import iter_matching_keys
+from aws_utils.s3.server_copy import copy_key, delete_keys
+from aws_utils.s3.streaming import iter_json_from_s3, stream_to_s3, text_type
+from aws_utils.s3.sync import sync_local_to_s3, sync_s3_to_local, sync_s3_to_s3
+from aws_utils.s3.transfer import MULTIPART_THRESHOLD, MultipartUpload, download_to_buffer, download_to_file, \
+    read_key_into, upload_file_multipart, upload_string_multipart
+from aws_utils.s3.verify import MISSING, verify_key, verify_keys
+
 
 # python version backwards compatibility
-try:
-    from ConfigParser import DuplicateSectionError
-except ImportError:
-    from configparser import DuplicateSectionError
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
 try:
     from urlparse import urlparse
 except ImportError:
@@ -37,7 +39,12 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 CHUNK_SIZE = 5 * (1024 ** 2)
-STD_DATE_PREFIX = 'year={:04}/month={:02}/day={:02}/'
+MERGE_FETCH_WORKERS = 4
+# maximum number of keys in a multi-object delete request
+DELETE_BATCH_SIZE = 1000
+DELETE_NUM_WORKERS = 4
+PROBE_NUM_WORKERS = 16
+STD_DATE_PREFIX = DATE_PREFIX
 
 
 class PklError(Exception):
@@ -71,44 +78,118 @@ def get_date_range(from_date, to_date):
     return rrule.rrule(rrule.DAILY, dtstart=from_date, until=to_date)
 
 
+def read_date_partitions(bucket, base_path, from_date, to_date, prefix_tmpl=STD_DATE_PREFIX, read=read_json_lines,
+                         file_filter=is_data_file, num_workers=DEFAULT_NUM_WORKERS, max_pending=None, ordered=True,
+                         list_num_workers=LIST_NUM_WORKERS):
+    """Yields the records of the files of every day partition between from and to, see aws_utils.s3.datasets
+
+    The partitions are the ones of get_date_paths, listed and read concurrently. Days without any partition are
+    skipped.
+
+    Args:
+        bucket (str or Bucket):
+        base_path (str): path holding the partitions, e.g. 'production/output/'
+        from_date (date or datetime): inclusive
+        to_date (date or datetime): inclusive
+        prefix_tmpl (str): see get_date_prefix
+        read (function): called with bucket and the path of a file, returns an iterable of its records. Defaults
+            to JSON lines, gzip decompressed for .gz files
+        file_filter (function): called with the KeyRecord of every key, only the keys it returns True for are read.
+            Defaults to leaving out hidden and hadoop marker files
+        num_workers (int): number of files read at the same time
+        max_pending (int): maximum number of files being read or whose records are not all consumed yet, which
+            bounds the memory held, defaults to twice num_workers
+        ordered (bool): if True records come in date then file order, otherwise batch by batch as they are read
+        list_num_workers (int): number of days listed at the same time
+
+    Returns:
+        generator of records
+    """
+    return iter_dataset(get_bucket(bucket), base_path, from_date, to_date, prefix_tmpl=prefix_tmpl, read=read,
+                        file_filter=file_filter, num_workers=num_workers, max_pending=max_pending, ordered=ordered,
+                        list_num_workers=list_num_workers)
+
+
 def get_filesize(bucket, path):
-    bucket = get_bucket(bucket)
-    return bucket.lookup(path).size
+    """Same as file_size but the bucket can also be given by name"""
+    return file_size(get_bucket(bucket), path)
+
 
+def get_files_metadata(bucket, paths, num_workers=HEAD_NUM_WORKERS):
+    """Returns the existence, size and etag of many files at once
 
-def save_to_s3(bucket, path, data, compress=False):
+    Files are looked up concurrently, and folders holding many of the files are listed rather than looking the
+    files up one by one, see aws_utils.s3.metadata.head_keys
+
+    Args:
+        bucket (str or Bucket):
+        paths (iterable of str): paths within the bucket
+        num_workers (int): number of requests sent at the same time
+
+    Returns:
+        dict: {path: aws_utils.s3.metadata.KeyMetadata}, e.g. {'output/part-00000': KeyMetadata(
+            name='output/part-00000', exists=True, size=1024, etag='"9a0364b9e99bb480dd25e1f0284c8555"')}
+    """
+    return head_keys(get_bucket(bucket), paths, num_workers=num_workers)
+
+
+def _existing_file_metadata(bucket, path):
+    """Returns the KeyMetadata of a file, raising an IOError if it doesn't exist"""
+    metadata = head_key(bucket, path)
+    if not metadata.exists:
+        raise IOError('file %s does not exist in bucket %s' % (path, bucket))
+    return metadata
+
+
+def save_to_s3(bucket, path, data, compress=False, multipart_threshold=MULTIPART_THRESHOLD):
     """Takes a data string and saves it to provided path in the provided bucket
 
     Args:
-        compress (bool): If True the data is gzip compressed before saving to s3.
-        data (str): String of data we wish to pass
+        compress (bool): If True the data is gzip compressed before saving to s3, this is done on the fly while
+            uploading so the compressed content is never held in memory as a whole.
+        data (str, bytes, file-like or iterable of str/bytes): Data we wish to pass, anything but a string is
+            streamed to S3 in multipart parts.
         path (str): Path within the bucket to save the file to, should not contain the bucket name
         bucket (str or Bucket): Bucket to add the file to, if a string is provided, we try and open an amazon bucket with that name.
+        multipart_threshold (int): data bigger than this many bytes is sent as a parallel multipart upload.
     """
     bucket = get_bucket(bucket)
+    logger.debug("Uploading to %s", path)
 
-    key = Key(bucket)
-    key.key = path
-    logger.debug("Uploading to %s", key.key)
+    if compress or not isinstance(data, (bytes, str, text_type)):
+        stream_to_s3(bucket, path, data, compress=compress)
+        return
 
-    if compress:
-        mock_file = BytesIO()
-        gzip_obj = gzip.GzipFile(filename='gzipped_file', mode='wb', fileobj=mock_file)
-        if isinstance(data, str):
-            data = data.encode('utf-8')
-        gzip_obj.write(data)
-        gzip_obj.close()
-        data = mock_file.getvalue()
+    # sized once encoded, non ASCII text takes more bytes than characters
+    if isinstance(data, text_type):
+        data = data.encode('utf-8')
+    if len(data) > multipart_threshold:
+        upload_string_multipart(bucket, path, data)
+    else:
+        key = Key(bucket)
+        key.key = path
+        key.set_contents_from_string(data)
 
-    key.set_contents_from_string(data)
 
+def get_from_s3(bucket, path, compressed=False, cache=None):
+    """Reads the content of an object, large objects are fetched in concurrent byte ranges
 
-def get_from_s3(bucket, path, compressed=False):
+    Args:
+        bucket (str or Bucket):
+        path (str): Path within the bucket of the object to read
+        compressed (bool): If True the content is gzip decompressed
+        cache (aws_utils.s3.disk_cache.DiskCache): if set the object is read through this cache, and only
+            downloaded if it changed since it was cached
+    Returns (bytes):
+    """
     bucket = get_bucket(bucket)
 
-    k = Key(bucket)
-    k.key = path
-    data = k.get_contents_as_string()
+    if cache is not None:
+        data = cache.get(bucket, path)
+    else:
+        data = download_to_buffer(bucket, path)
+        if isinstance(data, bytearray):
+            data = bytes(data)
 
     if compressed:
         with gzip.GzipFile(fileobj=BytesIO(data), mode="r") as f:
@@ -117,71 +198,136 @@ def get_from_s3(bucket, path, compressed=False):
     return data
 
 
-def delete_path(bucket, path):
+def delete_path(bucket, path, num_workers=DELETE_NUM_WORKERS):
     """
     Attempts to delete all keys under a given path
     Will also try to remove spark meta data keys for the path
+
+    Keys are deleted DELETE_BATCH_SIZE at a time with multi-object delete requests, which are sent by a few workers
+    while the listing goes on.
+
+    Args:
+        bucket (str or Bucket):
+        path (str): prefix of the keys to delete
+        num_workers (int): number of delete requests in flight at the same time
+
+    Returns:
+        list of boto.s3.multidelete.Error: the keys which could not be deleted
     """
     bucket = get_bucket(bucket)
 
-    for k in bucket.list(path):
-        k.delete()
+    def delete_batch(names):
+        return bucket.delete_keys(names, quiet=True).errors
+
+    names = (k.name for k in bucket.list(path))
+    errors = []
+    for batch_errors in bounded_map(delete_batch, chunked(names, DELETE_BATCH_SIZE), num_workers=num_workers):
+        errors.extend(batch_errors)
+
     k = Key(bucket)
     k.key = path.strip("/") + "_$folder$"
     k.delete()
 
+    for error in errors:
+        logger.error("Unable to delete %s: %s %s", error.key, error.code, error.message)
+    return errors
 
-def verify_s3_pkl(bucket, path, data):
+
+def verify_s3_pkl(bucket, path, data, checksum=False, protocol=serialization.DEFAULT_PROTOCOL, compression=None):
     """
     Grabs a pkl file from S3 and comparse to local pkl.
     Raises a PklError if it fails
+
+    Args:
+        bucket (str or Bucket):
+        path (str): Path within the bucket of the pickle
+        data (Object): the object the pickle is expected to hold
+        checksum (bool): If True data is pickled locally, as save_pickle_to_s3 would with the same protocol and
+            compression, and the checksum of that pickle compared to the etag of the key, see aws_utils.s3.verify.
+            Nothing is downloaded or unpickled if they match. Pickles aren't always the same from one process to
+            the next (e.g. the order of sets depends on the hash seed), so if they don't the pickle is still
+            downloaded and compared unpickled
+        protocol (int): pickle protocol the key was saved with, if checksum
+        compression (str): compression the key was saved with, if checksum
     """
     bucket = get_bucket(bucket)
 
+    if checksum:
+        result = verify_key(bucket, path, _pickle_writer(data, protocol, compression), stream_fallback=False)
+        if result.ok:
+            return
+        if result.method == MISSING:
+            raise PklError('{} does not exist'.format(path))
+        logger.debug('Checksum of %s does not match, comparing it unpickled', path)
+
     pkl = get_from_s3(bucket, path)
 
-    if pickle.loads(pkl) != data:
+    if serialization.loads(pkl) != data:
         raise PklError
 
 
-def file_is_empty(bucket, path):
-    """
+def verify_s3_pkls(bucket, objects, protocol=serialization.DEFAULT_PROTOCOL, compression=None,
+                   num_workers=HEAD_NUM_WORKERS):
+    """Verifies many pickles concurrently by checksum, see verify_s3_pkl
 
-    Args:
-        bucket:
-        path:
-
-    Returns:
+    The pickles whose checksum doesn't match are downloaded and compared unpickled.
 
+    Args:
+        bucket (str or Bucket):
+        objects (dict): path within the bucket -> the object its pickle is expected to hold
+        protocol (int): pickle protocol the keys were saved with
+        compression (str): compression the keys were saved with
+        num_workers (int): number of pickles verified at the same time
+    Raises:
+        PklError: listing the paths which don't hold the expected pickle
     """
     bucket = get_bucket(bucket)
+    writes = {path: _pickle_writer(data, protocol, compression) for path, data in objects.items()}
+    results = verify_keys(bucket, writes, stream_fallback=False, num_workers=num_workers)
+    failed = [path for path, result in results.items() if result.method == MISSING]
+    mismatched = [path for path, result in results.items() if not result.ok and result.method != MISSING]
 
-    key = bucket.lookup(path)
-    if key.size == 0:
-        return True
-    else:
-        return False
+    def differs(path):
+        return path, serialization.loads(get_from_s3(bucket, path)) != objects[path]
 
+    failed.extend(path for path, different in bounded_map(differs, mismatched, num_workers=num_workers) if different)
+    if failed:
+        raise PklError('{} pickles do not hold the expected object: {}'.format(len(failed), ', '.join(sorted(failed))))
+
+
+def _pickle_writer(data, protocol, compression):
+    return lambda f: serialization.dump(data, f, protocol=protocol, compression=compression)
 
-def setup_boto():
-    try:
-        boto.config.add_section("Boto")
-    except DuplicateSectionError:
-        pass
-    boto.config.set("Boto", "metadata_service_num_attempts", "20")
+
+def file_is_empty(bucket, path):
+    """Checks if a file is empty. Raises an IOError if the file is not found
+
+    Args:
+        bucket (str or Bucket):
+        path (str):
+
+    Returns:
+        bool
+    """
+    return _existing_file_metadata(get_bucket(bucket), path).size == 0
 
 
-def setup_bucket(bucket_name):
+def setup_bucket(bucket_name, reuse=False):
     """Setup bucket
 
     Args:
         bucket_name (str): name of the bucket we want to load
+        reuse (bool): If True the connection and the validated bucket are shared with other callers in this
+            process (see aws_utils.s3.connections), otherwise a fresh connection is opened.
 
     Returns:
         Bucket
     """
+    if reuse:
+        return get_pooled_bucket(bucket_name)
+
     setup_boto()
-    s3_conn = boto.connect_s3(host='s3.amazonaws.com', calling_format=OrdinaryCallingFormat())
+    s3_conn = boto.connect_s3(host=S3_HOST, calling_format=OrdinaryCallingFormat())
     bucket = s3_conn.get_bucket(bucket_name)
     return bucket
 
@@ -198,7 +344,7 @@ def get_bucket(bucket):
     if isinstance(bucket, Bucket):
         return bucket
     if isinstance(bucket, str):
-        return setup_bucket(bucket)
+        return setup_bucket(bucket, reuse=True)
     else:
         raise TypeError("Expected bucket to be Bucket or str was %s " % type(bucket))
 
@@ -216,22 +362,31 @@ def _iterate_days(from_date, to_date):
     return rrule.rrule(rrule.DAILY, dtstart=from_date, until=to_date)
 
 
-# FIXME: this is a bit too lax, and will regularly return $folder$
-# and _SUCCESS files which we do not want, refactor to use key.size
-# to filter these out
-def retrieve_segments_list(bucket, segment_type_path):
-    keys = bucket.list(segment_type_path)
-    folders = []
-    for key in keys:
-        raw_key = key.name.split(segment_type_path, 1)[1]
-        if raw_key.split("/")[0] != "":
-            folders.append(raw_key.split("/")[0])
-    return set(folders)
+def retrieve_segments_list(bucket, segment_type_path, index=None):
+    """Returns the names of the files and folders directly under a prefix, without hadoop markers
+
+    Only the immediate children are listed (see aws_utils.s3.listing), however many keys the folders contain.
+    _SUCCESS and *$folder$ markers are left out by name, whatever their size (Spark can write metrics into _SUCCESS).
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        segment_type_path (str): e.g production/output/segments/bluekai_segments/
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the children from
+
+    Returns:
+        set of str: e.g {'part-00000', 'part-00001'}
+    """
+    return {name for name, key in iter_directory(bucket, segment_type_path, index=index)
+            if not _is_hadoop_marker(name)}
+
+
+def _is_hadoop_marker(name):
+    return name == '_SUCCESS' or name.endswith('$folder$')
 
 
 def get_md5(bucket, path):
     """ Returns the md5 of a key using boto bucket and path """
-    return bucket.get_key(path).etag[1:-1]
+    return _existing_file_metadata(bucket, path).etag[1:-1]
 
 
 def get_segment_filepaths(segment_dest_dir, s3_bucket_conn,
@@ -242,23 +397,20 @@ def get_segment_filepaths(segment_dest_dir, s3_bucket_conn,
     """
     segment_dir = (segment_dest_dir
                    .split('s3n://{}/'.format(output_bucket))[-1])
-    segment_dir_contents = list(retrieve_segments_list(
-        s3_bucket_conn, segment_dir))
-
-    # Remove 0 byte non-segment files
-    segment_filenames = [fp for fp
-                         in segment_dir_contents
-                         if not ((fp.endswith('$folder$')) or (fp == '_SUCCESS'))]
-
     return ['{}{}'.format(segment_dir, filename)
             for filename
-            in segment_filenames]
+            in retrieve_segments_list(s3_bucket_conn, segment_dir)]
 
 
 def merge_part_files(input_bucket, input_prefix,
                      output_bucket, output_key, list_key=None,
-                     sort_key=None):
-    """
+                     sort_key=None, num_workers=DEFAULT_NUM_WORKERS):
+    """Concatenates all the keys under a prefix into a single key
+
+    The parts of the merged key are planned with aws_utils.s3.merge.plan_merge: keys big enough to be a part on
+    their own are copied server side when that is estimated to be faster than downloading them, the others are
+    downloaded and grouped together. Parts are fetched, assembled and uploaded concurrently but always end up in key
+    order.
 
     Args:
         input_bucket: a boto bucket object
@@ -266,41 +418,50 @@ def merge_part_files(input_bucket, input_prefix,
                          merge
         output_bucket: a boto bucket object
         output_key: the key to store the merged file
-        sort_key: function to sort the keys with
+        list_key: function selecting the keys to merge, called with a boto.s3.key.Key holding what a listing sets
+                     (name/key, size, etag and last_modified). Defaults to the .gz keys, which are selected by name
+                     before any Key is built
+        sort_key: function to sort the keys with, also called with Keys
                      If for example you want have header as first file sort_fn would be
                      lambda x: 'header' in x.key
+        num_workers: number of parts assembled and uploaded at the same time
     """
+    records = iter_key_records(input_bucket, input_prefix)
     if list_key is None:
-        list_key = lambda k: k.key.endswith('.gz')
-
-    key_list = [k for k in input_bucket.list(input_prefix) if list_key(k)]
+        key_list = [_to_key(input_bucket, record) for record in records if record.name.endswith('.gz')]
+    else:
+        key_list = [key for key in (_to_key(input_bucket, record) for record in records) if list_key(key)]
     if sort_key is not None:
         key_list = sorted(key_list, key=sort_key, reverse=True)
 
-    out_path = 's3://{}/{}'.format(output_bucket.name, output_key)
-    chunk = StringIO()
-
-    def _inc(out, size):
-        out.total_size += size
-        out.parts += 1
-
-    with smart_open.smart_open(out_path, mode='wb', min_part_size=CHUNK_SIZE) as out:
-        for parts in partition_list(key_list, threshold=CHUNK_SIZE):
-            if isinstance(parts, list):
-                # In this case it means that more parts were grouped
-                # together because to reach the desired minumum size
-                chunk = StringIO()
-                for part in parts:
-                    chunk.write(part.get_contents_as_string())
-                    _inc(out, part.size)
-
-                chunk.seek(0)
-                out.mp.upload_part_from_file(chunk, out.parts)
+    plan = plan_merge(key_list)
+    logger.debug("Merging %s into %s: %s", input_prefix, output_key, plan.explain())
+
+    def _fill_part(segments):
+        def fill(view):
+            offsets = []
+            offset = 0
+            for segment in segments:
+                offsets.append((segment, offset))
+                offset += segment.size
+
+            def fetch(segment_offset):
+                segment, start = segment_offset
+                read_key_into(input_bucket, segment.key.name, view[start:start + segment.size],
+                              start=None if segment.is_whole_key else segment.start)
+
+            for _ in bounded_map(fetch, offsets, num_workers=MERGE_FETCH_WORKERS):
+                pass
+        return fill
+
+    with MultipartUpload(output_bucket, output_key, num_workers=num_workers) as upload:
+        for part in plan:
+            if part.kind == COPY:
+                segment = part.segments[0]
+                start, end = (None, None) if segment.is_whole_key else (segment.start, segment.end)
+                upload.add_copy_part(input_bucket.name, segment.key.name, part.size, start=start, end=end)
             else:
-                # in this case the part is big enough to be uploaded
-                # straight away
-                _inc(out, parts.size)
-                out.mp.copy_part_from_key(input_bucket.name, parts.key, out.parts)
+                upload.add_filled_part(_fill_part(part.segments), part.size)
 
 
 def partition_list(lis, threshold):
@@ -309,6 +470,9 @@ def partition_list(lis, threshold):
     cluster is always bigger than the given threshold.
 
     If a small element ends up last it should go by itself
+
+    Note: merge_part_files now uses aws_utils.s3.merge.plan_merge, which also
+    enforces S3's part size and part count limits.
     """
     chunk, partial = [], 0
     idx = 0
@@ -333,33 +497,77 @@ def is_pickle_load_exception(exception):
 @retry(retry_on_exception=is_pickle_load_exception,
        stop_max_attempt_number=3,
        wait_fixed=10000)
-def load_pickle_from_s3(bucket, path):
+def load_pickle_from_s3(bucket, path, cache=None, object_cache=None):
     """Loads pickle files from S3, retries on the provided exception.
 
     We retry on EOF and Value errors as these occasionally occur in production
     and disappear upon re-run, leading us to believe they are S3 related
+
+    The pickle is unpickled as its byte ranges arrive, and decompressed on the fly if it was saved compressed, see
+    aws_utils.s3.serialization.
+
+    Args:
+        bucket (str or Bucket):
+        path (str): Path within the bucket of the pickle
+        cache (aws_utils.s3.disk_cache.DiskCache): optional cache to read the pickle through, see get_from_s3
+        object_cache (aws_utils.s3.object_cache.ObjectCache): if set the unpickled object is cached, and only loaded
+            again once the pickle changed
     """
-    pkl = get_from_s3(bucket, path)
-    try:
-        return pickle.loads(pkl, encoding='utf-8')  # python3
-    except TypeError:
-        return pickle.loads(pkl)  # python2
+    if object_cache is not None:
+        return object_cache.get(get_bucket(bucket), path, lambda b, p: _load_pickle(b, p, cache))
+    return _load_pickle(bucket, path, cache)
 
-def save_pickle_to_s3(bucket, path, data):
+
+def _load_pickle(bucket, path, cache):
+    if cache is not None:
+        return serialization.loads(get_from_s3(bucket, path, cache=cache))
+    return serialization.load_from_s3(get_bucket(bucket), path)
+
+
+def save_pickle_to_s3(bucket, path, data, protocol=serialization.DEFAULT_PROTOCOL, compression=None):
     """saves a python object as a pickle in s3
 
+    The object is uploaded while it is being pickled, see aws_utils.s3.serialization.
+
     Args:
         bucket (str or Bucket): Bucket to add the file to, if a string is provided, we try and open an amazon bucket with that name.
         path (str): Path within the bucket to save the file to, should not contain the bucket name
         data (Object): any python serializable object or value
+        protocol (int): pickle protocol, e.g. serialization.HIGHEST_PROTOCOL. From protocol 5 large buffers (e.g.
+            numpy arrays) are stored out-of-band
+        compression (str): serialization.GZIP, ZSTD or LZ4 to compress the pickle, load_pickle_from_s3 detects it
     """
-    pickled_data = pickle.dumps(data)
-    save_to_s3(bucket, path, pickled_data)
+    serialization.dump_to_s3(get_bucket(bucket), path, data, protocol=protocol, compression=compression)
 
 
-def load_jsonfile_from_s3(bucket, path, **kwargs):
-    file_contents = get_from_s3(bucket, path, **kwargs).decode('utf-8')
-    return [json.loads(item) for item in file_contents.splitlines()]
+def load_jsonfile_from_s3(bucket, path, stream=False, object_cache=None, **kwargs):
+    """Loads a JSON lines file from S3
+
+    Args:
+        bucket (str or Bucket):
+        path (str): Path within the bucket of the file
+        stream (bool): If True returns a generator streaming the records from S3, so the file is never held in
+            memory as a whole.
+        object_cache (aws_utils.s3.object_cache.ObjectCache): if set the list of records is cached, and only loaded
+            again once the file changed (ignored when streaming)
+        kwargs: passed to get_from_s3, e.g. compressed=True or cache=DiskCache(...) (ignored when streaming)
+
+    Returns:
+        list or generator of the JSON records
+    """
+    if stream:
+        kwargs.pop('cache', None)
+        return iter_json_from_s3(get_bucket(bucket), path, **kwargs)
+
+    if object_cache is not None:
+        # of the options of get_from_s3 only the decompression changes the records, not the disk cache
+        return object_cache.get(get_bucket(bucket), path, lambda b, p: _parse_json_lines(get_from_s3(b, p, **kwargs)),
+                                variant=bool(kwargs.get('compressed')))
+    return _parse_json_lines(get_from_s3(bucket, path, **kwargs))
+
+
+def _parse_json_lines(data):
+    return [json.loads(item) for item in data.decode('utf-8').splitlines()]
 
 
 def save_jsonfile_to_s3(bucket, path, items, **kwargs):
@@ -384,8 +592,7 @@ def path_exists(bucket, path):
         path (str): Path within the bucket to save the file to, should not contain the bucket name
         bucket (str or Bucket): Bucket to add the file to, if a string is provided, we try and open an amazon bucket with that name.
     """
-    bucket = get_bucket(bucket)
-    return bool(bucket.get_key(path, validate=True))
+    return head_key(get_bucket(bucket), path).exists
 
 
 def file_size(bucket, file_path):
@@ -398,14 +605,30 @@ def file_size(bucket, file_path):
     Returns:
         int: file size in bytes
     """
-    key = bucket.get_key(file_path)
-    if not key:
-        raise IOError('file %s does not exist in bucket %s' % (file_path, bucket))
+    return _existing_file_metadata(bucket, file_path).size
 
-    return key.size
 
+def _iter_records(bucket, prefix, index=None):
+    """Lists the keys under a prefix, reading them from a listing index if one is given
 
-def path_contains_data(bucket, root_path, min_file_size=0, file_extension=None):
+    Returns:
+        iterable of aws_utils.s3.listing.KeyRecord
+    """
+    if index is None:
+        return iter_key_records(bucket, prefix)
+    return index.iter_keys(bucket.name, prefix)
+
+
+def _to_key(bucket, record):
+    """Returns the boto.s3.key.Key of a listing.KeyRecord or of a listing_index.IndexedKey, as a listing would"""
+    key = Key(bucket, record.name)
+    key.size = record.size
+    key.etag = record.etag
+    key.last_modified = record.last_modified
+    return key
+
+
+def path_contains_data(bucket, root_path, min_file_size=0, file_extension=None, index=None):
     """Checks if there are any files under this path that contain files of size greater than 0
 
     Args:
@@ -415,35 +638,57 @@ def path_contains_data(bucket, root_path, min_file_size=0, file_extension=None):
             are .gz files with in the path.
         min_file_size (int): sometimes we may have empty gz files so set a minimum file size for returning True.
             Files of exactly this size will be excluded.
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the keys from
     Returns:
         bool
     """
-    for key in bucket.list(root_path):
-        if file_extension and not key.name.endswith(file_extension):
-            continue
-        if key.size > min_file_size:
-            return True
+    def has_data(key):
+        return (not file_extension or key.name.endswith(file_extension)) and key.size > min_file_size
+
+    if index is not None:
+        return any(has_data(record) for record in _iter_records(bucket, root_path, index=index))
+    # stops listing at the first file with data, see aws_utils.s3.probe
+    return find_first_key(bucket, root_path, has_data) is not None
 
-    return False
 
+def paths_contain_data(bucket, root_paths, min_file_size=0, file_extension=None, num_workers=PROBE_NUM_WORKERS,
+                       index=None):
+    """Checks concurrently which of the given paths contain data, see path_contains_data
+
+    Args:
+        bucket (boto.s3.bucket.Bucket): bucket within which to check.
+        root_paths (list of str): paths relative to the bucket, e.g. the date partitions a job needs
+        min_file_size (int): see path_contains_data
+        file_extension (str): see path_contains_data
+        num_workers (int): number of paths checked at the same time
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the keys from
+    Returns:
+        dict: {root path: bool}
+    """
+    root_paths = list(root_paths)
 
-def _delete_1000_s3_files(bucket, directory):
-    conn = boto3.resource('s3')
-    objects_to_delete = conn.meta.client.list_objects(Bucket=bucket, Prefix=directory)
-    delete_keys = {'Objects': [{'Key': k} for k in [obj['Key'] for obj in objects_to_delete.get('Contents', [])]]}
+    def check(root_path):
+        return path_contains_data(bucket, root_path, min_file_size=min_file_size, file_extension=file_extension,
+                                  index=index)
 
-    if delete_keys['Objects']:
-        conn.meta.client.delete_objects(Bucket=bucket, Delete=delete_keys)
-        return True
-    return False
+    return dict(zip(root_paths, bounded_map(check, root_paths, num_workers=num_workers)))
 
 
-def delete_contents_of_s3_directory(directory, bucket_name=None):
+def delete_contents_of_s3_directory(directory, bucket_name=None, dry_run=False, num_workers=DELETE_NUM_WORKERS):
     """Be very careful, this method will delete everything under a given path, use with caution
 
+    The directory is listed once, page by page, and each page is deleted with a multi-object delete request by a
+    pool of workers while the listing goes on.
+
     Args:
         directory (str): If bucket is not set then this path must contain the bucket directory, otherwise the bucket can be
         bucket_name (str): If set this is the bucket we delete from and the directory is the path within that
+        dry_run (bool): If True the keys are only listed, nothing is deleted
+        num_workers (int): number of delete requests in flight at the same time
+
+    Returns:
+        dict: {'listed': number of keys found, 'deleted': number of keys deleted,
+               'errors': list of {'Key': ..., 'Code': ..., 'Message': ...} for the keys which could not be deleted}
     """
     if bucket_name is None:
         bucket_name, directory = get_bucket_and_path_from_uri(directory)
@@ -451,21 +696,40 @@ def delete_contents_of_s3_directory(directory, bucket_name=None):
     if isinstance(bucket_name, Bucket):
         bucket_name = bucket_name.name
 
-    logger.info("deleting contents of s3 bucket %s directory %s", bucket_name, directory)
+    logger.info("deleting contents of s3 bucket %s directory %s%s", bucket_name, directory, " (dry run)" if dry_run else "")
 
     assert len(directory) > 10, "just in case don't want to delete the root of the bucket..."
 
-    # Deleting keys from s3 appears to max out at 1000 entries so we need to do this multiple times until the directory is clear.
-    while _delete_1000_s3_files(bucket_name, directory):
-        pass
+    client = get_client()
+    pages = client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=directory,
+                                                             PaginationConfig={'PageSize': DELETE_BATCH_SIZE})
+    batches = ([obj['Key'] for obj in page.get('Contents', [])] for page in pages)
+
+    def delete_batch(keys):
+        if dry_run:
+            return keys, []
+        return keys, delete_keys(client, bucket_name, keys)
+
+    stats = {'listed': 0, 'deleted': 0, 'errors': []}
+    for keys, errors in bounded_map(delete_batch, (keys for keys in batches if keys), num_workers=num_workers):
+        stats['listed'] += len(keys)
+        stats['errors'].extend(errors)
+        if not dry_run:
+            stats['deleted'] += len(keys) - len(errors)
 
+    for error in stats['errors']:
+        logger.error("Unable to delete %s: %s %s", error.get('Key'), error.get('Code'), error.get('Message'))
+    logger.info("listed %d keys, deleted %d", stats['listed'], stats['deleted'])
+    return stats
 
-def get_contents_of_directory(directory, bucket=None):
+
+def get_contents_of_directory(directory, bucket=None, index=None):
     """List all the files in a given s3 directory
 
     Args:
         directory (str): If bucket is not set then this path must contain the bucket directory, otherwise the bucket can be
         bucket (str or Bucket): If set this is the bucket we delete from and the directory is the path within that
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the keys from
 
     Returns:
         list of str - the names of all the files
@@ -474,7 +738,7 @@ def get_contents_of_directory(directory, bucket=None):
         bucket, directory = get_bucket_and_path_from_uri(directory)
     bucket = get_bucket(bucket)
 
-    return [x.key for x in bucket.list(prefix=directory)]
+    return [record.name for record in _iter_records(bucket, directory, index=index)]
 
 
 def rename_s3_key(boto3_client, bucket_name, old_prefix, new_prefix):
@@ -489,20 +753,24 @@ def rename_s3_key(boto3_client, bucket_name, old_prefix, new_prefix):
     if old_prefix != new_prefix:
         if not bucket_name:
             raise ValueError('The bucket cannot be an empty value')
-        boto3_client.copy_object(CopySource={'Bucket': bucket_name, 'Key': old_prefix}, Bucket=bucket_name, Key=new_prefix)
+        copy_key(boto3_client, bucket_name, old_prefix, bucket_name, new_prefix)
         boto3_client.delete_object(Bucket=bucket_name, Key=old_prefix)
         logger.info('Moved key {}'.format(old_prefix))
     else:
         logger.warn('Source and destination paths are the same')
 
-def get_pickle_from_s3(path):
+def get_pickle_from_s3(path, cache=None, object_cache=None):
     """ Loads an object from s3 and depickles, uses full path
     Args:
         path (str):
+        cache (aws_utils.s3.disk_cache.DiskCache): optional cache to read the pickle through, see get_from_s3
+        object_cache (aws_utils.s3.object_cache.ObjectCache): optional cache of the depickled object, see
+            load_pickle_from_s3
     Returns:
         object: depickled s3 object
     """
-    return load_pickle_from_s3(*load_bucket_and_path(path))
+    bucket, path = load_bucket_and_path(path)
+    return load_pickle_from_s3(bucket, path, cache=cache, object_cache=object_cache)
 
 def load_bucket_and_path(path):
     """
@@ -514,20 +782,26 @@ def load_bucket_and_path(path):
         tuple(boto.Object, string): Bucket and path to object in bucket
     """
     bucket_name, path = get_bucket_and_path_from_uri(path)
-    bucket = setup_bucket(bucket_name)
+    bucket = setup_bucket(bucket_name, reuse=True)
     return bucket, path
 
 
 def rename_keys_on_s3(bucket_name, bucket_region, prefix_root, prefix_modification_func,
-                      filter_keys_func=None):
+                      filter_keys_func=None, num_workers=DEFAULT_NUM_WORKERS, progress_file=None):
     """
     Renames all keys in a prefix_root/folder/ which are not filtered by a filter function
+
+    Keys are copied server side by a pool of workers (with a multipart copy for objects over 5GB) while the listing
+    goes on, and the source keys are then deleted in batches.
     Args:
         bucket_name (str): An existing s3 bucket
         bucket_region (str): A valid s3 region e.g 'us-east-1'
         prefix_root (str): The prefix to start the recursive renaming with
         prefix_modification_func (function): A function that changes the prefix string. In case it is None, nothing will be moved
         filter_keys_func (function): A function that will apply a filter to the keys we don't want to move. In case it is None, nothing will be moved
+        num_workers (int): number of keys copied at the same time
+        progress_file (str): optional local file recording every key copied so far. If a rename is interrupted,
+            calling it again with the same file finishes it without renaming the new keys a second time.
     Example:
         Before: [ 's3://bucket/partner_name/', 's3://bucket/partner_name/file_1.gz', 's3://bucket/partner_name/file_2.txt']
         rename_keys_on_s3('bucket', 'us-east-1', 'production/partner_name/', prefix_modification_func=lambda x: x.upper(), filter_keys_func=lambda x: x.endswith('.txt'))
@@ -536,53 +810,141 @@ def rename_keys_on_s3(bucket_name, bucket_region, prefix_root, prefix_modificati
     if prefix_modification_func is None:
         raise Exception('There should be a modification function specified')
 
-    boto3_client = boto3.client('s3', bucket_region)
-
-    paginator = boto3_client.get_paginator('list_objects')
-    pageresponse = paginator.paginate(Bucket=bucket_name, Prefix=prefix_root)
-    for page_of_keys in pageresponse:
-        for current_key in page_of_keys['Contents']:
-            current_prefix = current_key['Key']
-            if filter_keys_func is None or filter_keys_func(current_prefix):
-                logger.info('Skipped prefix {}'.format(current_prefix))
+    boto3_client = get_client(bucket_region)
+    copied = _load_rename_progress(progress_file)
+    # keys created by this rename, which must not be renamed again if the listing comes across them
+    destinations = set(copied.values())
+
+    def keys_to_rename():
+        # runs in the calling thread: destinations is only ever read and updated here, and a destination is added
+        # before its copy is submitted, so the listing can't come across the copy first
+        paginator = boto3_client.get_paginator('list_objects')
+        for page_of_keys in paginator.paginate(Bucket=bucket_name, Prefix=prefix_root):
+            for current_key in page_of_keys.get('Contents', []):
+                current_prefix = current_key['Key']
+                if current_prefix in destinations:
+                    continue
+                if filter_keys_func is None or filter_keys_func(current_prefix):
+                    logger.info('Skipped prefix {}'.format(current_prefix))
+                    continue
+                if current_prefix in copied:
+                    yield current_prefix, current_key['Size'], copied[current_prefix]
+                    continue
+                try:
+                    new_prefix_name = prefix_modification_func(current_prefix)
+                except AttributeError as e:
+                    logger.error('Unable to rename key prefix {}, {}'.format(current_prefix, e))
+                    continue
+                if new_prefix_name == current_prefix:
+                    logger.warn('Source and destination paths are the same')
+                    continue
+                destinations.add(new_prefix_name)
+                yield current_prefix, current_key['Size'], new_prefix_name
+
+    def copy(rename):
+        current_prefix, size, new_prefix_name = rename
+        if current_prefix in copied:
+            return current_prefix, new_prefix_name, None
+        try:
+            copy_key(boto3_client, bucket_name, current_prefix, bucket_name, new_prefix_name, size=size)
+            return current_prefix, new_prefix_name, None
+        except ClientError as e:
+            return current_prefix, None, e
+
+    progress = open(progress_file, 'a') if progress_file else None
+    to_delete = []
+    try:
+        for current_prefix, new_prefix_name, error in bounded_map(copy, keys_to_rename(), num_workers=num_workers,
+                                                                  ordered=False):
+            if error is not None:
+                logger.error('Unable to rename key prefix {}, {}'.format(current_prefix, error))
                 continue
-            try:
-                new_prefix_name = prefix_modification_func(current_prefix)
-                rename_s3_key(boto3_client, bucket_name, current_prefix, new_prefix_name)
-            except (ClientError, AttributeError) as e:
-                logger.error('Unable to rename key prefix {}, {}'.format(current_prefix, e[0]))
+            if progress is not None and current_prefix not in copied:
+                progress.write(json.dumps([current_prefix, new_prefix_name]) + '\n')
+                progress.flush()
+
+            to_delete.append(current_prefix)
+            if len(to_delete) == DELETE_BATCH_SIZE:
+                _delete_renamed_keys(boto3_client, bucket_name, to_delete)
+                to_delete = []
+    finally:
+        if to_delete:
+            _delete_renamed_keys(boto3_client, bucket_name, to_delete)
+        if progress is not None:
+            progress.close()
+
+
+def _load_rename_progress(progress_file):
+    """Returns the {old key: new key} copies recorded by rename_keys_on_s3 in a progress file"""
+    copied = {}
+    if progress_file and os.path.exists(progress_file):
+        with open(progress_file) as f:
+            for line in f:
+                if line.strip():
+                    old_key, new_key = json.loads(line)
+                    copied[old_key] = new_key
+    return copied
+
+
+def _delete_renamed_keys(boto3_client, bucket_name, keys):
+    errors = {error['Key']: error for error in delete_keys(boto3_client, bucket_name, keys)}
+    for key in keys:
+        if key in errors:
+            logger.error('Unable to delete renamed key {}, {}'.format(key, errors[key].get('Message')))
+        else:
+            logger.info('Moved key {}'.format(key))
+
 
-def fetch_s3_keys_by_regex_pattern(s3_bucket, s3_directory, pattern):
-    """Fetches the s3 keys of all files within the supplied directory using a regex
+def fetch_s3_keys_by_regex_pattern(s3_bucket, s3_directory, pattern, index=None):
+    r"""Fetches the s3 keys of all files within the supplied directory using a regex
 
     Args:
         s3_bucket (boto.s3.bucket.Bucket):
         s3_directory (str): 'production/output/'
-        pattern (re.RegexObject): compiled regex pattern, e.g re.compile('.*\d+$')
+        pattern (re.RegexObject): compiled regex pattern, e.g re.compile(r'.*\d+$')
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the keys from
     Returns: ([boto.s3.key.Key, boto.s3.key.Key...]):
     """
-    bucket_contents = s3_bucket.list(s3_directory)
-    return [key for key in bucket_contents if pattern.search(key.name)]
+    if index is None:
+        return list(iter_s3_keys_by_regex_pattern(s3_bucket, s3_directory, pattern))
+    return [_to_key(s3_bucket, record) for record in _iter_records(s3_bucket, s3_directory, index=index)
+            if pattern.search(record.name)]
+
+
+def iter_s3_keys_by_regex_pattern(s3_bucket, s3_directory, pattern):
+    r"""Lazily yields the s3 keys of all files within the supplied directory matching a regex
+
+    Key names are matched as they are listed and Key objects are only built for the matching ones. When the pattern
+    is anchored at the start of the key name, only the keys starting with its literal prefix are listed, see
+    aws_utils.s3.regex_listing
+
+    Args:
+        s3_bucket (boto.s3.bucket.Bucket):
+        s3_directory (str): 'production/output/'
+        pattern (re.RegexObject): compiled regex pattern, e.g re.compile(r'^production/output/part-\d+$')
+    Returns: (generator of boto.s3.key.Key):
+    """
+    return iter_matching_keys(s3_bucket, s3_directory, pattern)
 
 
-def fetch_s3_filepaths_to_local(keys, local_save_directory):
+def fetch_s3_filepaths_to_local(keys, local_save_directory, num_workers=DEFAULT_NUM_WORKERS):
     """Saves a list of S3 keys to the supplied local directory, returns a list containing the local paths
 
+    Keys are downloaded concurrently, and large keys are themselves split in concurrent byte ranges.
+
     Args:
         keys ([boto.s3.key.Key, boto.s3.key.Key...]):
         local_save_directory (str): '/usr/local/'
+        num_workers (int): number of keys downloaded at the same time
     Returns: ([str, str...]): ['/usr/local/part-000.gz', '/usr/local/part/part-001.gz']
     """
-    local_paths = []
-    for key in keys:
+    def fetch(key):
         local_path = '{}{}'.format(local_save_directory, get_s3_filename(key.name))
+        download_to_file(key.bucket, key.name, local_path)
+        logger.info('%s saved to %s', key.name, local_path)
+        return local_path
 
-        with open(local_path, 'wb') as f:
-            key.get_contents_to_file(f)
-            logger.info('%s saved to %s', key.name, local_path)
-            local_paths.append(local_path)
-
-    return local_paths
+    return list(bounded_map(fetch, keys, num_workers=num_workers))
 
 
 def get_s3_filename(s3_path):
@@ -607,39 +969,74 @@ def is_s3_exception(exception):
     return isinstance(exception, (AWSConnectionError, S3ResponseError))
 
   
-def upload_file(bucket, local_file_path, remote_destination_path):
+def upload_file(bucket, local_file_path, remote_destination_path, multipart_threshold=MULTIPART_THRESHOLD):
     """Upload a file to a S3 location.
 
     Args:
         bucket (boto.s3.bucket.Bucket or str):
         local_file_path (str): '/usr/local/file.txt'
         remote_destination_path (str): production/output/file.txt
+        multipart_threshold (int): files bigger than this many bytes are sent as a parallel multipart upload.
     """
     bucket = get_bucket(bucket)
+    if os.path.getsize(local_file_path) > multipart_threshold:
+        upload_file_multipart(bucket, local_file_path, remote_destination_path)
+        return
+
     k = Key(bucket)
     k.key = remote_destination_path
     k.set_contents_from_filename(local_file_path)
 
 
-def get_latest_year_month_day_prefix(s3_path):
+def sync_directory(source, destination, delete=False, num_workers=DEFAULT_NUM_WORKERS, progress=None):
+    """Mirrors a directory, only transferring the files which are missing or changed, see aws_utils.s3.sync
+
+    Args:
+        source (str): e.g. 's3n://bucket/models/latest/' or '/var/lib/models/'
+        destination (str): e.g. '/var/lib/models/' or 's3n://other-bucket/models/backup/'
+        delete (bool): delete the files of the destination which are not in the source
+        num_workers (int): number of files transferred at the same time
+        progress (function): called with each aws_utils.s3.sync.SyncAction once it is done
+
+    Returns (aws_utils.s3.sync.SyncResult): number of files copied, deleted and already in sync, and bytes copied
+    """
+    kwargs = dict(delete=delete, num_workers=num_workers, progress=progress)
+    if _is_s3_uri(source) and _is_s3_uri(destination):
+        src_bucket, src_prefix = get_bucket_and_path_from_uri(source)
+        dst_bucket, dst_prefix = get_bucket_and_path_from_uri(destination)
+        return sync_s3_to_s3(get_bucket(src_bucket), src_prefix, get_bucket(dst_bucket), dst_prefix, **kwargs)
+    if _is_s3_uri(source):
+        bucket, prefix = get_bucket_and_path_from_uri(source)
+        return sync_s3_to_local(get_bucket(bucket), prefix, destination, **kwargs)
+    if _is_s3_uri(destination):
+        bucket, prefix = get_bucket_and_path_from_uri(destination)
+        return sync_local_to_s3(source, get_bucket(bucket), prefix, **kwargs)
+    raise ValueError('Neither {} nor {} is an S3 uri'.format(source, destination))
+
+
+def _is_s3_uri(path):
+    return urlparse(path).scheme in ('s3', 's3n', 's3a')
+
+
+def get_latest_year_month_day_prefix(s3_path, index=None):
     """Gets the date of the most recent year/month/day prefix in a S3 folder
+
+    Only the partitions folders are listed if the folder holds the year= folders, see aws_utils.s3.partitions.
+    Otherwise they can be deeper below it (e.g. s3_path is the parent of several partitioned outputs), and every key
+    under the folder is listed to find them.
     Args:
         s3_path (str): e.g s3n://audience-data-store-qa/artem/
+        index (aws_utils.s3.listing_index.ListingIndex): optional index to read the partitions from
 
     Returns (Date): e.g datetime.date(2017, 5, 30)
 
     """
-    latest = date.min
-    keys = get_contents_of_directory(s3_path)
-
-    for key in keys:
-        search = re.search(r'.*year=(\d{4}).*month=(\d{2}).*day=(\d{2})', key)
-        if search:
-            year, month, day = search.groups()
-            bucket_date = date(int(year), int(month), int(day))
-            if bucket_date > latest:
-                latest = bucket_date
-
-    if latest == date.min:
-        return None
-    return latest
+    bucket_name, path = get_bucket_and_path_from_uri(s3_path)
+    bucket = get_bucket(bucket_name)
+    latest = next(iter_partitions(bucket, path, reverse=True, index=index), None)
+    if latest is not None or has_partitions(bucket, path, index=index):
+        return latest
+
+    logger.debug("no year= folder directly under %s, looking for partitions in every key", s3_path)
+    dates = list(find_nested_partitions(record.name for record in _iter_records(bucket, path, index=index)))
+    return max(dates) if dates else None
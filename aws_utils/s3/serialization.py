@@ -0,0 +1,345 @@
+"""Pickles saved to and loaded from S3 as streams, optionally compressed.
+
+A saved object is written straight to a multipart upload as it is pickled,
+through a gzip, zstd or lz4 compressor if asked to, and loading it unpickles
+the object as its byte ranges arrive. The compression is told from the first
+bytes of the object, so plain pickles saved by earlier versions load as well.
+
+With pickle protocol 5 (python 3.8 onwards) the large buffers of an object,
+e.g. the data of numpy arrays, are written out-of-band: after the pickle
+rather than copied into it, and they are loaded back into buffers of their
+own, without going through the unpickler. Such pickles are stored in a small
+container:
+
+    OOB_MAGIC, pickle length (8 bytes), pickle, number of buffers (4 bytes),
+    then each buffer as its length (8 bytes) followed by its content
+
+zstd and lz4 compression need the zstandard and lz4 packages.
+
+Example:
+    dump_to_s3(bucket, 'models/latest/model.pkl', model, protocol=5, compression=ZSTD)
+    model = load_from_s3(bucket, 'models/latest/model.pkl')
+"""
+import logging
+import struct
+import sys
+import zlib
+
+from aws_utils.s3.concurrency import DEFAULT_NUM_WORKERS
+from aws_utils.s3.streaming import GZIP_WBITS, S3Writer, gunzip_chunks
+from aws_utils.s3.transfer import DEFAULT_PART_SIZE, iter_ranges
+
+# python version backwards compatibility
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# optional compression libraries
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+logger = logging.getLogger(__name__)
+GZIP = 'gzip'
+ZSTD = 'zstd'
+LZ4 = 'lz4'
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+# no pickle starts with a null byte
+OOB_MAGIC = b'\x00OOBPKL\x01'
+MAGIC_SIZE = len(OOB_MAGIC)
+HIGHEST_PROTOCOL = pickle.HIGHEST_PROTOCOL
+# protocol used by pickle.dumps when none is given
+DEFAULT_PROTOCOL = getattr(pickle, 'DEFAULT_PROTOCOL', 0)
+# out-of-band buffers need pickle protocol 5
+OOB_PROTOCOL = 5
+# python 2 pickles hold their str as bytes, which python 3 decodes as utf-8
+LOAD_KWARGS = {'encoding': 'utf-8'} if sys.version_info[0] >= 3 else {}
+
+
+def _require(module, compression, package):
+    if module is None:
+        raise ImportError('{} compression needs the {} package'.format(compression, package))
+    return module
+
+
+class _Lz4Compressor(object):
+    """lz4.frame.LZ4FrameCompressor with the compress and flush methods of zlib compressors"""
+
+    def __init__(self, level):
+        self._compressor = _require(lz4_frame, LZ4, 'lz4').LZ4FrameCompressor(compression_level=level or 0)
+        self._started = False
+
+    def compress(self, data):
+        if not self._started:
+            self._started = True
+            return self._compressor.begin() + self._compressor.compress(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self.compress(b'') + self._compressor.flush()
+
+
+def _compressor(compression, level=None):
+    """Returns an object with the compress and flush methods of zlib compressors"""
+    if compression == GZIP:
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, GZIP_WBITS)
+    if compression == ZSTD:
+        return _require(zstandard, ZSTD, 'zstandard').ZstdCompressor(level=3 if level is None else level).compressobj()
+    if compression == LZ4:
+        return _Lz4Compressor(level)
+    raise ValueError('Unknown compression {}'.format(compression))
+
+
+def _decompress_chunks(chunks, compression):
+    if compression == GZIP:
+        for data in gunzip_chunks(chunks):
+            yield data
+        return
+
+    if compression == ZSTD:
+        decompressor = _require(zstandard, ZSTD, 'zstandard').ZstdDecompressor().decompressobj()
+    else:
+        decompressor = _require(lz4_frame, LZ4, 'lz4').LZ4FrameDecompressor()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if not decompressor.eof:
+        raise EOFError('Compressed file ended before the end of its {} frame'.format(compression))
+
+
+class CompressingWriter(object):
+    """Write-only file-like object compressing what is written to it into another file-like object
+
+    Closing it writes the end of the compressed stream but doesn't close the underlying file.
+    """
+
+    def __init__(self, f, compression, level=None):
+        self._f = f
+        self._compressor = _compressor(compression, level)
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._f.write(compressed)
+
+    def close(self):
+        self._f.write(self._compressor.flush())
+
+
+class ChunkReader(object):
+    """Read-only file-like object over an iterable of bytes chunks, as needed by pickle.load
+
+    Chunks are appended to a single buffer whose consumed start is only dropped once it makes up half of it, so
+    reading costs time linear in the size of the stream however the chunks and the reads are sized.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def _available(self):
+        return len(self._buffer) - self._pos
+
+    def _fill(self):
+        """Reads the next chunk, returns False at the end of the stream"""
+        for chunk in self._chunks:
+            if chunk:
+                if self._pos and 2 * self._pos >= len(self._buffer):
+                    del self._buffer[:self._pos]
+                    self._pos = 0
+                self._buffer += chunk
+                return True
+        return False
+
+    def _take(self, size):
+        data = memoryview(self._buffer)[self._pos:self._pos + size].tobytes()
+        self._pos += len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            return self._take(self._available())
+
+        while self._available() < size and self._fill():
+            pass
+        return self._take(size)
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast('B') if hasattr(memoryview, 'cast') else memoryview(buf)
+        pos = min(len(view), self._available())
+        view[:pos] = memoryview(self._buffer)[self._pos:self._pos + pos]
+        self._pos += pos
+        # the rest is copied straight from the chunks, without going through the buffer
+        while pos < len(view):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            chunk = memoryview(chunk)
+            take = min(len(chunk), len(view) - pos)
+            view[pos:pos + take] = chunk[:take]
+            pos += take
+            if take < len(chunk):
+                self._buffer, self._pos = bytearray(chunk[take:]), 0
+        return pos
+
+    def readline(self):
+        searched = 0
+        while True:
+            end = self._buffer.find(b'\n', self._pos + searched)
+            if end >= 0:
+                return self._take(end + 1 - self._pos)
+            searched = self._available()
+            if not self._fill():
+                return self._take(self._available())
+
+    def iter_rest(self):
+        """Yields what is left of the stream, chunk by chunk"""
+        if self._available():
+            yield self._take(self._available())
+        self._buffer, self._pos = bytearray(), 0
+        for chunk in self._chunks:
+            yield chunk
+
+    def peek(self, size):
+        """Returns the next size bytes (or less at the end of the stream) without consuming them"""
+        while self._available() < size and self._fill():
+            pass
+        return memoryview(self._buffer)[self._pos:self._pos + size].tobytes()
+
+
+def dump(obj, f, protocol=HIGHEST_PROTOCOL, compression=None, level=None):
+    """Pickles an object into a file-like object
+
+    Args:
+        obj: any picklable object
+        f (file-like): written to, not closed
+        protocol (int): pickle protocol, buffers are written out-of-band from protocol 5
+        compression (str): None, GZIP, ZSTD or LZ4
+        level (int): compression level, the default of the compression library if None
+    """
+    out = CompressingWriter(f, compression, level) if compression else f
+    if protocol is not None and protocol >= OOB_PROTOCOL:
+        _dump_out_of_band(obj, out, protocol)
+    else:
+        pickle.dump(obj, out, protocol)
+    if compression:
+        out.close()
+
+
+def _dump_out_of_band(obj, out, protocol):
+    buffers = []
+
+    def buffer_callback(buf):
+        try:
+            buffers.append(buf.raw())
+        except BufferError:
+            # not contiguous, pickled in-band
+            return True
+        return False
+
+    data = pickle.dumps(obj, protocol=protocol, buffer_callback=buffer_callback)
+    out.write(OOB_MAGIC)
+    out.write(struct.pack('<Q', len(data)))
+    out.write(data)
+    out.write(struct.pack('<I', len(buffers)))
+    for buf in buffers:
+        out.write(struct.pack('<Q', buf.nbytes))
+        out.write(buf)
+
+
+def _read_exactly(reader, size):
+    data = reader.read(size)
+    if len(data) != size:
+        raise EOFError('Truncated pickle, expected {} more bytes'.format(size - len(data)))
+    return data
+
+
+def load_chunks(chunks):
+    """Unpickles an object from its serialized bytes as they arrive, see dump
+
+    Args:
+        chunks (iterable of bytes): the output of dump, in any number of chunks
+
+    Returns:
+        the unpickled object
+    """
+    reader = ChunkReader(chunks)
+    head = reader.peek(MAGIC_SIZE)
+    for compression, magic in ((GZIP, GZIP_MAGIC), (ZSTD, ZSTD_MAGIC), (LZ4, LZ4_MAGIC)):
+        if head.startswith(magic):
+            reader = ChunkReader(_decompress_chunks(reader.iter_rest(), compression))
+            head = reader.peek(MAGIC_SIZE)
+            break
+
+    if head != OOB_MAGIC:
+        obj = pickle.load(reader, **LOAD_KWARGS)
+    else:
+        obj = _load_oob(reader)
+    # the unpickled object can end before the compressed stream, reading the rest makes a truncated one raise EOFError
+    for _ in reader.iter_rest():
+        pass
+    return obj
+
+
+def _load_oob(reader):
+    """Unpickles an object stored in an out-of-band container, see the module documentation"""
+    _read_exactly(reader, MAGIC_SIZE)
+    data = _read_exactly(reader, struct.unpack('<Q', _read_exactly(reader, 8))[0])
+    buffers = []
+    for _ in range(struct.unpack('<I', _read_exactly(reader, 4))[0]):
+        buf = bytearray(struct.unpack('<Q', _read_exactly(reader, 8))[0])
+        if reader.readinto(buf) != len(buf):
+            raise EOFError('Truncated out-of-band buffer')
+        buffers.append(buf)
+    return pickle.loads(data, buffers=buffers, **LOAD_KWARGS)
+
+
+def loads(data):
+    """Unpickles an object from bytes, see load_chunks"""
+    return load_chunks([data])
+
+
+def dump_to_s3(bucket, path, obj, protocol=HIGHEST_PROTOCOL, compression=None, level=None,
+               part_size=DEFAULT_PART_SIZE, num_workers=DEFAULT_NUM_WORKERS):
+    """Pickles an object straight to S3, uploading its parts while it is being pickled
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the object within the bucket
+        obj: any picklable object
+        protocol (int): pickle protocol, buffers are written out-of-band from protocol 5
+        compression (str): None, GZIP, ZSTD or LZ4
+        level (int): compression level, the default of the compression library if None
+        part_size (int): size in bytes of each part of the upload
+        num_workers (int): number of parts uploaded at the same time
+    """
+    with S3Writer(bucket, path, part_size=part_size, num_workers=num_workers) as writer:
+        dump(obj, writer, protocol=protocol, compression=compression, level=level)
+
+
+def load_from_s3(bucket, path, part_size=DEFAULT_PART_SIZE, num_workers=DEFAULT_NUM_WORKERS):
+    """Unpickles an object from S3 as its byte ranges arrive, whatever its compression
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the object within the bucket
+        part_size (int): size in bytes of each range
+        num_workers (int): number of ranges fetched at the same time
+
+    Returns:
+        the unpickled object
+    """
+    return load_chunks(iter_ranges(bucket, path, part_size=part_size, num_workers=num_workers))
@@ -0,0 +1,80 @@
+"""Server side copies of S3 objects of any size with boto3.
+
+CopyObject is limited to objects of up to 5 GiB, bigger objects have to be
+copied as a multipart upload whose parts are byte ranges of the source
+(UploadPartCopy). Those parts are copied concurrently.
+"""
+import logging
+
+from aws_utils.s3.concurrency import DEFAULT_NUM_WORKERS, bounded_map
+from aws_utils.s3.transfer import MAX_PART_SIZE, get_part_size
+
+
+logger = logging.getLogger(__name__)
+MULTIPART_COPY_THRESHOLD = MAX_PART_SIZE
+DEFAULT_COPY_PART_SIZE = 512 * (1024 ** 2)
+
+
+def copy_key(client, src_bucket, src_key, dst_bucket, dst_key, size=None, part_size=DEFAULT_COPY_PART_SIZE,
+             num_workers=DEFAULT_NUM_WORKERS):
+    """Copies an object server side, with a multipart copy for objects too big for a single CopyObject
+
+    Note: multipart copies don't carry over the metadata of the source object, apart from its content type.
+
+    Args:
+        client (botocore.client.S3): boto3 client
+        src_bucket (str):
+        src_key (str):
+        dst_bucket (str):
+        dst_key (str):
+        size (int): size of the source object in bytes, looked up if not given
+        part_size (int): size of each part of a multipart copy
+        num_workers (int): number of parts copied at the same time
+    """
+    copy_source = {'Bucket': src_bucket, 'Key': src_key}
+    head = None
+    if size is None:
+        head = client.head_object(Bucket=src_bucket, Key=src_key)
+        size = head['ContentLength']
+
+    if size <= MULTIPART_COPY_THRESHOLD:
+        client.copy_object(CopySource=copy_source, Bucket=dst_bucket, Key=dst_key)
+        return
+
+    if head is None:
+        head = client.head_object(Bucket=src_bucket, Key=src_key)
+    upload_id = client.create_multipart_upload(Bucket=dst_bucket, Key=dst_key,
+                                               ContentType=head.get('ContentType', 'binary/octet-stream'))['UploadId']
+    part_size = get_part_size(size, part_size)
+
+    def copy_part(part):
+        part_num, start = part
+        end = min(start + part_size, size) - 1
+        response = client.upload_part_copy(Bucket=dst_bucket, Key=dst_key, UploadId=upload_id, PartNumber=part_num,
+                                           CopySource=copy_source, CopySourceRange='bytes={}-{}'.format(start, end))
+        return {'PartNumber': part_num, 'ETag': response['CopyPartResult']['ETag']}
+
+    try:
+        parts = list(bounded_map(copy_part, enumerate(range(0, size, part_size), 1), num_workers=num_workers))
+        client.complete_multipart_upload(Bucket=dst_bucket, Key=dst_key, UploadId=upload_id,
+                                         MultipartUpload={'Parts': parts})
+    except Exception:
+        logger.warning('Aborting multipart copy of %s/%s to %s/%s', src_bucket, src_key, dst_bucket, dst_key)
+        client.abort_multipart_upload(Bucket=dst_bucket, Key=dst_key, UploadId=upload_id)
+        raise
+    logger.debug('Copied %s/%s to %s/%s in %d parts', src_bucket, src_key, dst_bucket, dst_key, len(parts))
+
+
+def delete_keys(client, bucket_name, keys):
+    """Deletes up to 1000 keys with a single multi-object delete request
+
+    Args:
+        client (botocore.client.S3): boto3 client
+        bucket_name (str):
+        keys (list of str):
+
+    Returns:
+        list of {'Key': ..., 'Code': ..., 'Message': ...} for the keys which could not be deleted
+    """
+    response = client.delete_objects(Bucket=bucket_name, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+    return response.get('Errors', [])
@@ -0,0 +1,287 @@
+"""Streaming reads and writes of S3 objects with bounded memory."""
+import gzip
+import json
+import logging
+import zlib
+
+from aws_utils.s3.transfer import DEFAULT_PART_SIZE, MultipartUpload
+
+# python version backwards compatibility
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+logger = logging.getLogger(__name__)
+READ_CHUNK_SIZE = 256 * 1024
+# accept the gzip header only, see zlib.decompressobj
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+STREAM_NUM_WORKERS = 4
+
+
+def _to_bytes(data):
+    if isinstance(data, text_type):
+        return data.encode('utf-8')
+    return data
+
+
+class S3Writer(object):
+    """Write-only file-like object storing what is written to an S3 key.
+
+    Written data is buffered until a full part is available, which is then handed over to a MultipartUpload. If
+    less than one part is written overall it is saved with a single PUT on close. At most
+    (num_workers + 1) * part_size bytes are held in memory, whatever the size of the object.
+
+    Example:
+        with S3Writer(bucket, 'path/to/key') as f:
+            for line in lines:
+                f.write(line)
+    """
+
+    def __init__(self, bucket, path, part_size=DEFAULT_PART_SIZE, num_workers=STREAM_NUM_WORKERS):
+        """
+        Args:
+            bucket (boto.s3.bucket.Bucket): bucket to write to
+            path (str): key of the object to create
+            part_size (int): size in bytes of each part, at least transfer.MIN_PART_SIZE
+            num_workers (int): number of parts uploaded at the same time
+        """
+        self.bucket = bucket
+        self.path = path
+        self.part_size = part_size
+        self.num_workers = num_workers
+        self.closed = False
+        self._buffer = bytearray()
+        self._upload = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed S3Writer')
+
+        self._buffer.extend(_to_bytes(data))
+        # each part is copied once out of the buffer, which is only shifted once all the full parts are handed over
+        offset = 0
+        try:
+            while len(self._buffer) - offset >= self.part_size:
+                if self._upload is None:
+                    self._upload = MultipartUpload(self.bucket, self.path, num_workers=self.num_workers,
+                                                   max_pending=self.num_workers)
+                self._upload.add_part(memoryview(self._buffer)[offset:offset + self.part_size].tobytes())
+                offset += self.part_size
+        finally:
+            del self._buffer[:offset]
+
+    def close(self):
+        """Sends the data still buffered and completes the upload"""
+        if self.closed:
+            return
+        self.closed = True
+
+        if self._upload is None:
+            key = self.bucket.new_key(self.path)
+            key.set_contents_from_string(bytes(self._buffer))
+        else:
+            try:
+                if self._buffer:
+                    self._upload.add_part(bytes(self._buffer))
+            except Exception:
+                self._upload.abort()
+                raise
+            self._upload.complete()
+        self._buffer = bytearray()
+
+    def abort(self):
+        """Discards everything written so far, nothing is saved to S3"""
+        self.closed = True
+        self._buffer = bytearray()
+        if self._upload is not None:
+            self._upload.abort()
+
+
+def _iter_chunks(data, chunk_size=READ_CHUNK_SIZE):
+    """Yields the bytes of data in chunks
+
+    Args:
+        data (str, bytes, file-like or iterable of str/bytes):
+    """
+    if isinstance(data, (bytes, bytearray, text_type)):
+        data = _to_bytes(data)
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+    elif hasattr(data, 'read'):
+        for chunk in iter(lambda: data.read(chunk_size), data.read(0)):
+            yield _to_bytes(chunk)
+    else:
+        for chunk in data:
+            yield _to_bytes(chunk)
+
+
+def stream_to_s3(bucket, path, data, compress=False, part_size=DEFAULT_PART_SIZE, num_workers=STREAM_NUM_WORKERS):
+    """Saves data to S3 without ever holding the whole (or the whole compressed) content in memory
+
+    Args:
+        bucket (boto.s3.bucket.Bucket): bucket to write to
+        path (str): Path within the bucket to save the file to, should not contain the bucket name
+        data (str, bytes, file-like or iterable of str/bytes): the content to save, text is utf-8 encoded
+        compress (bool): If True the data is gzip compressed on the fly
+        part_size (int): size in bytes of each multipart part
+        num_workers (int): number of parts uploaded at the same time
+    """
+    with S3Writer(bucket, path, part_size=part_size, num_workers=num_workers) as writer:
+        out = writer
+        if compress:
+            out = gzip.GzipFile(filename='gzipped_file', mode='wb', fileobj=writer)
+        for chunk in _iter_chunks(data):
+            out.write(chunk)
+        if compress:
+            out.close()
+
+
+def iter_s3_chunks(bucket, path, chunk_size=READ_CHUNK_SIZE):
+    """Yields the content of an S3 object in chunks as it is received
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the object within the bucket
+        chunk_size (int): maximum size in bytes of each chunk
+    """
+    key = bucket.new_key(path)
+    key.open_read()
+    try:
+        for chunk in iter(lambda: key.read(chunk_size), b''):
+            yield chunk
+    finally:
+        # don't drain the rest of the response if we are stopped early
+        key.close(fast=True)
+
+
+def gunzip_chunks(chunks, chunk_size=READ_CHUNK_SIZE):
+    """Incrementally decompresses gzip data, yielding chunks of at most chunk_size bytes
+
+    Concatenated gzip members (e.g. the output of merge_part_files) are decompressed one after the other.
+
+    Args:
+        chunks (iterable of bytes): the compressed data
+        chunk_size (int): maximum size in bytes of each decompressed chunk
+
+    Raises:
+        EOFError: if the data ends before the end of its last gzip member
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    started = False
+    for chunk in chunks:
+        started = started or bool(chunk)
+        while chunk:
+            data = decompressor.decompress(chunk, chunk_size)
+            if data:
+                yield data
+
+            # checked first: at the end of a member unconsumed_tail can still hold what was moved to unused_data
+            # (python 2 decompressors have no eof, only unused_data tells)
+            if getattr(decompressor, 'eof', False) or decompressor.unused_data:
+                chunk = decompressor.unused_data
+                if chunk:
+                    # the end of a gzip member, anything left is the start of the next one
+                    data = decompressor.flush()
+                    if data:
+                        yield data
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+            elif decompressor.unconsumed_tail:
+                chunk = decompressor.unconsumed_tail
+            else:
+                chunk = b''
+
+    if not started:
+        # empty data, as with GzipFile
+        return
+    data = _finish_gzip(decompressor)
+    if data:
+        yield data
+
+
+def _finish_gzip(decompressor):
+    """Returns the rest of the data of a gzip decompressor given all its input, raises EOFError if it is truncated"""
+    if hasattr(decompressor, 'eof'):
+        data = decompressor.flush()
+        ended = decompressor.eof
+    else:
+        # python 2 decompressors have no eof, past the end of the stream what they are given is left unused
+        try:
+            data = decompressor.decompress(b'\0')
+        except zlib.error:
+            data = b''
+        ended = decompressor.unused_data == b'\0'
+    if not ended:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+    return data
+
+
+def split_lines(chunks):
+    """Splits chunks of bytes into lines, without their LF or CRLF terminator
+
+    Args:
+        chunks (iterable of bytes):
+    """
+    pending = []
+    for chunk in chunks:
+        lines = chunk.split(b'\n')
+        if len(lines) == 1:
+            pending.append(chunk)
+            continue
+
+        pending.append(lines[0])
+        lines[0] = b''.join(pending)
+        pending = [lines.pop()]
+        for line in lines:
+            yield line[:-1] if line.endswith(b'\r') else line
+
+    last = b''.join(pending)
+    if last:
+        yield last[:-1] if last.endswith(b'\r') else last
+
+
+def iter_lines_from_s3(bucket, path, compressed=False, encoding='utf-8'):
+    """Yields the lines of an S3 object one at a time, streaming and decompressing it on the fly
+
+    Only a few chunks of the object are held in memory, whatever its size.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the object within the bucket
+        compressed (bool): If True the object is gzip decompressed
+        encoding (str): lines are decoded with this encoding, if None they are yielded as bytes
+    """
+    chunks = iter_s3_chunks(bucket, path)
+    if compressed:
+        chunks = gunzip_chunks(chunks)
+
+    for line in split_lines(chunks):
+        yield line.decode(encoding) if encoding else line
+
+
+def iter_json_from_s3(bucket, path, compressed=False):
+    """Yields the records of a JSON lines S3 object one at a time, see iter_lines_from_s3
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the object within the bucket
+        compressed (bool): If True the object is gzip decompressed
+    """
+    for line in iter_lines_from_s3(bucket, path, compressed=compressed):
+        yield json.loads(line)
@@ -0,0 +1,350 @@
+"""Mirroring of a directory between S3 and the local disk, or between two S3 prefixes.
+
+Both sides are listed into KeyRecords indexed by their name relative to the
+synced directory, and only the files that are missing from the destination
+or differ from it are transferred, concurrently. A file differs when:
+
+* its size differs;
+* or both sides have a comparable etag (the MD5 of the content, which
+  multipart objects and local files don't have unless checksums are asked
+  for) and the etags differ;
+* or, when the etags can't tell, the source was modified after the
+  destination, to the second as S3 dates are.
+
+Downloaded files get the modification date of their key, so a file which was
+synced down is not downloaded again as long as its key doesn't change.
+
+Example:
+    sync_s3_to_local(bucket, 'models/latest/', '/var/lib/models/', delete=True)
+"""
+import hashlib
+import logging
+import os
+from collections import namedtuple
+
+from aws_utils.s3.concurrency import DEFAULT_NUM_WORKERS, bounded_map, chunked
+from aws_utils.s3.connections import get_client
+from aws_utils.s3.listing import KeyRecord, format_timestamp, iter_key_records, parse_timestamp
+from aws_utils.s3.server_copy import copy_key, delete_keys
+from aws_utils.s3.transfer import MULTIPART_THRESHOLD, READ_CHUNK_SIZE, download_to_file, upload_file_multipart
+
+
+logger = logging.getLogger(__name__)
+COPY = 'copy'
+DELETE = 'delete'
+# maximum number of keys in a multi-object delete request
+DELETE_BATCH_SIZE = 1000
+TMP_SUFFIX = '.sync-tmp'
+
+
+class SyncAction(namedtuple('SyncAction', ['kind', 'name', 'size'])):
+    """A file to copy (or upload, or download) to the destination, or to delete from it
+
+    Attributes:
+        kind (str): COPY or DELETE
+        name (str): relative to the synced directories, with '/' as separator
+        size (int): in bytes, of the source file for copies and of the destination file for deletes
+    """
+    __slots__ = ()
+
+
+class SyncResult(namedtuple('SyncResult', ['copied', 'deleted', 'skipped', 'bytes_copied'])):
+    """What a sync did: number of files copied, deleted and left alone, and number of bytes transferred"""
+    __slots__ = ()
+
+
+def _comparable_etag(etag):
+    # multipart etags are not the MD5 of the content
+    return etag is not None and '-' not in etag
+
+
+def is_modified(source, destination):
+    """Whether a file has to be copied over its destination, see the module documentation
+
+    Args:
+        source (aws_utils.s3.listing.KeyRecord):
+        destination (aws_utils.s3.listing.KeyRecord):
+
+    Returns:
+        bool
+    """
+    if source.size != destination.size:
+        return True
+    if _comparable_etag(source.etag) and _comparable_etag(destination.etag):
+        return source.etag != destination.etag
+    return parse_timestamp(source.last_modified) // 1000 > parse_timestamp(destination.last_modified) // 1000
+
+
+def plan_sync(source, destination, delete=False):
+    """Lists what needs to be done for the destination to mirror the source
+
+    Args:
+        source (dict): relative name -> KeyRecord
+        destination (dict): relative name -> KeyRecord
+        delete (bool): if set the files of the destination which are not in the source are deleted
+
+    Returns:
+        (list of SyncAction, int): the actions, in name order, and the number of files which are already in sync
+    """
+    actions = []
+    skipped = 0
+    for name in sorted(source):
+        record = source[name]
+        if name not in destination or is_modified(record, destination[name]):
+            actions.append(SyncAction(COPY, name, record.size))
+        else:
+            skipped += 1
+
+    if delete:
+        actions.extend(SyncAction(DELETE, name, destination[name].size)
+                       for name in sorted(destination) if name not in source)
+    return actions, skipped
+
+
+def _directory_prefix(prefix):
+    return prefix if not prefix or prefix.endswith('/') else prefix + '/'
+
+
+def list_s3_files(bucket, prefix):
+    """Returns the keys under a prefix by name relative to it, skipping folder markers
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): e.g. 'models/latest/'
+
+    Returns:
+        dict: relative name -> KeyRecord
+    """
+    prefix = _directory_prefix(prefix)
+    return {record.name[len(prefix):]: record for record in iter_key_records(bucket, prefix)
+            if not record.name.endswith('/')}
+
+
+def _local_path(local_directory, name):
+    """Returns the path a key is synced to, None if its name would put it outside of the local directory
+
+    Args:
+        local_directory (str): must be the real path of the directory, see os.path.realpath
+        name (str): relative to the synced prefix, e.g. 'vocab/words.txt' but also '../../.bashrc'
+    """
+    path = os.path.realpath(os.path.join(local_directory, *name.split('/')))
+    return path if path.startswith(os.path.join(local_directory, '')) else None
+
+
+def _local_etag(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return '"{}"'.format(md5.hexdigest())
+
+
+def list_local_files(directory, checksum=False):
+    """Returns the files under a local directory by name relative to it, as KeyRecords
+
+    Args:
+        directory (str): e.g. '/var/lib/models/'
+        checksum (bool): if set the etag of each file is its MD5, as S3 computes it for keys which were not uploaded
+            in parts. Reads every file, otherwise the etags are None and files are compared by size and date
+
+    Returns:
+        dict: relative name -> KeyRecord, its name being the local path
+
+    Raises:
+        IOError: if the directory doesn't exist, rather than listing it as empty
+    """
+    if not os.path.isdir(directory):
+        raise IOError('{} is not a directory'.format(directory))
+    files = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if path.endswith(TMP_SUFFIX):
+                continue
+            stat = os.stat(path)
+            name = os.path.relpath(path, directory).replace(os.sep, '/')
+            files[name] = KeyRecord(path, stat.st_size, _local_etag(path) if checksum else None,
+                                    format_timestamp(int(stat.st_mtime * 1000)))
+    return files
+
+
+def _copy_all(actions, transfer, num_workers, progress):
+    """Transfers the files of the COPY actions concurrently, calling progress(action) as each one is done
+
+    Returns:
+        (int, int): number of files and of bytes copied
+    """
+    def run(action):
+        transfer(action.name)
+        logger.debug('Copied %s (%d bytes)', action.name, action.size)
+        if progress is not None:
+            progress(action)
+        return action
+
+    copies = [action for action in actions if action.kind == COPY]
+    bytes_copied = sum(action.size for action in bounded_map(run, copies, num_workers=num_workers, ordered=False))
+    return len(copies), bytes_copied
+
+
+def _delete_all(actions, remove, progress):
+    """Deletes the files of the DELETE actions, remove being called with the list of their names
+
+    Returns:
+        int: number of files deleted
+    """
+    deletes = [action for action in actions if action.kind == DELETE]
+    if deletes:
+        remove([action.name for action in deletes])
+        if progress is not None:
+            for action in deletes:
+                progress(action)
+    return len(deletes)
+
+
+def _delete_s3_keys(client, bucket_name, keys):
+    for batch in chunked(keys, DELETE_BATCH_SIZE):
+        errors = delete_keys(client, bucket_name, batch)
+        if errors:
+            raise IOError('Unable to delete {} keys from {}, e.g. {}'.format(len(errors), bucket_name, errors[0]))
+    logger.debug('Deleted %d keys from %s', len(keys), bucket_name)
+
+
+def _log_result(source, destination, result):
+    logger.info('Synced %s to %s: %d files copied (%d bytes), %d deleted, %d already in sync', source, destination,
+                result.copied, result.bytes_copied, result.deleted, result.skipped)
+    return result
+
+
+def sync_s3_to_local(bucket, prefix, local_directory, delete=False, checksum=False, num_workers=DEFAULT_NUM_WORKERS,
+                     progress=None):
+    """Mirrors the keys under a prefix to a local directory
+
+    Files are downloaded next to their destination and renamed over it once complete, so an interrupted sync never
+    leaves truncated files behind. Keys whose name would put them outside of the local directory (e.g.
+    'prefix/../../.bashrc') are skipped.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): e.g. 'models/latest/'
+        local_directory (str): e.g. '/var/lib/models/', created if needed
+        delete (bool): delete the local files which are not under the prefix
+        checksum (bool): compare the MD5 of the local files to the etags, see list_local_files
+        num_workers (int): number of files transferred at the same time
+        progress (function): called with each SyncAction once it is done
+
+    Returns:
+        SyncResult
+    """
+    prefix = _directory_prefix(prefix)
+    local = list_local_files(local_directory, checksum=checksum) if os.path.isdir(local_directory) else {}
+    remote = {}
+    paths = {}
+    root = os.path.realpath(local_directory)
+    for name, record in list_s3_files(bucket, prefix).items():
+        path = _local_path(root, name)
+        if path is None:
+            logger.warning('Skipped s3://%s/%s%s, it would be written outside of %s', bucket.name, prefix, name,
+                           local_directory)
+            continue
+        remote[name] = record
+        paths[name] = path
+    actions, skipped = plan_sync(remote, local, delete=delete)
+
+    def download(name):
+        path = paths[name]
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # created by another worker in the meantime
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        download_to_file(bucket, prefix + name, path + TMP_SUFFIX)
+        mtime = parse_timestamp(remote[name].last_modified) / 1000.0
+        os.utime(path + TMP_SUFFIX, (mtime, mtime))
+        os.rename(path + TMP_SUFFIX, path)
+
+    def remove(names):
+        for name in names:
+            os.remove(local[name].name)
+
+    copied, bytes_copied = _copy_all(actions, download, num_workers, progress)
+    deleted = _delete_all(actions, remove, progress)
+    return _log_result('s3://{}/{}'.format(bucket.name, prefix), local_directory,
+                       SyncResult(copied, deleted, skipped, bytes_copied))
+
+
+def sync_local_to_s3(local_directory, bucket, prefix, delete=False, checksum=False, client=None,
+                     num_workers=DEFAULT_NUM_WORKERS, progress=None):
+    """Mirrors a local directory to the keys under a prefix
+
+    Args:
+        local_directory (str): e.g. '/var/lib/models/'
+        bucket (boto.s3.bucket.Bucket):
+        prefix (str): e.g. 'models/latest/'
+        delete (bool): delete the keys under the prefix which are not in the local directory
+        checksum (bool): compare the MD5 of the local files to the etags, see list_local_files
+        client (botocore.client.S3): boto3 client used to delete keys, see connections.get_client
+        num_workers (int): number of files transferred at the same time
+        progress (function): called with each SyncAction once it is done
+
+    Returns:
+        SyncResult
+    """
+    prefix = _directory_prefix(prefix)
+    local = list_local_files(local_directory, checksum=checksum)
+    remote = list_s3_files(bucket, prefix)
+    actions, skipped = plan_sync(local, remote, delete=delete)
+
+    def upload(name):
+        record = local[name]
+        if record.size > MULTIPART_THRESHOLD:
+            upload_file_multipart(bucket, record.name, prefix + name)
+        else:
+            bucket.new_key(prefix + name).set_contents_from_filename(record.name)
+
+    def remove(names):
+        _delete_s3_keys(client or get_client(), bucket.name, [prefix + name for name in names])
+
+    copied, bytes_copied = _copy_all(actions, upload, num_workers, progress)
+    deleted = _delete_all(actions, remove, progress)
+    return _log_result(local_directory, 's3://{}/{}'.format(bucket.name, prefix),
+                       SyncResult(copied, deleted, skipped, bytes_copied))
+
+
+def sync_s3_to_s3(src_bucket, src_prefix, dst_bucket, dst_prefix, delete=False, client=None,
+                  num_workers=DEFAULT_NUM_WORKERS, progress=None):
+    """Mirrors the keys under a prefix to another prefix, possibly in another bucket, with server side copies
+
+    Args:
+        src_bucket (boto.s3.bucket.Bucket):
+        src_prefix (str): e.g. 'models/2017-05-30/'
+        dst_bucket (boto.s3.bucket.Bucket):
+        dst_prefix (str): e.g. 'models/latest/'
+        delete (bool): delete the keys under the destination prefix which are not under the source prefix
+        client (botocore.client.S3): boto3 client used for copies and deletes, see connections.get_client
+        num_workers (int): number of keys copied at the same time
+        progress (function): called with each SyncAction once it is done
+
+    Returns:
+        SyncResult
+    """
+    src_prefix = _directory_prefix(src_prefix)
+    dst_prefix = _directory_prefix(dst_prefix)
+    client = client or get_client()
+    source = list_s3_files(src_bucket, src_prefix)
+    destination = list_s3_files(dst_bucket, dst_prefix)
+    actions, skipped = plan_sync(source, destination, delete=delete)
+
+    def copy(name):
+        copy_key(client, src_bucket.name, src_prefix + name, dst_bucket.name, dst_prefix + name,
+                 size=source[name].size)
+
+    def remove(names):
+        _delete_s3_keys(client, dst_bucket.name, [dst_prefix + name for name in names])
+
+    copied, bytes_copied = _copy_all(actions, copy, num_workers, progress)
+    deleted = _delete_all(actions, remove, progress)
+    return _log_result('s3://{}/{}'.format(src_bucket.name, src_prefix),
+                       's3://{}/{}'.format(dst_bucket.name, dst_prefix),
+                       SyncResult(copied, deleted, skipped, bytes_copied))
@@ -0,0 +1,486 @@
+"""Parallel multipart transfers between local data and S3.
+
+A single PUT or GET moves the whole object through one TCP stream, which caps
+the throughput of large transfers well below what a big instance can do. Here
+large uploads are split into parts and large downloads into byte ranges, which
+are transferred concurrently by a pool of threads.
+"""
+import errno
+import logging
+import math
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+
+from boto.exception import AWSConnectionError, S3ResponseError
+from concurrent.futures import ThreadPoolExecutor
+from retrying import Retrying
+
+# python version backwards compatibility
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from aws_utils.s3.concurrency import DEFAULT_NUM_WORKERS, bounded_map
+
+
+logger = logging.getLogger(__name__)
+
+# S3 limits, see http://docs.aws.amazon.com/AmazonS3/latest/dev/qfacts.html
+MIN_PART_SIZE = 5 * (1024 ** 2)
+MAX_PART_SIZE = 5 * (1024 ** 3)
+MAX_PARTS = 10000
+
+DEFAULT_PART_SIZE = 16 * (1024 ** 2)
+MULTIPART_THRESHOLD = 64 * (1024 ** 2)
+PART_MAX_ATTEMPTS = 3
+PART_RETRY_WAIT_MS = 500
+READ_CHUNK_SIZE = 256 * 1024
+# socket errors of a dropped or unreachable connection, the errors of local files (e.g. ENOENT) are not retried
+RETRYABLE_ERRNOS = frozenset([errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED, errno.EPIPE,
+                              errno.ETIMEDOUT, errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ENETDOWN])
+# 4xx errors S3 answers when it is throttling or the connection was too slow
+RETRYABLE_ERROR_CODES = frozenset(['RequestTimeout', 'SlowDown', 'Throttling', 'ThrottlingException'])
+
+
+def is_retryable_part_error(exception):
+    """Connection problems, throttling and S3 server errors are worth retrying, local and other client errors are not"""
+    if isinstance(exception, S3ResponseError):
+        return exception.status >= 500 or exception.error_code in RETRYABLE_ERROR_CODES
+    if isinstance(exception, (AWSConnectionError, socket.timeout)):
+        return True
+    return isinstance(exception, socket.error) and exception.errno in RETRYABLE_ERRNOS
+
+
+def get_part_size(total_size, part_size=DEFAULT_PART_SIZE):
+    """Returns a part size valid for S3 for an object of the given size.
+
+    The requested part size is increased when needed so that the object fits in MAX_PARTS parts.
+
+    Args:
+        total_size (int): size of the whole object in bytes
+        part_size (int): desired part size in bytes
+    Returns (int):
+    """
+    part_size = max(part_size, MIN_PART_SIZE, int(math.ceil(total_size / float(MAX_PARTS))))
+    if part_size > MAX_PART_SIZE:
+        raise ValueError('Object of {} bytes is too big for a multipart upload'.format(total_size))
+    return part_size
+
+
+class MemoryViewReader(object):
+    """Read-only file-like object over a memoryview, lets boto upload a slice of a buffer without copying it whole"""
+
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, min(offset, len(self._view)))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class BufferPool(object):
+    """Hands out reusable bytearrays, so that assembling many parts doesn't allocate a new buffer for each one"""
+
+    def __init__(self, count):
+        """
+        Args:
+            count (int): number of buffers, getting a buffer blocks while all of them are in use
+        """
+        self._buffers = Queue()
+        for _ in range(count):
+            self._buffers.put(bytearray())
+
+    @contextmanager
+    def buffer(self, size):
+        """Context manager providing a memoryview of exactly size bytes over one of the buffers"""
+        buf = self._buffers.get()
+        try:
+            if len(buf) < size:
+                # release the old buffer before allocating the bigger one
+                buf = None
+                buf = bytearray(size)
+            yield memoryview(buf)[:size]
+        finally:
+            self._buffers.put(buf if buf is not None else bytearray())
+
+
+class MultipartUpload(object):
+    """Uploads the parts of one S3 object concurrently.
+
+    Parts are numbered in the order in which they are added and sent by a pool of worker threads. Use it as a
+    context manager: the upload is completed on a clean exit and aborted if anything failed, so no orphaned parts
+    (which S3 keeps billing for) are left behind.
+
+    Example:
+        with MultipartUpload(bucket, 'path/to/key') as upload:
+            for chunk in chunks:
+                upload.add_part(chunk)
+    """
+
+    def __init__(self, bucket, path, num_workers=DEFAULT_NUM_WORKERS, max_attempts=PART_MAX_ATTEMPTS,
+                 max_pending=None):
+        """
+        Args:
+            bucket (boto.s3.bucket.Bucket): bucket to upload to
+            path (str): key of the object to create
+            num_workers (int): number of parts uploaded at the same time
+            max_attempts (int): number of times a part is tried before giving up on the whole upload
+            max_pending (int): maximum number of parts queued or in flight, adding a part blocks beyond this.
+                Defaults to twice num_workers, it bounds the memory held by add_part.
+        """
+        self.bucket = bucket
+        self.path = path
+        self.part_count = 0
+        self.total_size = 0
+        self._retrying = Retrying(retry_on_exception=is_retryable_part_error,
+                                  stop_max_attempt_number=max_attempts,
+                                  wait_exponential_multiplier=PART_RETRY_WAIT_MS)
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * num_workers)
+        self._futures = []
+        self._error = None
+        self._buffer_pool = BufferPool(num_workers)
+        self.mp = bucket.initiate_multipart_upload(path)
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.complete()
+        else:
+            self.abort()
+
+    def _submit(self, func, size, *args):
+        if self._error is not None:
+            raise self._error
+
+        self._slots.acquire()
+        self.part_count += 1
+        self.total_size += size
+        future = self._executor.submit(self._retrying.call, func, self.part_count, *args)
+        future.add_done_callback(self._part_done)
+        self._futures.append(future)
+        return self.part_count
+
+    def _part_done(self, future):
+        self._slots.release()
+        if not future.cancelled() and future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def _upload_bytes(self, part_num, data):
+        self.mp.upload_part_from_file(BytesIO(data), part_num)
+
+    def _upload_file_range(self, part_num, filename, offset, size):
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            self.mp.upload_part_from_file(f, part_num, size=size)
+
+    def _upload_filled(self, part_num, fill, size):
+        with self._buffer_pool.buffer(size) as view:
+            fill(view)
+            self.mp.upload_part_from_file(MemoryViewReader(view), part_num, size=size)
+
+    def _copy_part(self, part_num, src_bucket_name, src_key_name, start, end):
+        self.mp.copy_part_from_key(src_bucket_name, src_key_name, part_num, start=start, end=end)
+
+    def add_part(self, data):
+        """Queues a part holding the given bytes
+
+        Args:
+            data (bytes):
+        Returns (int): the part number
+        """
+        return self._submit(self._upload_bytes, len(data), data)
+
+    def add_file_part(self, filename, offset, size):
+        """Queues a part read from a local file, the data is only read by the worker uploading it
+
+        Args:
+            filename (str): local file path
+            offset (int): position of the first byte of the part in the file
+            size (int): number of bytes in the part
+        Returns (int): the part number
+        """
+        return self._submit(self._upload_file_range, size, filename, offset, size)
+
+    def add_filled_part(self, fill, size):
+        """Queues a part assembled by fill(view) in the worker uploading it
+
+        The worker takes a reusable buffer, fill writes the bytes of the part in the given memoryview of exactly
+        size bytes (e.g. downloading them straight into it) and the part is uploaded from the buffer without further
+        copies. This lets the production of the parts run concurrently too. fill is called again if the part is
+        retried.
+
+        Args:
+            fill (function): called with a memoryview to write the part to
+            size (int): number of bytes in the part
+        Returns (int): the part number
+        """
+        return self._submit(self._upload_filled, size, fill, size)
+
+    def add_copy_part(self, src_bucket_name, src_key_name, size, start=None, end=None):
+        """Queues a part copied server side from an existing key, optionally from a byte range of it
+
+        Args:
+            src_bucket_name (str): bucket of the key to copy
+            src_key_name (str): key to copy
+            size (int): number of bytes in the part
+            start (int): first byte to copy, inclusive
+            end (int): last byte to copy, inclusive
+        Returns (int): the part number
+        """
+        return self._submit(self._copy_part, size, src_bucket_name, src_key_name, start, end)
+
+    def complete(self):
+        """Waits for all the parts and completes the upload, aborting it if any part failed."""
+        try:
+            if not self.part_count:
+                # S3 refuses to complete an upload without parts
+                self.add_part(b'')
+            for future in self._futures:
+                future.result()
+            self.mp.complete_upload()
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown(wait=True)
+        logger.debug('Uploaded %s in %d parts (%d bytes)', self.path, self.part_count, self.total_size)
+
+    def abort(self):
+        """Cancels the parts not started yet and aborts the upload."""
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        logger.warning('Aborting multipart upload of %s', self.path)
+        try:
+            self.mp.cancel_upload()
+        except S3ResponseError:
+            logger.exception('Unable to abort multipart upload %s of %s', self.mp.id, self.path)
+
+
+def upload_file_multipart(bucket, local_file_path, remote_destination_path, part_size=DEFAULT_PART_SIZE,
+                          num_workers=DEFAULT_NUM_WORKERS):
+    """Upload a local file to S3 sending its parts concurrently.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        local_file_path (str): '/usr/local/file.txt'
+        remote_destination_path (str): production/output/file.txt
+        part_size (int): size in bytes of each part, increased if the file would need more than MAX_PARTS
+        num_workers (int): number of parts uploaded at the same time
+    """
+    size = os.path.getsize(local_file_path)
+    part_size = get_part_size(size, part_size)
+
+    with MultipartUpload(bucket, remote_destination_path, num_workers=num_workers) as upload:
+        for offset in range(0, size, part_size):
+            upload.add_file_part(local_file_path, offset, min(part_size, size - offset))
+
+
+def upload_string_multipart(bucket, path, data, part_size=DEFAULT_PART_SIZE, num_workers=DEFAULT_NUM_WORKERS):
+    """Upload a bytes string to S3 sending its parts concurrently.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): Path within the bucket to save the file to
+        data (bytes):
+        part_size (int): size in bytes of each part, increased if the data would need more than MAX_PARTS
+        num_workers (int): number of parts uploaded at the same time
+    """
+    part_size = get_part_size(len(data), part_size)
+
+    with MultipartUpload(bucket, path, num_workers=num_workers) as upload:
+        for offset in range(0, len(data), part_size):
+            upload.add_part(data[offset:offset + part_size])
+
+
+class ObjectChangedError(IOError):
+    """Raised when an object is overwritten while its byte ranges are being downloaded"""
+
+
+def _get_range(bucket, path, start, end, etag=None):
+    """Returns the bytes between start and end (both inclusive) of an object, and the size and etag of the whole object.
+
+    An empty object has no valid range, so it is returned as an empty string with a size of 0 and no etag.
+
+    Raises:
+        ObjectChangedError: if etag is set and the object doesn't have this etag anymore (If-Match), so that the
+            ranges of a download all come from the same version of the object
+    """
+    # a Key holds the state of its last request so each call needs its own
+    key = bucket.new_key(path)
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    if etag is not None:
+        headers['If-Match'] = etag
+    try:
+        data = key.get_contents_as_string(headers=headers)
+    except S3ResponseError as e:
+        if e.status == 416 and start == 0:
+            return b'', 0, None
+        if e.status == 412:
+            raise ObjectChangedError('s3://{}/{} was overwritten during the download, its etag is not {} anymore'
+                                     .format(bucket.name, path, etag))
+        raise
+    return data, key.size, key.etag
+
+
+def _fetch_remaining_ranges(bucket, path, start, size, etag, part_size, num_workers, write):
+    """Fetches the bytes of an object from start onwards in concurrent ranges, passing each to write(offset, data)"""
+    def fetch(offset):
+        data, _, _ = _get_range(bucket, path, offset, min(offset + part_size, size) - 1, etag=etag)
+        write(offset, data)
+
+    for _ in bounded_map(fetch, range(start, size, part_size), num_workers=num_workers):
+        pass
+
+
+def download_to_buffer(bucket, path, part_size=DEFAULT_PART_SIZE, num_workers=DEFAULT_NUM_WORKERS):
+    """Download an object fetching its byte ranges concurrently
+
+    The first range tells us the size of the object, so objects smaller than part_size cost a single GET, and its
+    etag, which the other ranges must match.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the object within the bucket
+        part_size (int): size in bytes of each range
+        num_workers (int): number of ranges fetched at the same time
+    Returns (bytes or bytearray): the content of the object, as a preallocated bytearray for multi range objects
+    Raises:
+        ObjectChangedError: if the object is overwritten during the download
+    """
+    first, size, etag = _get_range(bucket, path, 0, part_size - 1)
+    if len(first) >= size:
+        return first
+
+    buf = bytearray(size)
+    buf[:len(first)] = first
+
+    def write(offset, data):
+        buf[offset:offset + len(data)] = data
+
+    _fetch_remaining_ranges(bucket, path, len(first), size, etag, part_size, num_workers, write)
+    return buf
+
+
+def iter_ranges(bucket, path, part_size=DEFAULT_PART_SIZE, num_workers=DEFAULT_NUM_WORKERS):
+    """Yields the content of an object in order, as byte ranges which are fetched concurrently ahead of the consumer
+
+    At most 2 * num_workers ranges are fetched but not consumed yet, so the object is streamed with bounded memory.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the object within the bucket
+        part_size (int): size in bytes of each range
+        num_workers (int): number of ranges fetched at the same time
+
+    Returns:
+        generator of bytes
+    Raises:
+        ObjectChangedError: if the object is overwritten during the download
+    """
+    first, size, etag = _get_range(bucket, path, 0, part_size - 1)
+    if first:
+        yield first
+
+    def fetch(offset):
+        return _get_range(bucket, path, offset, min(offset + part_size, size) - 1, etag=etag)[0]
+
+    for data in bounded_map(fetch, range(len(first), size, part_size), num_workers=num_workers):
+        yield data
+
+
+def download_to_file(bucket, path, local_file_path, part_size=DEFAULT_PART_SIZE, num_workers=DEFAULT_NUM_WORKERS):
+    """Download an object to a local file fetching its byte ranges concurrently
+
+    The local file is preallocated to the size of the object and each range is written at its offset as soon as it
+    arrives, so no more than num_workers ranges are held in memory.
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the object within the bucket
+        local_file_path (str): '/usr/local/file.txt'
+        part_size (int): size in bytes of each range
+        num_workers (int): number of ranges fetched at the same time
+    Raises:
+        ObjectChangedError: if the object is overwritten during the download
+    """
+    first, size, etag = _get_range(bucket, path, 0, part_size - 1)
+
+    with open(local_file_path, 'wb') as f:
+        f.write(first)
+        if len(first) >= size:
+            return
+        f.truncate(size)
+        f.flush()
+
+        fd = f.fileno()
+        lock = threading.Lock()
+
+        def write(offset, data):
+            if hasattr(os, 'pwrite'):
+                os.pwrite(fd, data, offset)
+            else:
+                with lock:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    os.write(fd, data)
+
+        _fetch_remaining_ranges(bucket, path, len(first), size, etag, part_size, num_workers, write)
+
+
+def read_key_into(bucket, path, view, start=None):
+    """Streams the content of an object straight into a memoryview, which must be exactly as big as the object
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the object within the bucket
+        view (memoryview): writable view to fill
+        start (int): if set only len(view) bytes from this offset are read
+    Raises:
+        IOError: if the object (or the range) is not the expected size
+    """
+    headers = None
+    if start is not None:
+        headers = {'Range': 'bytes={}-{}'.format(start, start + len(view) - 1)}
+
+    key = bucket.new_key(path)
+    key.open_read(headers=headers)
+    try:
+        resp = key.resp
+        readinto = getattr(resp, 'readinto', None)
+        pos = 0
+        while pos < len(view):
+            if readinto is not None:
+                read = readinto(view[pos:])
+            else:
+                chunk = resp.read(min(READ_CHUNK_SIZE, len(view) - pos))
+                read = len(chunk)
+                view[pos:pos + read] = chunk
+            if not read:
+                break
+            pos += read
+
+        if pos != len(view) or resp.read(1):
+            raise IOError('{} changed size, expected {} bytes'.format(path, len(view)))
+    finally:
+        key.close(fast=True)
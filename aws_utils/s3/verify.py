@@ -0,0 +1,208 @@
+"""Checks that S3 objects hold the expected content without downloading them.
+
+S3 gives every object an etag computed from its content: the MD5 of the
+content for objects uploaded with a single PUT, and for multipart uploads the
+MD5 of the concatenated MD5s of the parts followed by '-' and the number of
+parts. So the expected content (e.g. a local serialization of a pickled
+object) is streamed through an EtagWriter and its etag compared to the one
+returned by a HEAD request.
+
+The part size of a multipart object isn't stored, it is guessed from the size
+of the object and its number of parts: first the common part sizes giving that
+number of parts (transfer.DEFAULT_PART_SIZE, which S3Writer and
+save_pickle_to_s3 use, and 8 MiB, the default of the AWS CLI and boto3), then
+the smallest one (as transfer.get_part_size gives for the biggest objects) and
+a few of the whole numbers of MiB above it (as most other clients use).
+
+When the etags can't tell, e.g. for objects encrypted with KMS whose etag is
+not an MD5 or for unusual part sizes, the object is streamed and the MD5 of
+its content is compared to the expected one.
+"""
+import hashlib
+import logging
+from collections import namedtuple
+
+from aws_utils.s3.concurrency import bounded_map
+from aws_utils.s3.metadata import HEAD_NUM_WORKERS
+from aws_utils.s3.transfer import DEFAULT_PART_SIZE, iter_ranges
+
+
+logger = logging.getLogger(__name__)
+MIB = 1024 ** 2
+MAX_PART_SIZE_CANDIDATES = 4
+# tried first whenever they give the number of parts of the object
+COMMON_PART_SIZES = (DEFAULT_PART_SIZE, 8 * MIB)
+# how a verification was decided
+ETAG = 'etag'
+CONTENT = 'content'
+SIZE = 'size'
+MISSING = 'missing'
+
+
+class KeyVerification(namedtuple('KeyVerification', ['name', 'ok', 'method'])):
+    """Outcome of the verification of a key
+
+    Attributes:
+        name (str): path of the key
+        ok (bool): whether the key holds the expected content
+        method (str): what decided: ETAG, CONTENT (the streamed content), SIZE (the sizes differ) or MISSING (the
+            key doesn't exist)
+    """
+    __slots__ = ()
+
+
+class _PartHasher(object):
+    """Computes the multipart etag of a stream for a given part size"""
+    __slots__ = ('part_size', 'digests', 'md5', 'filled')
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.digests = []
+        self.md5 = hashlib.md5()
+        self.filled = 0
+
+    def update(self, view):
+        while len(view):
+            take = min(len(view), self.part_size - self.filled)
+            self.md5.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.part_size:
+                self.digests.append(self.md5.digest())
+                self.md5 = hashlib.md5()
+                self.filled = 0
+
+    def etag(self):
+        digests = self.digests + [self.md5.digest()] if self.filled or not self.digests else self.digests
+        return '"{}-{}"'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+class EtagWriter(object):
+    """Write-only file-like object computing the etags S3 would give to what is written to it
+
+    Example:
+        writer = EtagWriter([16 * 1024 ** 2])
+        writer.write(data)
+        writer.etag(), writer.etag(16 * 1024 ** 2)
+    """
+
+    def __init__(self, part_sizes=()):
+        """
+        Args:
+            part_sizes (iterable of int): part sizes of the multipart etags to compute
+        """
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._parts = [_PartHasher(part_size) for part_size in part_sizes]
+
+    def write(self, data):
+        view = memoryview(data)
+        if view.ndim != 1 or view.itemsize != 1:
+            view = memoryview(view.tobytes())
+        self.size += len(view)
+        self._md5.update(view)
+        for hasher in self._parts:
+            hasher.update(view)
+
+    def flush(self):
+        pass
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def etag(self, part_size=None):
+        """Returns the etag of a single PUT upload, or of a multipart upload with one of the part sizes given"""
+        if part_size is None:
+            return '"{}"'.format(self.md5)
+        for hasher in self._parts:
+            if hasher.part_size == part_size:
+                return hasher.etag()
+        raise KeyError('The etag of {} bytes parts was not computed'.format(part_size))
+
+
+def candidate_part_sizes(size, parts):
+    """Returns the likely part sizes of a multipart object, see the module documentation
+
+    Args:
+        size (int): size of the object in bytes
+        parts (int): number of parts, from its etag
+
+    Returns:
+        list of int
+    """
+    if parts <= 1:
+        return [max(size, 1)]
+    smallest = -(-size // parts)
+    # parts - 1 parts of part_size must not be enough
+    largest = -(-size // (parts - 1)) - 1
+    candidates = [part_size for part_size in COMMON_PART_SIZES if smallest <= part_size <= largest]
+    searched = [smallest]
+    part_size = -(-smallest // MIB) * MIB
+    while part_size <= largest and len(searched) < MAX_PART_SIZE_CANDIDATES:
+        if part_size != smallest:
+            searched.append(part_size)
+        part_size += MIB
+    return candidates + [part_size for part_size in searched if part_size not in candidates]
+
+
+def _stream_md5(bucket, path):
+    md5 = hashlib.md5()
+    for chunk in iter_ranges(bucket, path):
+        md5.update(chunk)
+    return md5.hexdigest()
+
+
+def verify_key(bucket, path, write, stream_fallback=True):
+    """Checks that a key holds the expected content, comparing etags and only streaming the key if they can't tell
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        path (str): path of the key within the bucket
+        write (function): called with a file-like object to write the expected content to, e.g.
+            lambda f: f.write(data)
+        stream_fallback (bool): if False keys whose etag doesn't match are reported as different rather than
+            streamed
+
+    Returns:
+        KeyVerification
+    """
+    key = bucket.get_key(path)
+    if key is None:
+        return KeyVerification(path, False, MISSING)
+
+    etag = key.etag
+    parts = int(etag.strip('"').rsplit('-', 1)[1]) if '-' in etag else None
+    part_sizes = candidate_part_sizes(key.size, parts) if parts else [None]
+    writer = EtagWriter([part_size for part_size in part_sizes if part_size is not None])
+    write(writer)
+    if writer.size != key.size:
+        return KeyVerification(path, False, SIZE)
+
+    expected = [writer.etag(part_size) for part_size in part_sizes]
+    if etag in expected:
+        return KeyVerification(path, True, ETAG)
+    if not stream_fallback:
+        return KeyVerification(path, False, ETAG)
+
+    logger.debug('Etag %s of s3://%s/%s is not one of %s, comparing its content', etag, bucket.name, path, expected)
+    return KeyVerification(path, _stream_md5(bucket, path) == writer.md5, CONTENT)
+
+
+def verify_keys(bucket, writes, stream_fallback=True, num_workers=HEAD_NUM_WORKERS):
+    """Verifies many keys concurrently, see verify_key
+
+    Args:
+        bucket (boto.s3.bucket.Bucket):
+        writes (dict): path -> function writing the expected content of the key to a file-like object
+        stream_fallback (bool): see verify_key
+        num_workers (int): number of keys verified at the same time
+
+    Returns:
+        dict: path -> KeyVerification
+    """
+    def verify(item):
+        path, write = item
+        return verify_key(bucket, path, write, stream_fallback=stream_fallback)
+
+    return {result.name: result for result in bounded_map(verify, writes.items(), num_workers=num_workers)}
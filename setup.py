@@ -6,11 +6,17 @@ version = '0.4.6'
 INSTALL_REQUIRES = [
     'boto>=2.38.0',# need to stay in this version as sqs.get_queue function stops working when we upgrade
     'boto3>=1.2.3',
-    'smart_open==1.3.2',# smart open must be 1.3.2 because in 1.3.3 onward the gzip write functionality has been removed
     'dateutils>=0.6.6',
-    'retrying>=1.3.3'
+    'retrying>=1.3.3',
+    'futures>=3.0.5; python_version < "3"',
 ]
 
+# optional compression of pickles, see aws_utils.s3.serialization
+EXTRAS_REQUIRE = {
+    'zstd': ['zstandard'],
+    'lz4': ['lz4'],
+}
+
 setup(
     name=package,
     version=version,
@@ -20,4 +26,5 @@ setup(
     url='https://github.com/skimhub/aws-utils',
     packages=find_packages(exclude=['test']),
     install_requires=INSTALL_REQUIRES,
+    extras_require=EXTRAS_REQUIRE,
 )
@@ -19,4 +19,12 @@ def boto3_get_response():
         with stubber:
             response = stubbed_client.list_buckets()
         return response
-    return pass_response
\ No newline at end of file
+    return pass_response
+
+@pytest.fixture(autouse=True)
+def reset_s3_connections():
+    """Pooled S3 connections must not leak between tests, each test has its own mocked S3."""
+    from aws_utils.s3.connections import reset_connections
+    reset_connections()
+    yield
+    reset_connections()
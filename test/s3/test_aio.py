@@ -0,0 +1,98 @@
+import threading
+
+import boto
+import moto
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+
+from aws_utils.s3 import aio, connections  # noqa: E402
+from aws_utils.s3.aio import AsyncS3  # noqa: E402
+
+TEST_BUCKET = 'aio-test'
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        yield boto.connect_s3().create_bucket(TEST_BUCKET)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def s3(loop):
+    # the in-process S3 mock doesn't support concurrent requests
+    with AsyncS3(max_concurrency=1, loop=loop) as s3:
+        yield s3
+
+
+def test_save_get_exists_delete(bucket, loop, s3):
+    loop.run_until_complete(s3.save(bucket, 'dir/a', b'data'))
+    assert loop.run_until_complete(s3.get(bucket, 'dir/a')) == b'data'
+    assert loop.run_until_complete(s3.exists(bucket, 'dir/a'))
+    assert loop.run_until_complete(s3.list(bucket, 'dir/')) == ['dir/a']
+
+    loop.run_until_complete(s3.save(bucket, 'dir/ab', b'data'))
+    loop.run_until_complete(s3.delete(bucket, 'dir/a'))
+    assert not loop.run_until_complete(s3.exists(bucket, 'dir/a'))
+    assert loop.run_until_complete(s3.list(bucket, 'dir/')) == ['dir/ab']
+
+    loop.run_until_complete(s3.delete_prefix(bucket, 'dir/a'))
+    assert loop.run_until_complete(s3.list(bucket, 'dir/')) == []
+
+
+def test_pickles_and_json(bucket, loop, s3):
+    paths = ['features/{}.pkl'.format(i) for i in range(5)]
+    for i, path in enumerate(paths):
+        loop.run_until_complete(s3.save_pickle(bucket, path, {'id': i}))
+    assert loop.run_until_complete(s3.load_pickles(bucket, paths)) == [{'id': i} for i in range(5)]
+
+    loop.run_until_complete(s3.save_json(bucket, 'records.json', [{'a': 1}, {'a': 2}]))
+    assert loop.run_until_complete(s3.load_json(bucket, 'records.json')) == [{'a': 1}, {'a': 2}]
+
+    metadata = loop.run_until_complete(s3.head_many(bucket, ['features/0.pkl', 'missing']))
+    assert metadata['features/0.pkl'].exists and not metadata['missing'].exists
+
+
+def test_cancelled_calls_dont_start(loop, s3):
+    started = []
+    release = threading.Event()
+
+    def call(i):
+        started.append(i)
+        release.wait(5)
+
+    futures = [s3.run(call, i) for i in range(10)]
+    for future in futures[1:]:
+        future.cancel()
+    # lets the cancellations reach the thread pool before its thread is free
+    loop.run_until_complete(asyncio.sleep(0.1))
+    release.set()
+    loop.run_until_complete(asyncio.wait(futures))
+    assert started == [0]
+
+
+
+def test_concurrent_calls_share_pooled_buckets(bucket, loop, monkeypatch):
+    pooled = connections.get_pooled_bucket(TEST_BUCKET)
+    # 4 gets have to be in flight at the same time to get past the barrier, the mock S3 isn't called concurrently
+    barrier = threading.Barrier(4, timeout=5)
+    buckets = []
+
+    def get_from_s3(bucket, path, compressed=False):
+        buckets.append(aio.s3_utils.get_bucket(bucket))
+        barrier.wait()
+        return path.encode()
+
+    monkeypatch.setattr(aio.s3_utils, 'get_from_s3', get_from_s3)
+
+    paths = ['features/{}'.format(i) for i in range(8)]
+    with AsyncS3(max_concurrency=4, loop=loop) as s3:
+        assert loop.run_until_complete(s3.get_many(TEST_BUCKET, paths)) == [path.encode() for path in paths]
+    assert len(buckets) == 8 and all(other is pooled for other in buckets)
@@ -0,0 +1,104 @@
+import threading
+
+import boto
+import moto
+
+from aws_utils.s3 import connections
+from aws_utils.s3.s3_utils import get_bucket, setup_bucket
+
+TEST_BUCKET = 'connections-test-bucket'
+
+
+@moto.mock_s3()
+def test_get_bucket_reuses_connection_and_bucket():
+    boto.connect_s3().create_bucket(TEST_BUCKET)
+
+    first = get_bucket(TEST_BUCKET)
+    second = get_bucket(TEST_BUCKET)
+
+    assert first is second
+    assert first.connection is connections.get_connection()
+
+
+@moto.mock_s3()
+def test_setup_bucket_without_reuse_opens_new_connection():
+    boto.connect_s3().create_bucket(TEST_BUCKET)
+
+    pooled = setup_bucket(TEST_BUCKET, reuse=True)
+    fresh = setup_bucket(TEST_BUCKET)
+
+    assert pooled is not fresh
+    assert pooled.connection is not fresh.connection
+
+
+@moto.mock_s3()
+def test_threads_share_connection_and_bucket():
+    boto.connect_s3().create_bucket(TEST_BUCKET)
+    bucket = get_bucket(TEST_BUCKET)
+    other = []
+    thread = threading.Thread(target=lambda: other.append(get_bucket(TEST_BUCKET)))
+    thread.start()
+    thread.join()
+
+    assert other[0] is bucket
+
+
+@moto.mock_s3()
+def test_idle_buckets_are_evicted(monkeypatch):
+    boto.connect_s3().create_bucket(TEST_BUCKET)
+    now = [1000.0]
+    monkeypatch.setattr(connections.time, 'time', lambda: now[0])
+
+    first = connections.get_pooled_bucket(TEST_BUCKET)
+    now[0] += connections.BUCKET_IDLE_TIMEOUT - 1
+    assert connections.get_pooled_bucket(TEST_BUCKET) is first
+
+    now[0] += connections.BUCKET_IDLE_TIMEOUT + 1
+    assert connections.get_pooled_bucket(TEST_BUCKET) is not first
+
+
+@moto.mock_s3()
+def test_registry_is_discarded_after_fork(monkeypatch):
+    boto.connect_s3().create_bucket(TEST_BUCKET)
+    parent_conn = connections.get_connection()
+    parent_bucket = connections.get_pooled_bucket(TEST_BUCKET)
+
+    monkeypatch.setattr(connections.os, 'getpid', lambda: -1)
+
+    assert connections.get_connection() is not parent_conn
+    assert connections.get_pooled_bucket(TEST_BUCKET) is not parent_bucket
+
+
+@moto.mock_s3()
+def test_slow_bucket_validation_doesnt_block_other_buckets(monkeypatch):
+    boto.connect_s3().create_bucket(TEST_BUCKET)
+    boto.connect_s3().create_bucket('slow-bucket')
+    connection = connections.get_connection()
+    original = type(connection).get_bucket
+    validating, release = threading.Event(), threading.Event()
+    validated = []
+
+    def get_bucket(self, bucket_name, *args, **kwargs):
+        if bucket_name == 'slow-bucket':
+            validating.set()
+            release.wait(5)
+            validated.append(bucket_name)
+        return original(self, bucket_name, *args, **kwargs)
+
+    monkeypatch.setattr(type(connection), 'get_bucket', get_bucket)
+    slow = threading.Thread(target=connections.get_pooled_bucket, args=('slow-bucket',))
+    slow.start()
+    try:
+        assert validating.wait(5)
+        assert connections.get_pooled_bucket(TEST_BUCKET).name == TEST_BUCKET
+        assert not validated
+    finally:
+        release.set()
+        slow.join()
+
+
+def test_boto3_clients_are_shared_per_region():
+    client = connections.get_client('us-east-1')
+
+    assert connections.get_client('us-east-1') is client
+    assert connections.get_client('eu-west-1') is not client
@@ -0,0 +1,108 @@
+import gzip
+import io
+import itertools
+import json
+from datetime import date, datetime
+
+import boto
+import moto
+import pytest
+
+from aws_utils.s3.datasets import iter_dataset, iter_days, list_dataset_files
+from aws_utils.s3.s3_utils import read_date_partitions
+
+TEST_BUCKET = 'datasets-test'
+
+
+def gzipped(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+        for day in (1, 2, 4):
+            prefix = 'output/year=2017/month=05/day={:02}/'.format(day)
+            for part in range(2):
+                records = '\n'.join(json.dumps({'day': day, 'part': part, 'i': i}) for i in range(3))
+                bucket.new_key(prefix + 'part-{:05}.gz'.format(part)).set_contents_from_string(
+                    gzipped(records.encode('utf-8')))
+            bucket.new_key(prefix + '_SUCCESS').set_contents_from_string('')
+        bucket.new_key('output/year=2017/month=05/day=05_$folder$').set_contents_from_string('')
+        yield bucket
+
+
+def test_iter_days():
+    assert list(iter_days(date(2017, 2, 27), datetime(2017, 3, 1, 12))) == [
+        date(2017, 2, 27), date(2017, 2, 28), date(2017, 3, 1)]
+    with pytest.raises(ValueError):
+        list(iter_days(date(2017, 3, 2), date(2017, 3, 1)))
+
+
+def test_list_dataset_files(bucket):
+    files = list(list_dataset_files(bucket, 'output', date(2017, 5, 2), date(2017, 5, 5), num_workers=1))
+
+    assert [(f.date, f.record.name) for f in files] == [
+        (date(2017, 5, 2), 'output/year=2017/month=05/day=02/part-00000.gz'),
+        (date(2017, 5, 2), 'output/year=2017/month=05/day=02/part-00001.gz'),
+        (date(2017, 5, 4), 'output/year=2017/month=05/day=04/part-00000.gz'),
+        (date(2017, 5, 4), 'output/year=2017/month=05/day=04/part-00001.gz'),
+    ]
+
+
+def test_iter_dataset(bucket):
+    records = list(iter_dataset(bucket, 'output/', date(2017, 4, 30), date(2017, 5, 4), num_workers=1,
+                                list_num_workers=1))
+
+    assert records == [{'day': day, 'part': part, 'i': i} for day in (1, 2, 4) for part in range(2) for i in range(3)]
+
+
+def test_iter_dataset_unordered(bucket):
+    records = iter_dataset(bucket, 'output/', date(2017, 5, 1), date(2017, 5, 4), ordered=False, num_workers=1,
+                           list_num_workers=1)
+
+    assert sorted(records, key=lambda r: (r['day'], r['part'], r['i'])) == [
+        {'day': day, 'part': part, 'i': i} for day in (1, 2, 4) for part in range(2) for i in range(3)]
+
+
+def test_iter_dataset_streams_files(bucket):
+    produced = []
+
+    def read(b, path):
+        for i in itertools.count():
+            produced.append(path)
+            yield i
+
+    records = iter_dataset(bucket, 'output/', date(2017, 5, 1), date(2017, 5, 1), read=read, num_workers=1,
+                           list_num_workers=1, batch_size=10, max_batches=2)
+
+    assert list(itertools.islice(records, 25)) == list(range(25))
+    # the reader of the first, endless, file is only a few batches ahead
+    assert len(produced) <= 25 + 10 * 4
+    records.close()
+
+
+def test_iter_dataset_read_error(bucket):
+    def read(b, path):
+        yield path
+        raise IOError('broken ' + path)
+
+    records = iter_dataset(bucket, 'output/', date(2017, 5, 1), date(2017, 5, 1), read=read, num_workers=1,
+                           list_num_workers=1)
+
+    assert next(records) == 'output/year=2017/month=05/day=01/part-00000.gz'
+    with pytest.raises(IOError):
+        list(records)
+
+
+def test_read_date_partitions(bucket):
+    read = lambda b, path: [path]
+    paths = list(read_date_partitions(TEST_BUCKET, 'output/', date(2017, 5, 4), date(2017, 5, 10),
+                                      prefix_tmpl='year={:04}/month={:02}/day={:02}/part-00001', read=read,
+                                      num_workers=1, list_num_workers=1))
+
+    assert paths == ['output/year=2017/month=05/day=04/part-00001.gz']
@@ -0,0 +1,124 @@
+import os
+import pickle
+
+import boto
+import moto
+import pytest
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+
+from aws_utils.s3.disk_cache import DiskCache
+from aws_utils.s3.s3_utils import get_from_s3, load_pickle_from_s3
+
+TEST_BUCKET = 'disk-cache-test'
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        yield boto.connect_s3().create_bucket(TEST_BUCKET)
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    """Records the If-None-Match header of every GET, answering 304 like S3 when the etag matches"""
+    requests = []
+    open_read = Key.open_read
+
+    def conditional_open_read(self, headers=None, *args, **kwargs):
+        if self.resp is not None:
+            # already open, Key.read calls open_read before every read
+            return open_read(self, headers, *args, **kwargs)
+        etag = (headers or {}).get('If-None-Match')
+        requests.append(etag)
+        if etag is not None and etag == self.bucket.get_key(self.name).etag:
+            raise S3ResponseError(304, 'Not Modified')
+        return open_read(self, headers, *args, **kwargs)
+
+    monkeypatch.setattr(Key, 'open_read', conditional_open_read)
+    return requests
+
+
+def test_get_revalidates_with_etag(bucket, requests, tmpdir):
+    cache = DiskCache(str(tmpdir))
+    bucket.new_key('lookup.pkl').set_contents_from_string(pickle.dumps({'a': 1}))
+    etag = bucket.get_key('lookup.pkl').etag
+
+    assert load_pickle_from_s3(bucket, 'lookup.pkl', cache=cache) == {'a': 1}
+    assert load_pickle_from_s3(bucket, 'lookup.pkl', cache=cache) == {'a': 1}
+    assert requests == [None, etag]
+
+    bucket.new_key('lookup.pkl').set_contents_from_string(pickle.dumps({'a': 2}))
+    assert load_pickle_from_s3(bucket, 'lookup.pkl', cache=cache) == {'a': 2}
+    assert requests[-1] == etag
+    assert load_pickle_from_s3(bucket, 'lookup.pkl', cache=cache) == {'a': 2}
+    assert requests[-1] == bucket.get_key('lookup.pkl').etag
+
+
+def test_get_without_304_support(bucket, tmpdir):
+    cache = DiskCache(str(tmpdir.join('cache')))
+    bucket.new_key('a').set_contents_from_string('data')
+    assert get_from_s3(bucket, 'a', cache=cache) == b'data'
+    assert get_from_s3(bucket, 'a', cache=cache) == b'data'
+    assert [name for name in os.listdir(cache.directory) if not name.startswith('.')] == \
+        [os.path.basename(cache._entry_path(TEST_BUCKET, 'a'))]
+
+    cache.invalidate(TEST_BUCKET, 'a')
+    assert cache.size == 0
+
+
+def test_missing_object_is_not_cached(bucket, tmpdir):
+    cache = DiskCache(str(tmpdir))
+    with pytest.raises(S3ResponseError):
+        cache.get(bucket, 'missing')
+    assert cache.size == 0
+    assert [name for name in os.listdir(str(tmpdir)) if name.startswith('.tmp')] == []
+
+
+def test_evicts_least_recently_used(bucket, requests, tmpdir):
+    for name in ('a', 'b', 'c'):
+        bucket.new_key(name).set_contents_from_string(name * 1000)
+    cache = DiskCache(str(tmpdir), max_size=2500)
+
+    cache.get(bucket, 'a')
+    cache.get(bucket, 'b')
+    os.utime(cache._entry_path(TEST_BUCKET, 'a'), (0, 0))
+    os.utime(cache._entry_path(TEST_BUCKET, 'b'), (1, 1))
+    # a hit makes an entry the most recently used
+    cache.get(bucket, 'a')
+    cache.get(bucket, 'c')
+
+    assert os.path.exists(cache._entry_path(TEST_BUCKET, 'a'))
+    assert not os.path.exists(cache._entry_path(TEST_BUCKET, 'b'))
+    assert os.path.exists(cache._entry_path(TEST_BUCKET, 'c'))
+    assert cache.size <= 2500
+
+
+def test_object_bigger_than_the_cache(bucket, tmpdir):
+    bucket.new_key('big').set_contents_from_string('x' * 5000)
+    cache = DiskCache(str(tmpdir), max_size=1000)
+
+    # the entry is evicted as soon as it is written, its content is still returned
+    assert cache.get(bucket, 'big') == b'x' * 5000
+    assert cache.size == 0
+
+
+def test_truncated_read_is_not_cached(bucket, tmpdir, monkeypatch):
+    bucket.new_key('a').set_contents_from_string('x' * 1000)
+    cache = DiskCache(str(tmpdir))
+    read = Key.read
+    reads = []
+
+    def truncated_read(self, size=0):
+        # the connection is cut after the first 100 bytes
+        reads.append(size)
+        return read(self, 100) if len(reads) == 1 else b''
+
+    monkeypatch.setattr(Key, 'read', truncated_read)
+    with pytest.raises(IOError):
+        cache.get(bucket, 'a')
+    assert cache.size == 0
+    assert [name for name in os.listdir(str(tmpdir)) if name.startswith('.tmp')] == []
+
+    monkeypatch.setattr(Key, 'read', read)
+    assert cache.get(bucket, 'a') == b'x' * 1000
@@ -0,0 +1,117 @@
+import boto
+import boto3
+import moto
+import pytest
+
+from boto.s3.connection import OrdinaryCallingFormat
+
+from aws_utils.s3.connections import get_bucket_client
+from aws_utils.s3.listing import KeyRecord, iter_directory, iter_key_records, list_directory, list_key_columns, \
+    list_subdirectories
+from aws_utils.s3.s3_utils import get_segment_filepaths, retrieve_segments_list
+
+TEST_BUCKET = 'listing-test'
+KEYS = [
+    'segments/bluekai/_SUCCESS',
+    'segments/bluekai/part-00000',
+    'segments/bluekai/part-00001',
+    'segments/bluekai/nested/part-00000',
+    'segments/bluekai/nested/deeper/part-00000',
+    'segments/bluekai/other/part-00000',
+    'segments/bluekai_$folder$',
+    'segments/bluekaiextra/part-00000',
+]
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+        for name in KEYS:
+            bucket.new_key(name).set_contents_from_string('' if name.endswith(('_SUCCESS', '$folder$')) else 'data')
+        yield bucket
+
+
+def test_iter_directory(bucket):
+    children = sorted((name, key is None) for name, key in iter_directory(bucket, 'segments/bluekai/'))
+    assert children == [('_SUCCESS', False), ('nested', True), ('other', True),
+                        ('part-00000', False), ('part-00001', False)]
+
+
+def test_list_directory_follows_pagination(bucket):
+    for i in range(1005):
+        bucket.new_key('many/dir{:04}/part'.format(i)).set_contents_from_string('x')
+    bucket.new_key('many/file').set_contents_from_string('x')
+
+    listing = list_directory(bucket, 'many/')
+    assert listing.directories == ['dir{:04}'.format(i) for i in range(1005)]
+    assert [key.name for key in listing.files] == ['many/file']
+
+
+def test_list_subdirectories(bucket):
+    assert list_subdirectories(bucket, 'segments/') == ['bluekai', 'bluekaiextra']
+    assert list_subdirectories(bucket, 'segments/bluekai/nested/') == ['deeper']
+    assert list_subdirectories(bucket, 'missing/') == []
+
+
+def test_iter_key_records(bucket):
+    records = list(iter_key_records(bucket, 'segments/bluekai/', page_size=2))
+    assert [record.name for record in records] == sorted(name for name in KEYS if name.startswith('segments/bluekai/'))
+
+    record = records[-1]
+    key = bucket.get_key('segments/bluekai/part-00001')
+    assert record == KeyRecord(key.name, 4, key.etag, record.last_modified)
+    assert record.key == key.name
+
+
+def test_iter_key_records_names_invalid_in_xml(bucket):
+    # listed URL encoded, a control character doesn't break the parsing of the page
+    boto3.client('s3', region_name='us-east-1').put_object(Bucket=TEST_BUCKET, Key=u'odd/\x01name', Body=b'data')
+
+    assert [record.name for record in iter_key_records(bucket, 'odd/')] == [u'odd/\x01name']
+    assert list_directory(bucket, 'odd/').files[0].name == u'odd/\x01name'
+
+
+def test_listing_uses_the_connection_of_the_bucket(bucket):
+    connection = boto.connect_s3('other-access-key', 'other-secret-key', security_token='other-token',
+                                 host='s3.example.com', port=9000, is_secure=False,
+                                 calling_format=OrdinaryCallingFormat())
+    client = get_bucket_client(connection.get_bucket(TEST_BUCKET, validate=False))
+
+    credentials = client._request_signer._credentials
+    assert (credentials.access_key, credentials.secret_key, credentials.token) == \
+        ('other-access-key', 'other-secret-key', 'other-token')
+    assert client.meta.endpoint_url == 'http://s3.example.com:9000'
+    assert client.meta.config.s3['addressing_style'] == 'path'
+    assert get_bucket_client(connection.get_bucket('another-bucket', validate=False)) is client
+    assert get_bucket_client(bucket) is not client
+
+    other_bucket = boto.connect_s3('other-access-key', 'other-secret-key').get_bucket(TEST_BUCKET)
+    assert [record.name for record in iter_key_records(other_bucket, 'segments/bluekai/nested/')] == \
+        ['segments/bluekai/nested/deeper/part-00000', 'segments/bluekai/nested/part-00000']
+
+
+def test_list_key_columns(bucket):
+    columns = list_key_columns(bucket, 'segments/', page_size=3)
+    assert columns.names == sorted(KEYS)
+    assert list(columns.sizes) == [0 if name.endswith(('_SUCCESS', '$folder$')) else 4 for name in sorted(KEYS)]
+    assert columns.total_size == 4 * 6
+    assert list(columns) == list(iter_key_records(bucket, 'segments/'))
+    assert len(list_key_columns(bucket, 'missing/')) == 0
+
+
+def test_retrieve_segments_list(bucket):
+    assert retrieve_segments_list(bucket, 'segments/bluekai/') == {'part-00000', 'part-00001', 'nested', 'other'}
+    assert retrieve_segments_list(bucket, 'segments/') == {'bluekai', 'bluekaiextra'}
+
+
+def test_retrieve_segments_list_leaves_out_non_empty_markers(bucket):
+    bucket.new_key('segments/bluekai/_SUCCESS').set_contents_from_string('{"records": 2}')
+
+    assert retrieve_segments_list(bucket, 'segments/bluekai/') == {'part-00000', 'part-00001', 'nested', 'other'}
+
+
+def test_get_segment_filepaths(bucket):
+    paths = get_segment_filepaths('s3n://{}/segments/bluekai/'.format(TEST_BUCKET), bucket, TEST_BUCKET)
+    assert sorted(paths) == ['segments/bluekai/nested', 'segments/bluekai/other',
+                             'segments/bluekai/part-00000', 'segments/bluekai/part-00001']
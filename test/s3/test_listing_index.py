@@ -0,0 +1,158 @@
+import re
+import threading
+from datetime import date
+
+import boto
+import moto
+import pytest
+
+from aws_utils.s3 import listing_index
+from aws_utils.s3.listing import iter_directory
+from aws_utils.s3.listing_index import ListingIndex
+from aws_utils.s3.s3_utils import fetch_s3_keys_by_regex_pattern, get_contents_of_directory, \
+    get_latest_year_month_day_prefix, path_contains_data, retrieve_segments_list
+
+TEST_BUCKET = 'listing-index-test'
+KEYS = [
+    'data/_SUCCESS',
+    'data/part-00000',
+    'data/year=2017/month=01/day=01/part-00000',
+    'data/year=2017/month=01/day=02/part-00000',
+    'data/year=2017/month=01/day=02/part-00001',
+    'data/year=2017/month=02/day=10/part-00000',
+    'datalake/part-00000',
+]
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+        for name in KEYS:
+            bucket.new_key(name).set_contents_from_string('' if name.endswith('_SUCCESS') else 'data')
+        yield bucket
+
+
+@pytest.fixture
+def index(tmpdir):
+    with ListingIndex(str(tmpdir.join('index.db')), refresh_interval=0) as index:
+        yield index
+
+
+def names(keys):
+    return [key.name for key in keys]
+
+
+def test_iter_keys(bucket, index):
+    assert names(index.iter_keys(TEST_BUCKET, 'data/')) == KEYS[:-1]
+    assert names(index.iter_keys(TEST_BUCKET, 'data/year=2017/month=01/day=02/')) == KEYS[3:5]
+    assert names(index.iter_keys(TEST_BUCKET, 'data/missing/')) == []
+
+    key = next(index.iter_keys(TEST_BUCKET, 'data/part'))
+    assert (key.name, key.size, key.etag) == ('data/part-00000', 4, bucket.get_key('data/part-00000').etag)
+
+
+def test_iter_directory_matches_listing(bucket, index, monkeypatch):
+    monkeypatch.setattr(listing_index, 'FETCH_SIZE', 2)
+    for prefix in ('data/', 'data/year=2017/', 'data/year=2017/month=01/', ''):
+        expected = sorted((name, key is None) for name, key in iter_directory(bucket, prefix))
+        assert [(name, key is None) for name, key in index.iter_directory(TEST_BUCKET, prefix)] == expected
+
+
+def test_queries_below_a_root_use_it(bucket, index, monkeypatch):
+    index.refresh(TEST_BUCKET, 'data/')
+    refreshed = []
+    monkeypatch.setattr(index, 'refresh', lambda bucket_name, prefix: refreshed.append(prefix))
+
+    assert names(index.iter_keys(TEST_BUCKET, 'data/year=2017/month=02/')) == KEYS[5:6]
+    assert refreshed == ['data/']
+
+
+def test_index_isnt_locked_during_refresh(bucket, index, monkeypatch):
+    refresh = index.refresh
+    locked = []
+
+    def try_lock():
+        locked.append(index._lock.acquire(False))
+        if locked[-1]:
+            index._lock.release()
+
+    def checking_refresh(bucket_name, prefix):
+        # reads from other threads go on while a root is listed
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+        return refresh(bucket_name, prefix)
+
+    monkeypatch.setattr(index, 'refresh', checking_refresh)
+
+    assert names(index.iter_keys(TEST_BUCKET, 'data/year=2017/')) == KEYS[2:6]
+    assert locked == [True]
+
+
+def test_incremental_refresh_lists_only_new_keys(bucket, index):
+    assert index.refresh(TEST_BUCKET, 'data/') == 6
+    bucket.new_key('data/year=2017/month=03/day=01/part-00000').set_contents_from_string('data')
+    assert index.refresh(TEST_BUCKET, 'data/') == 1
+    assert len(list(index.iter_keys(TEST_BUCKET, 'data/'))) == 7
+
+    # deleted keys are only noticed by a full refresh
+    bucket.delete_key('data/part-00000')
+    assert 'data/part-00000' in names(index.iter_keys(TEST_BUCKET, 'data/'))
+    index.refresh(TEST_BUCKET, 'data/', full=True)
+    assert 'data/part-00000' not in names(index.iter_keys(TEST_BUCKET, 'data/'))
+
+
+def test_interrupted_refresh_resumes(bucket, index, monkeypatch):
+    monkeypatch.setattr(listing_index, 'LIST_PAGE_SIZE', 2)
+    list_pages = index._list_pages
+
+    def interrupted(bucket_name, prefix, start_after):
+        pages = list_pages(bucket_name, prefix, start_after)
+        yield next(pages)
+        raise IOError('Connection reset')
+
+    monkeypatch.setattr(index, '_list_pages', interrupted)
+    with pytest.raises(IOError):
+        index.refresh(TEST_BUCKET, 'data/')
+    # the first page was committed to the staging table, the root isn't listed until the listing completes
+    assert index._db.execute('SELECT last_key FROM staged_roots').fetchall() == [(KEYS[1],)]
+    assert index._db.execute('SELECT COUNT(*) FROM keys').fetchone()[0] == 0
+
+    monkeypatch.setattr(index, '_list_pages', list_pages)
+    assert index.refresh(TEST_BUCKET, 'data/') == 4
+    assert names(index.iter_keys(TEST_BUCKET, 'data/')) == KEYS[:-1]
+    assert index._db.execute('SELECT COUNT(*) FROM staged_keys').fetchone()[0] == 0
+
+
+def test_refresh_interval_and_ttl(bucket, tmpdir):
+    path = str(tmpdir.join('index.db'))
+    with ListingIndex(path, refresh_interval=3600) as index:
+        index.refresh(TEST_BUCKET, 'data/')
+        bucket.new_key('data/year=2017/month=03/day=01/part-00000').set_contents_from_string('data')
+        bucket.delete_key('data/part-00000')
+        assert len(list(index.iter_keys(TEST_BUCKET, 'data/'))) == 6
+
+    # the index is persisted, and a root older than the TTL is listed again from scratch
+    with ListingIndex(path, ttl=-1) as index:
+        keys = names(index.iter_keys(TEST_BUCKET, 'data/'))
+        assert 'data/part-00000' not in keys
+        assert 'data/year=2017/month=03/day=01/part-00000' in keys
+
+
+def test_invalidate(bucket, index):
+    index.refresh(TEST_BUCKET, 'data/')
+    index.invalidate(TEST_BUCKET)
+    assert index._db.execute('SELECT COUNT(*) FROM keys').fetchone()[0] == 0
+
+
+def test_s3_utils_helpers_with_index(bucket, index):
+    assert get_contents_of_directory('data/', bucket=bucket, index=index) == KEYS[:-1]
+    assert path_contains_data(bucket, 'data/year=2017/', index=index)
+    assert not path_contains_data(bucket, 'data/_SUCCESS', index=index)
+    assert retrieve_segments_list(bucket, 'data/', index=index) == {'part-00000', 'year=2017'}
+    assert get_latest_year_month_day_prefix('s3n://{}/data/'.format(TEST_BUCKET), index=index) == date(2017, 2, 10)
+
+    keys = fetch_s3_keys_by_regex_pattern(bucket, 'data/', re.compile(r'day=02/part-\d+$'), index=index)
+    assert names(keys) == KEYS[3:5]
+    assert keys[0].get_contents_as_string() == b'data'
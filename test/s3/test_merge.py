@@ -0,0 +1,125 @@
+from collections import namedtuple
+
+import pytest
+
+from aws_utils.s3.merge import COPY, DOWNLOAD, Segment, copy_cost, download_cost, plan_merge
+
+MIB = 1024 ** 2
+
+Key = namedtuple('Key', ['name', 'size'])
+
+
+def _describe(plan):
+    return [(part.kind, [(s.key.name, s.start, s.end) for s in part.segments]) for part in plan]
+
+
+def test_plan_merge_groups_small_keys_and_copies_big_ones():
+    keys = [Key('a', 10), Key('b', 20), Key('c', 50), Key('d', 60)]
+
+    plan = plan_merge(keys, min_part_size=50, copy_threshold=50)
+
+    assert _describe(plan) == [
+        (DOWNLOAD, [('a', 0, 9), ('b', 0, 19), ('c', 0, 49)]),
+        (COPY, [('d', 0, 59)]),
+    ]
+
+
+def test_plan_merge_tops_up_small_group_with_head_of_big_key():
+    keys = [Key('a', 10), Key('big', 100)]
+
+    plan = plan_merge(keys, min_part_size=50, copy_threshold=50)
+
+    assert _describe(plan) == [
+        (DOWNLOAD, [('a', 0, 9), ('big', 0, 39)]),
+        (COPY, [('big', 40, 99)]),
+    ]
+    assert plan.downloaded_bytes == 50
+    assert plan.copied_bytes == 60
+    assert plan.requests == 3
+
+
+def test_plan_merge_downloads_big_key_when_rest_would_be_too_small():
+    keys = [Key('a', 10), Key('b', 60), Key('c', 10)]
+
+    plan = plan_merge(keys, min_part_size=50)
+
+    assert _describe(plan) == [
+        (DOWNLOAD, [('a', 0, 9), ('b', 0, 59)]),
+        (DOWNLOAD, [('c', 0, 9)]),
+    ]
+
+
+def test_plan_merge_respects_max_part_size():
+    keys = [Key('huge', 250), Key('a', 40), Key('b', 40), Key('c', 40)]
+
+    plan = plan_merge(keys, min_part_size=10, max_part_size=100, copy_threshold=200)
+
+    assert all(part.size <= 100 for part in plan)
+    assert [part.kind for part in plan][:3] == [COPY, COPY, COPY]
+    assert plan.total_size == 370
+
+
+def test_plan_merge_respects_max_parts():
+    keys = [Key(str(i), 1) for i in range(100)]
+
+    plan = plan_merge(keys, min_part_size=1, max_parts=10)
+
+    assert len(plan) == 10
+    assert plan.part_size == 10
+    assert all(part.size == 10 for part in plan)
+
+
+def test_plan_merge_compares_costs():
+    # a key just above the part size costs less to download than to copy, a much bigger one the other way round
+    assert download_cost(6 * MIB) < copy_cost(6 * MIB)
+    assert copy_cost(500 * MIB) < download_cost(500 * MIB)
+    keys = [Key('small', 6 * MIB), Key('medium', 6 * MIB), Key('big', 500 * MIB)]
+
+    plan = plan_merge(keys)
+
+    assert _describe(plan) == [
+        (DOWNLOAD, [('small', 0, 6 * MIB - 1)]),
+        (DOWNLOAD, [('medium', 0, 6 * MIB - 1)]),
+        (COPY, [('big', 0, 500 * MIB - 1)]),
+    ]
+    assert plan.explain().startswith('3 parts of at least {} bytes, keys are copied server side when'.format(5 * MIB))
+
+
+def test_plan_merge_enlarges_parts_when_there_are_too_many():
+    # with 61 bytes parts 'big' is copied in two parts of 55 bytes and 'c' is left on its own, one part too many
+    keys = [Key('big', 110), Key('b', 61), Key('c', 11)]
+
+    plan = plan_merge(keys, min_part_size=10, max_part_size=100, max_parts=3, copy_threshold=10)
+
+    assert len(plan) == 3
+    assert plan.part_size > 61
+    assert plan.total_size == 182
+
+
+def test_plan_merge_too_many_parts():
+    with pytest.raises(ValueError):
+        plan_merge([Key(str(i), 10) for i in range(11)], min_part_size=10, max_part_size=10, max_parts=10)
+
+
+def test_plan_merge_keeps_order_and_every_byte():
+    keys = [Key('k%d' % i, size) for i, size in enumerate([3, 70, 0, 5, 120, 1, 49, 51, 2])]
+
+    plan = plan_merge(keys, min_part_size=50)
+
+    covered = [(s.key.name, b) for part in plan for s in part.segments for b in range(s.start, s.end + 1)]
+    assert covered == [(key.name, b) for key in keys for b in range(key.size)]
+    assert all(part.size >= 50 for part in plan.parts[:-1])
+
+
+def test_plan_merge_explain():
+    plan = plan_merge([Key('a', 10), Key('big', 100)], min_part_size=50, copy_threshold=50)
+
+    explanation = plan.explain()
+
+    assert explanation.startswith('2 parts')
+    assert 'part 2: copy big bytes 40-99 (60 bytes)' in explanation
+
+
+def test_segment_is_whole_key():
+    assert Segment(Key('a', 10), 0, 9).is_whole_key
+    assert not Segment(Key('a', 10), 1, 9).is_whole_key
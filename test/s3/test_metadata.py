@@ -0,0 +1,102 @@
+import boto
+import moto
+import pytest
+
+from aws_utils.s3 import metadata
+from aws_utils.s3.metadata import KeyMetadata, head_key, head_keys
+from aws_utils.s3.s3_utils import file_is_empty, get_filesize, get_files_metadata, get_md5, path_exists
+
+TEST_BUCKET = 'metadata-test'
+PARTS = ['output/part-{:05}'.format(i) for i in range(120)]
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+        for name in PARTS:
+            bucket.new_key(name).set_contents_from_string(name)
+        bucket.new_key('output/_SUCCESS').set_contents_from_string('')
+        bucket.new_key('other/file').set_contents_from_string('data')
+        yield bucket
+
+
+@pytest.fixture
+def requests(bucket, monkeypatch):
+    requests = []
+    get_key, list_keys = bucket.get_key, bucket.list
+
+    def recording_get_key(path, *args, **kwargs):
+        requests.append(('head', path))
+        return get_key(path, *args, **kwargs)
+
+    def recording_list(prefix='', *args, **kwargs):
+        requests.append(('list', prefix))
+        return list_keys(prefix, *args, **kwargs)
+
+    monkeypatch.setattr(bucket, 'get_key', recording_get_key)
+    monkeypatch.setattr(bucket, 'list', recording_list)
+    return requests
+
+
+def test_head_key(bucket):
+    etag = bucket.get_key('other/file').etag
+    assert head_key(bucket, 'other/file') == KeyMetadata('other/file', True, 4, etag)
+    assert head_key(bucket, 'other/missing') == KeyMetadata('other/missing', False, None, None)
+
+
+def test_head_keys_uses_head_requests_for_few_keys(bucket, requests):
+    result = head_keys(bucket, ['other/file', 'output/part-00001', 'output/missing'], num_workers=1)
+    assert {name: m.exists for name, m in result.items()} == \
+        {'other/file': True, 'output/part-00001': True, 'output/missing': False}
+    assert result['output/part-00001'].size == len('output/part-00001')
+    assert sorted(kind for kind, _ in requests) == ['head', 'head', 'head']
+
+
+def test_head_keys_lists_folders_with_many_keys(bucket, requests):
+    etag = bucket.get_key('output/part-00020').etag
+    del requests[:]
+    paths = PARTS[10:110] + ['output/part-00050-missing', 'other/file']
+    result = head_keys(bucket, paths, num_workers=1)
+
+    assert sorted(requests) == [('head', 'other/file'), ('list', 'output/part-00')]
+    assert set(result) == set(paths)
+    assert [name for name, m in result.items() if not m.exists] == ['output/part-00050-missing']
+    assert result['output/part-00020'] == KeyMetadata('output/part-00020', True, 17, etag)
+
+
+def test_head_keys_falls_back_to_head_requests(bucket, requests, monkeypatch):
+    monkeypatch.setattr(metadata, 'LIST_MIN_KEYS', 2)
+    monkeypatch.setattr(metadata, 'LIST_PAGE_SIZE', 1)
+    result = head_keys(bucket, ['output/part-00000', 'output/part-00119', 'output/zzz'], num_workers=1)
+
+    assert {name: m.exists for name, m in result.items()} == \
+        {'output/part-00000': True, 'output/part-00119': True, 'output/zzz': False}
+    # the listing stopped at output/_SUCCESS, before any of the keys
+    assert requests == [('list', 'output/'), ('head', 'output/part-00000'), ('head', 'output/part-00119'),
+                        ('head', 'output/zzz')]
+
+
+def test_head_keys_without_listing(bucket, requests):
+    result = head_keys(bucket, PARTS, num_workers=1, use_listing=False)
+    assert all(m.exists for m in result.values())
+    assert sorted(requests) == [('head', name) for name in PARTS]
+
+
+def test_single_key_functions(bucket):
+    assert path_exists(bucket, 'other/file')
+    assert not path_exists(TEST_BUCKET, 'other/missing')
+    assert get_filesize(TEST_BUCKET, 'other/file') == 4
+    assert get_md5(bucket, 'other/file') == bucket.get_key('other/file').etag[1:-1]
+    assert file_is_empty(bucket, 'output/_SUCCESS')
+    assert not file_is_empty(bucket, 'other/file')
+    for function in (get_filesize, get_md5, file_is_empty):
+        with pytest.raises(IOError):
+            function(bucket, 'other/missing')
+
+
+def test_get_files_metadata(bucket):
+    result = get_files_metadata(TEST_BUCKET, PARTS + ['missing'], num_workers=1)
+    assert len(result) == len(PARTS) + 1
+    assert all(result[name].exists for name in PARTS)
+    assert not result['missing'].exists
@@ -0,0 +1,180 @@
+import pickle
+import threading
+import time
+
+import boto
+import moto
+import pytest
+
+from aws_utils.s3 import object_cache
+from aws_utils.s3.object_cache import ObjectCache
+from aws_utils.s3.s3_utils import load_jsonfile_from_s3, load_pickle_from_s3, save_jsonfile_to_s3
+
+TEST_BUCKET = 'object-cache-test'
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        yield boto.connect_s3().create_bucket(TEST_BUCKET)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(object_cache.time, 'time', lambda: now[0])
+    return now
+
+
+class CountingLoader(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, bucket, path):
+        self.calls += 1
+        return bucket.get_key(path).get_contents_as_string()
+
+
+def test_get_within_and_past_ttl(bucket, clock):
+    cache = ObjectCache(ttl=60)
+    load = CountingLoader()
+    bucket.new_key('model').set_contents_from_string('v1')
+
+    assert cache.get(bucket, 'model', load) == b'v1'
+    clock[0] += 30
+    assert cache.get(bucket, 'model', load) == b'v1'
+    # past the TTL the etag is checked, the object didn't change so it isn't loaded again
+    clock[0] += 60
+    assert cache.get(bucket, 'model', load) == b'v1'
+    assert load.calls == 1
+
+    bucket.new_key('model').set_contents_from_string('v2')
+    assert cache.get(bucket, 'model', load) == b'v1'
+    clock[0] += 61
+    assert cache.get(bucket, 'model', load) == b'v2'
+    assert load.calls == 2
+
+
+def test_variants_are_cached_apart(bucket, clock):
+    cache = ObjectCache(ttl=60)
+    bucket.new_key('model').set_contents_from_string('v1')
+
+    assert cache.get(bucket, 'model', lambda b, p: 'upper') == 'upper'
+    assert cache.get(bucket, 'model', lambda b, p: 'lower', variant='lower') == 'lower'
+    assert cache.get(bucket, 'model', lambda b, p: 'other') == 'upper'
+    assert len(cache) == 2
+
+    bucket.new_key('model').set_contents_from_string('v2')
+    cache.refresh()
+    assert len(cache) == 2
+    cache.invalidate(TEST_BUCKET, 'model')
+    assert (len(cache), cache.size) == (0, 0)
+
+
+def test_memory_budget(bucket):
+    cache = ObjectCache(max_size=250, ttl=0)
+    load = CountingLoader()
+    for name in ('a', 'b', 'c', 'big'):
+        bucket.new_key(name).set_contents_from_string(name[0] * (300 if name == 'big' else 100))
+
+    cache.get(bucket, 'a', load)
+    cache.get(bucket, 'b', load)
+    cache.get(bucket, 'a', load)
+    cache.get(bucket, 'c', load)
+    assert (len(cache), cache.size) == (2, 200)
+    assert load.calls == 3
+
+    cache.get(bucket, 'a', load)
+    assert load.calls == 3
+    cache.get(bucket, 'b', load)
+    assert load.calls == 4
+
+    cache.get(bucket, 'big', load)
+    assert (len(cache), cache.size) == (2, 200)
+
+
+def test_concurrent_gets_load_once(bucket):
+    cache = ObjectCache()
+    bucket.new_key('model').set_contents_from_string('v1')
+    loading, release = threading.Event(), threading.Event()
+    calls = []
+
+    def load(b, path):
+        calls.append(path)
+        loading.set()
+        release.wait(5)
+        return b'v1'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(bucket, 'model', load))) for _ in range(3)]
+    threads[0].start()
+    assert loading.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert (calls, results) == (['model'], [b'v1'] * 3)
+    # the loading locks don't outlive the loads
+    assert not cache._loading
+
+
+def test_refresh_swaps_in_new_versions(bucket, clock):
+    cache = ObjectCache(ttl=60)
+    load = CountingLoader()
+    bucket.new_key('changed').set_contents_from_string('v1')
+    bucket.new_key('same').set_contents_from_string('v1')
+    bucket.new_key('deleted').set_contents_from_string('v1')
+    for name in ('changed', 'same', 'deleted'):
+        cache.get(bucket, name, load)
+
+    bucket.new_key('changed').set_contents_from_string('v2')
+    bucket.delete_key('deleted')
+    cache.refresh()
+    assert load.calls == 4
+    assert len(cache) == 2
+    assert cache.get(bucket, 'changed', load) == b'v2'
+    assert cache.get(bucket, 'same', load) == b'v1'
+    assert load.calls == 4
+
+
+def test_refresher_thread(bucket):
+    cache = ObjectCache(ttl=3600)
+    load = CountingLoader()
+    bucket.new_key('model').set_contents_from_string('v1')
+    cache.get(bucket, 'model', load)
+    bucket.new_key('model').set_contents_from_string('v2')
+
+    cache.start_refresher(0.01)
+    try:
+        with pytest.raises(RuntimeError):
+            cache.start_refresher(0.01)
+        deadline = time.time() + 5
+        while load.calls < 2 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        cache.stop_refresher()
+    assert cache.get(bucket, 'model', load) == b'v2'
+
+
+def test_load_from_s3_with_object_cache(bucket):
+    cache = ObjectCache(ttl=0)
+    bucket.new_key('lookup.pkl').set_contents_from_string(pickle.dumps({'a': 1}))
+    save_jsonfile_to_s3(bucket, 'records.json', [{'a': 1}])
+
+    first = load_pickle_from_s3(bucket, 'lookup.pkl', object_cache=cache)
+    assert first == {'a': 1}
+    assert load_pickle_from_s3(bucket, 'lookup.pkl', object_cache=cache) is first
+
+    records = load_jsonfile_from_s3(bucket, 'records.json', object_cache=cache)
+    assert records == [{'a': 1}]
+    assert load_jsonfile_from_s3(bucket, 'records.json', object_cache=cache) is records
+    assert load_jsonfile_from_s3(bucket, 'records.json', object_cache=cache, compressed=False) is records
+
+    save_jsonfile_to_s3(bucket, 'records.json', [{'a': 2}], compress=True)
+    cache.invalidate(TEST_BUCKET, 'records.json')
+    assert load_jsonfile_from_s3(bucket, 'records.json', object_cache=cache, compressed=True) == [{'a': 2}]
+    with pytest.raises(ValueError):
+        # the compressed records aren't returned for a load without decompression
+        load_jsonfile_from_s3(bucket, 'records.json', object_cache=cache)
@@ -0,0 +1,77 @@
+from datetime import date
+
+import boto
+import moto
+import pytest
+
+from aws_utils.s3 import listing
+from aws_utils.s3.partitions import find_nested_partitions, get_latest_partitions, get_partitions_in_range, \
+    has_partitions, iter_partitions
+
+TEST_BUCKET = 'partitions-test'
+KEYS = [
+    'data/year=2016/month=12/day=31/part-00000',
+    'data/year=2017/month=01/day=01/part-00000',
+    'data/year=2017/month=01/day=02/part-00000',
+    'data/year=2017/month=01/day=02/part-00001',
+    'data/year=2017/month=02/day=10',
+    'data/year=2017/month=03/_SUCCESS',
+    'data/year=2018/_SUCCESS',
+    'data/other/year=2019/month=01/day=01/part-00000',
+]
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+        for name in KEYS:
+            bucket.new_key(name).set_contents_from_string('data')
+        yield bucket
+
+
+def test_iter_partitions(bucket):
+    expected = [date(2016, 12, 31), date(2017, 1, 1), date(2017, 1, 2), date(2017, 2, 10)]
+    assert list(iter_partitions(bucket, 'data/')) == expected
+    assert list(iter_partitions(bucket, 'data', reverse=True)) == expected[::-1]
+    assert list(iter_partitions(bucket, 'missing/')) == []
+
+
+def test_get_latest_partitions_skips_empty_years_and_months(bucket):
+    assert get_latest_partitions(bucket, 'data/') == [date(2017, 2, 10)]
+    assert get_latest_partitions(bucket, 'data/', count=3) == [date(2017, 2, 10), date(2017, 1, 2), date(2017, 1, 1)]
+    assert get_latest_partitions(bucket, 'data/', count=10)[-1] == date(2016, 12, 31)
+
+
+def test_get_latest_partition_lists_only_needed_prefixes(bucket, monkeypatch):
+    listed = []
+    iter_pages = listing.iter_pages
+
+    def recording_iter_pages(bucket, prefix, **kwargs):
+        listed.append(prefix)
+        return iter_pages(bucket, prefix, **kwargs)
+
+    monkeypatch.setattr(listing, 'iter_pages', recording_iter_pages)
+    get_latest_partitions(bucket, 'data/')
+    assert listed == ['data/', 'data/year=2018/', 'data/year=2017/', 'data/year=2017/month=03/',
+                      'data/year=2017/month=02/']
+
+
+def test_has_partitions(bucket):
+    assert has_partitions(bucket, 'data/')
+    assert has_partitions(bucket, 'data/other')
+    assert not has_partitions(bucket, '')
+    assert not has_partitions(bucket, 'data/year=2017/')
+
+
+def test_find_nested_partitions():
+    assert list(find_nested_partitions(KEYS[3:])) == [date(2017, 1, 2), date(2017, 2, 10), date(2019, 1, 1)]
+
+
+def test_get_partitions_in_range(bucket):
+    assert get_partitions_in_range(bucket, 'data/', date(2017, 1, 2), date(2017, 12, 31)) == \
+        [date(2017, 1, 2), date(2017, 2, 10)]
+    assert get_partitions_in_range(bucket, 'data/', date(2016, 12, 31), date(2016, 12, 31)) == [date(2016, 12, 31)]
+    assert get_partitions_in_range(bucket, 'data/', date(2015, 1, 1), date(2015, 12, 31)) == []
+    with pytest.raises(ValueError):
+        get_partitions_in_range(bucket, 'data/', date(2017, 1, 2), date(2017, 1, 1))
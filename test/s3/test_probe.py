@@ -0,0 +1,68 @@
+import boto
+import moto
+import pytest
+
+from aws_utils.s3.probe import find_first_key
+from aws_utils.s3.s3_utils import path_contains_data, paths_contain_data
+
+TEST_BUCKET = 'probe-test'
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+        bucket.new_key('day=01/_SUCCESS').set_contents_from_string('')
+        for i in range(150):
+            bucket.new_key('day=01/empty-{:03}.gz'.format(i)).set_contents_from_string('')
+        bucket.new_key('day=01/part-00000.gz').set_contents_from_string('data')
+        bucket.new_key('day=02/part-00000.txt').set_contents_from_string('data')
+        bucket.new_key('day=03/_SUCCESS').set_contents_from_string('')
+        yield bucket
+
+
+@pytest.fixture
+def page_sizes(bucket, monkeypatch):
+    sizes = []
+    get_all_keys = bucket.get_all_keys
+
+    def recording_get_all_keys(**kwargs):
+        sizes.append(kwargs['max_keys'])
+        return get_all_keys(**kwargs)
+
+    monkeypatch.setattr(bucket, 'get_all_keys', recording_get_all_keys)
+    return sizes
+
+
+def test_find_first_key_stops_at_first_match(bucket, page_sizes):
+    assert find_first_key(bucket, 'day=').name == 'day=01/_SUCCESS'
+    assert page_sizes == [10]
+
+
+def test_find_first_key_grows_page_size(bucket, page_sizes):
+    key = find_first_key(bucket, 'day=01/', lambda k: k.size > 0)
+    assert key.name == 'day=01/part-00000.gz'
+    assert page_sizes == [10, 100, 1000]
+
+
+def test_find_first_key_no_match(bucket, page_sizes):
+    assert find_first_key(bucket, 'day=01/', lambda k: k.size > 10, max_page_size=100) is None
+    assert page_sizes == [10, 100, 100]
+    assert find_first_key(bucket, 'day=04/') is None
+
+
+def test_path_contains_data(bucket):
+    assert path_contains_data(bucket, 'day=01/')
+    assert path_contains_data(bucket, 'day=01/', file_extension='.gz')
+    assert not path_contains_data(bucket, 'day=01/', min_file_size=4)
+    assert not path_contains_data(bucket, 'day=02/', file_extension='.gz')
+    assert not path_contains_data(bucket, 'day=03/')
+
+
+def test_paths_contain_data(bucket):
+    paths = ['day=01/', 'day=02/', 'day=03/', 'day=04/']
+    assert paths_contain_data(bucket, paths, num_workers=1) == \
+        {'day=01/': True, 'day=02/': True, 'day=03/': False, 'day=04/': False}
+    assert paths_contain_data(bucket, paths, file_extension='.gz', num_workers=1) == \
+        {'day=01/': True, 'day=02/': False, 'day=03/': False, 'day=04/': False}
+    assert paths_contain_data(bucket, []) == {}
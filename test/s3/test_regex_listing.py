@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import re
+
+import boto
+import moto
+import pytest
+
+from aws_utils.s3 import regex_listing
+from aws_utils.s3.regex_listing import iter_matching_keys, literal_prefix
+from aws_utils.s3.s3_utils import fetch_s3_keys_by_regex_pattern, iter_s3_keys_by_regex_pattern
+
+TEST_BUCKET = 'regex-listing-test'
+KEYS = [
+    'output/_SUCCESS',
+    'output/part-00000.gz',
+    'output/part-00001.gz',
+    'output/part-00002.txt',
+    'output/parts & pieces/file 1.gz',
+    u'output/répertoire/part-00003.gz',
+    'outputs/part-00004.gz',
+]
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+        for name in KEYS:
+            bucket.new_key(name).set_contents_from_string('data')
+        yield bucket
+
+
+@pytest.fixture
+def listed_prefixes(monkeypatch):
+    prefixes = []
+    iter_pages = regex_listing.iter_pages
+
+    def recording_iter_pages(bucket, prefix, **kwargs):
+        prefixes.append(prefix)
+        return iter_pages(bucket, prefix, **kwargs)
+
+    monkeypatch.setattr(regex_listing, 'iter_pages', recording_iter_pages)
+    return prefixes
+
+
+@pytest.mark.parametrize(('pattern', 'flags', 'expected'), [
+    (r'^output/part-\d+$', 0, 'output/part-'),
+    (r'\Aoutput/(part)s?', 0, 'output/'),
+    (r'^outputs?/', 0, 'output'),
+    (r'^output+/', 0, 'output'),
+    (r'^out{2}', 0, 'ou'),
+    (r'^output/part-\d+|^input/', 0, None),
+    (r'^output/[|]part', 0, 'output/'),
+    (r'^out put', re.VERBOSE, ''),
+    (b'^output/part-', 0, b'output/part-'),
+    (r'^output/(a|b)', 0, 'output/'),
+    (r'^output\.gz', 0, 'output.gz'),
+    (r'part-\d+', 0, None),
+    (r'^output', re.IGNORECASE, None),
+    (r'^output', re.MULTILINE, None),
+    (r'^.*', 0, ''),
+])
+def test_literal_prefix(pattern, flags, expected):
+    assert literal_prefix(re.compile(pattern, flags)) == expected
+
+
+def test_iter_matching_keys(bucket, listed_prefixes):
+    keys = list(iter_matching_keys(bucket, 'output/', re.compile(r'part-\d+\.gz$'), page_size=2))
+    assert [key.name for key in keys] == ['output/part-00000.gz', 'output/part-00001.gz',
+                                          u'output/répertoire/part-00003.gz']
+    assert keys[0].size == 4
+    assert keys[0].etag == bucket.get_key('output/part-00000.gz').etag
+    assert keys[0].get_contents_as_string() == b'data'
+    assert listed_prefixes == ['output/']
+
+
+def test_iter_matching_keys_narrows_listing_to_literal_prefix(bucket, listed_prefixes):
+    pattern = re.compile(r'^output/parts & pieces/.*\.gz$')
+    assert [key.name for key in iter_matching_keys(bucket, 'output/', pattern)] == ['output/parts & pieces/file 1.gz']
+    assert [key.name for key in iter_matching_keys(bucket, 'output/parts', re.compile(r'^output/'))] == \
+        ['output/parts & pieces/file 1.gz']
+    assert list(iter_matching_keys(bucket, 'output/', re.compile(r'^outputs/'))) == []
+    assert listed_prefixes == ['output/parts & pieces/', 'output/parts']
+
+
+def test_fetch_s3_keys_by_regex_pattern(bucket):
+    pattern = re.compile(r'^output/part-\d+')
+    assert [key.name for key in fetch_s3_keys_by_regex_pattern(bucket, 'output/', pattern)] == \
+        ['output/part-00000.gz', 'output/part-00001.gz', 'output/part-00002.txt']
+
+    keys = iter_s3_keys_by_regex_pattern(bucket, 'output', re.compile(r'\d{5}'))
+    assert next(keys).name == 'output/part-00000.gz'
+    assert len(list(keys)) == 4
@@ -10,6 +10,7 @@ try:
 except ImportError:
     import pickle
 
+from aws_utils.s3 import s3_utils
 from aws_utils.s3.s3_utils import merge_part_files, get_from_s3, partition_list, load_pickle_from_s3, file_size, \
     path_contains_data, save_to_s3, \
     setup_bucket, delete_contents_of_s3_directory, get_contents_of_directory, rename_keys_on_s3, rename_s3_key, \
@@ -76,6 +77,45 @@ def test_merge_files_ordering(bucket):
     assert merged == desired_content, "Content not matching"
 
 
+@moto.mock_s3()
+def test_merge_part_files_callbacks_get_boto_keys():
+    bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+    for name in ('a.gz', 'b.gz', 'c.txt'):
+        save_to_s3(bucket, 'parts/' + name, name * 3)
+    listed = []
+
+    def list_key(key):
+        listed.append(key)
+        return key.name.endswith('.gz')
+
+    merge_part_files(bucket, 'parts/', bucket, 'merged', list_key=list_key,
+                     sort_key=lambda key: key.key, num_workers=1)
+
+    assert all(isinstance(key, boto.s3.key.Key) and key.bucket is bucket for key in listed)
+    assert [(key.name, key.size, key.etag) for key in listed] == [
+        (k.name, k.size, k.etag) for k in (bucket.get_key('parts/' + name) for name in ('a.gz', 'b.gz', 'c.txt'))]
+    assert get_from_s3(bucket, 'merged') == b'b.gzb.gzb.gza.gza.gza.gz'
+
+
+@moto.mock_s3()
+def test_merge_part_files_only_builds_merged_keys(monkeypatch):
+    bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+    for name in ('a.gz', 'b.gz', 'c.txt'):
+        save_to_s3(bucket, 'parts/' + name, name * 3)
+    built = []
+    to_key = s3_utils._to_key
+
+    def _to_key(bucket, record):
+        built.append(record.name)
+        return to_key(bucket, record)
+
+    monkeypatch.setattr(s3_utils, '_to_key', _to_key)
+    merge_part_files(bucket, 'parts/', bucket, 'merged', num_workers=1)
+
+    assert built == ['parts/a.gz', 'parts/b.gz']
+    assert get_from_s3(bucket, 'merged') == b'a.gza.gza.gzb.gzb.gzb.gz'
+
+
 @pytest.mark.parametrize(('input', 'expected'), [
     ([Key('a', 10), Key('b', 20), Key('c', 50), Key('d', 60)],
      [[Key('a', 10), Key('b', 20), Key('c', 50)], Key('d', 60)]),
@@ -213,6 +253,41 @@ def test_delete_contents_of_s3_directory_should_fail_on_root():
     assert len(get_contents_of_directory(root_path, bucket=test_bucket)) == 0
 
 
+@moto.mock_s3
+def test_delete_contents_of_s3_directory_dry_run():
+    test_bucket = 'test_bucket'
+    root_path = 'my/test/root/path/is/here'
+
+    boto.connect_s3().create_bucket(test_bucket)
+    for i in range(5):
+        _create_file(root_path + '/' + str(i), bucket_name=test_bucket)
+    _create_file('my/test/root/path/is/not/here', bucket_name=test_bucket)
+
+    stats = delete_contents_of_s3_directory(root_path, bucket_name=test_bucket, dry_run=True)
+
+    assert stats == {'listed': 5, 'deleted': 0, 'errors': []}
+    assert len(get_contents_of_directory(root_path, bucket=test_bucket)) == 5
+
+    stats = delete_contents_of_s3_directory(root_path, bucket_name=test_bucket)
+
+    assert stats == {'listed': 5, 'deleted': 5, 'errors': []}
+    assert get_contents_of_directory('my/test/root/path/is/', bucket=test_bucket) == ['my/test/root/path/is/not/here']
+
+
+
+@moto.mock_s3
+def test_delete_path_in_batches(monkeypatch):
+    monkeypatch.setattr(s3_utils, 'DELETE_BATCH_SIZE', 3)
+    bucket = boto.connect_s3().create_bucket('mybucket')
+    for i in range(10):
+        bucket.new_key('some-path/file%d' % i).set_contents_from_string('Some content')
+    bucket.new_key('other-path/file').set_contents_from_string('Some content')
+
+    errors = s3_utils.delete_path(bucket, 'some-path', num_workers=1)
+
+    assert errors == []
+    assert [k.name for k in bucket.list()] == ['other-path/file']
+
 @moto.mock_s3()
 def test_boto3_rename_keys_on_s3(boto3_client):
     mock_bucket = TEST_BUCKET + 'test'
@@ -339,7 +414,11 @@ def test_get_s3_keys_by_regex_no_files():
     ('test/', ['year=2017/month=01/day=02', 'year=2016/month=01/file'], datetime.date(2017, 1, 2)),
     ('test/', ['year=2017/month=01/day=02'], datetime.date(2017, 1, 2)),
     ('test/', ['year=2017/month=01', 'year=2016/day=30'], None),
-    ('test/', ['year=2017/month=01/random_filename'], None)
+    ('test/', ['year=2017/month=01/random_filename'], None),
+    # the year= folders are deeper than the given path
+    ('test/', ['partner=1/year=2017/month=01/day=02/part-00000', 'partner=2/year=2017/month=03/day=01'],
+     datetime.date(2017, 3, 1)),
+    ('', ['test/year=2016/month=12/day=31/part-00000', 'test/random_filename'], datetime.date(2016, 12, 31)),
 ])
 def test_get_latest_year_month_day_prefix(prefix, content, expected):
     test_bucket = TEST_BUCKET + 'test'
@@ -0,0 +1,105 @@
+import io
+import pickle
+import sys
+
+import boto
+import moto
+import pytest
+
+from aws_utils.s3 import serialization
+from aws_utils.s3.s3_utils import load_pickle_from_s3, save_pickle_to_s3, save_to_s3
+from aws_utils.s3.serialization import GZIP, LZ4, ZSTD, ChunkReader, dump, load_chunks, loads
+
+TEST_BUCKET = 'serialization-test'
+DATA = {'ints': list(range(1000)), 'text': u'caf\xe9', 'blob': b'\x00\x01' * 5000, 'nested': [{'a': None}]}
+COMPRESSIONS = [
+    None,
+    GZIP,
+    pytest.param(ZSTD, marks=pytest.mark.skipif(serialization.zstandard is None, reason='needs zstandard')),
+    pytest.param(LZ4, marks=pytest.mark.skipif(serialization.lz4_frame is None, reason='needs lz4')),
+]
+PROTOCOLS = [0, 2, pytest.param(5, marks=pytest.mark.skipif(sys.version_info < (3, 8), reason='needs python 3.8'))]
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        yield boto.connect_s3().create_bucket(TEST_BUCKET)
+
+
+def dumps(obj, **kwargs):
+    f = io.BytesIO()
+    dump(obj, f, **kwargs)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+@pytest.mark.parametrize('protocol', PROTOCOLS)
+def test_dump_and_load_chunks(compression, protocol):
+    data = dumps(DATA, protocol=protocol, compression=compression)
+    chunks = [data[i:i + 100] for i in range(0, len(data), 100)]
+    assert load_chunks(chunks) == DATA
+
+
+def test_compression_is_detected():
+    assert dumps(DATA, compression=GZIP).startswith(serialization.GZIP_MAGIC)
+    assert len(dumps(DATA, compression=GZIP)) < len(dumps(DATA))
+    # pickles saved before compression was supported
+    assert loads(pickle.dumps(DATA)) == DATA
+    with pytest.raises(ValueError):
+        dumps(DATA, compression='bz2')
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS[1:])
+@pytest.mark.parametrize('protocol', PROTOCOLS)
+@pytest.mark.parametrize('cut', [1, 100])
+def test_truncated_pickle(compression, protocol, cut):
+    # cutting 1 byte leaves the pickle whole but not the end of the compressed stream
+    with pytest.raises(EOFError):
+        loads(dumps(DATA, protocol=protocol, compression=compression)[:-cut])
+
+
+def test_chunk_reader():
+    reader = ChunkReader([b'ab', b'', b'c\nde', b'f\n', b'gh'])
+    assert reader.peek(4) == b'abc\n'
+    assert reader.read(1) == b'a'
+    assert reader.readline() == b'bc\n'
+    buf = bytearray(2)
+    assert reader.readinto(buf) == 2
+    assert buf == bytearray(b'de')
+    assert reader.readline() == b'f\n'
+    assert reader.readline() == b'gh'
+    assert reader.read(1) == b''
+
+    reader = ChunkReader([b'abc', b'def', b'ghi'])
+    buf = bytearray(5)
+    assert reader.readinto(buf) == 5
+    assert buf == bytearray(b'abcde')
+    assert reader.read() == b'fghi'
+
+
+@pytest.mark.parametrize('compression', [None, GZIP])
+def test_load_chunks_of_large_object(compression):
+    obj = {'blob': b'\x01\x02\x03' * (2 * 1024 ** 2), 'ints': list(range(100000))}
+    data = dumps(obj, protocol=2, compression=compression)
+    # small chunks, every large read spans thousands of them
+    chunks = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+
+    assert load_chunks(chunks) == obj
+
+
+def test_save_and_load_pickle(bucket):
+    save_pickle_to_s3(bucket, 'plain.pkl', DATA)
+    # still readable without this module
+    assert pickle.loads(bucket.get_key('plain.pkl').get_contents_as_string()) == DATA
+    assert load_pickle_from_s3(bucket, 'plain.pkl') == DATA
+
+    save_pickle_to_s3(bucket, 'compressed.pkl', DATA, protocol=serialization.HIGHEST_PROTOCOL, compression=GZIP)
+    # loaded as a stream of ranges
+    assert serialization.load_from_s3(bucket, 'compressed.pkl', part_size=100, num_workers=1) == DATA
+    assert load_pickle_from_s3(bucket, 'compressed.pkl') == DATA
+
+
+def test_load_pickle_saved_by_python2(bucket):
+    save_to_s3(bucket, 'py2.pkl', b"(dp0\nS'text'\np1\nS'caf\\xc3\\xa9'\np2\ns.")
+    assert load_pickle_from_s3(bucket, 'py2.pkl') == {'text': u'caf\xe9' if sys.version_info[0] >= 3 else 'caf\xc3\xa9'}
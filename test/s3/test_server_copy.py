@@ -0,0 +1,82 @@
+import json
+
+import boto3
+import moto
+import pytest
+
+from aws_utils.s3 import server_copy
+from aws_utils.s3.s3_utils import rename_keys_on_s3
+
+TEST_BUCKET = 'server-copy-test'
+TEST_REGION = 'us-east-1'
+
+
+@pytest.fixture
+def client():
+    with moto.mock_s3():
+        client = boto3.client('s3', region_name=TEST_REGION)
+        client.create_bucket(Bucket=TEST_BUCKET)
+        yield client
+
+
+def list_keys(client, prefix=''):
+    return {key['Key'] for key in client.list_objects_v2(Bucket=TEST_BUCKET, Prefix=prefix).get('Contents', [])}
+
+
+def read(client, key):
+    return client.get_object(Bucket=TEST_BUCKET, Key=key)['Body'].read()
+
+
+def test_copy_key(client):
+    client.put_object(Bucket=TEST_BUCKET, Key='src', Body=b'abc')
+    server_copy.copy_key(client, TEST_BUCKET, 'src', TEST_BUCKET, 'dst')
+    assert read(client, 'dst') == b'abc'
+    assert read(client, 'src') == b'abc'
+
+
+def test_copy_key_multipart(client, monkeypatch):
+    data = b''.join(bytes(bytearray([i])) * (2 ** 20) for i in range(12))
+    client.put_object(Bucket=TEST_BUCKET, Key='src', Body=data)
+    monkeypatch.setattr(server_copy, 'MULTIPART_COPY_THRESHOLD', 2 ** 20)
+
+    server_copy.copy_key(client, TEST_BUCKET, 'src', TEST_BUCKET, 'dst', part_size=5 * 2 ** 20, num_workers=1)
+    assert read(client, 'dst') == data
+    assert client.list_multipart_uploads(Bucket=TEST_BUCKET).get('Uploads', []) == []
+
+
+def test_delete_keys(client):
+    for key in ('a', 'b', 'c'):
+        client.put_object(Bucket=TEST_BUCKET, Key=key, Body=b'x')
+    assert server_copy.delete_keys(client, TEST_BUCKET, ['a', 'b']) == []
+    assert list_keys(client) == {'c'}
+
+
+def test_rename_keys_on_s3_resumes_from_progress_file(client, tmpdir):
+    for key in ('in/a', 'in/b', 'in/c'):
+        client.put_object(Bucket=TEST_BUCKET, Key=key, Body=key.encode('utf-8'))
+    # a previous run copied in/a to out/a but was interrupted before deleting it
+    client.copy_object(CopySource={'Bucket': TEST_BUCKET, 'Key': 'in/a'}, Bucket=TEST_BUCKET, Key='out/a')
+    progress_file = str(tmpdir.join('progress'))
+    with open(progress_file, 'w') as f:
+        f.write(json.dumps(['in/a', 'out/a']) + '\n')
+
+    rename_keys_on_s3(TEST_BUCKET, TEST_REGION, '', lambda key: key.replace('in/', 'out/'),
+                      filter_keys_func=lambda key: False, num_workers=1, progress_file=progress_file)
+
+    assert list_keys(client) == {'out/a', 'out/b', 'out/c'}
+    assert read(client, 'out/b') == b'in/b'
+    with open(progress_file) as f:
+        assert sorted(json.loads(line)[0] for line in f) == ['in/a', 'in/b', 'in/c']
+
+
+def test_rename_keys_on_s3_doesnt_rename_its_own_copies(client):
+    keys = ['in/{:03}'.format(i) for i in range(20)]
+    for key in keys:
+        client.put_object(Bucket=TEST_BUCKET, Key=key, Body=key.encode('utf-8'))
+
+    # the copies sort right after their source, in the part of the listing still to come
+    rename_keys_on_s3(TEST_BUCKET, TEST_REGION, 'in/', lambda key: key + '.renamed',
+                      filter_keys_func=lambda key: False, num_workers=4)
+
+    assert list_keys(client) == {key + '.renamed' for key in keys}
+    assert read(client, 'in/007.renamed') == b'in/007'
@@ -0,0 +1,131 @@
+import gzip
+import os
+from io import BytesIO
+
+import boto
+import moto
+import pytest
+
+from aws_utils.s3.s3_utils import get_from_s3, load_jsonfile_from_s3, save_jsonfile_to_s3, save_to_s3
+from aws_utils.s3.streaming import S3Writer, gunzip_chunks, iter_lines_from_s3, split_lines, stream_to_s3
+from aws_utils.s3.transfer import MIN_PART_SIZE
+
+TEST_BUCKET = 'streaming-test-bucket'
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        yield boto.connect_s3().create_bucket(TEST_BUCKET)
+
+
+def _gzip(data):
+    out = BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def _gunzip(data):
+    with gzip.GzipFile(fileobj=BytesIO(data), mode='rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('data', [
+    u'some text',
+    b'some bytes',
+    BytesIO(b'a file like object'),
+    iter([u'an ', b'iterator ', u'of chunks']),
+])
+def test_save_to_s3_compressed_inputs(bucket, data):
+    save_to_s3(bucket, 'compressed.gz', data, compress=True)
+
+    content = _gunzip(get_from_s3(bucket, 'compressed.gz'))
+    assert content in (b'some text', b'some bytes', b'a file like object', b'an iterator of chunks')
+
+
+def test_stream_to_s3_sends_parts_while_compressing(bucket):
+    # random data does not compress so we end up with more than one part
+    chunks = [os.urandom(1024 ** 2) for _ in range(7)]
+
+    stream_to_s3(bucket, 'streamed.gz', iter(chunks), compress=True, part_size=MIN_PART_SIZE, num_workers=1)
+
+    assert bucket.get_key('streamed.gz').etag.strip('"').endswith('-2')
+    assert get_from_s3(bucket, 'streamed.gz', compressed=True) == b''.join(chunks)
+
+
+def test_s3_writer_splits_writes_in_parts(bucket):
+    data = os.urandom(3 * MIN_PART_SIZE + 10)
+
+    with S3Writer(bucket, 'split', part_size=MIN_PART_SIZE, num_workers=1) as writer:
+        # a write holding several parts, then one completing a part
+        writer.write(data[:2 * MIN_PART_SIZE + 5])
+        assert len(writer._buffer) == 5
+        writer.write(data[2 * MIN_PART_SIZE + 5:])
+
+    assert bucket.get_key('split').etag.strip('"').endswith('-4')
+    assert get_from_s3(bucket, 'split') == data
+
+
+def test_s3_writer_abort_saves_nothing(bucket):
+    with pytest.raises(RuntimeError):
+        with S3Writer(bucket, 'aborted', part_size=MIN_PART_SIZE) as writer:
+            writer.write(b'x' * (MIN_PART_SIZE + 1))
+            raise RuntimeError('failed while producing data')
+
+    assert bucket.get_key('aborted') is None
+    assert not bucket.get_all_multipart_uploads()
+
+
+@pytest.mark.parametrize(('chunks', 'expected'), [
+    ([], []),
+    ([b'one line'], [b'one line']),
+    ([b'first\nsec', b'on', b'd\r\nthird\n'], [b'first', b'second', b'third']),
+    ([b'\n\n'], [b'', b'']),
+])
+def test_split_lines(chunks, expected):
+    assert list(split_lines(chunks)) == expected
+
+
+def test_gunzip_chunks_handles_concatenated_members():
+    compressed = _gzip(b'first member\n') + _gzip(b'second member\n')
+    chunks = [compressed[i:i + 3] for i in range(0, len(compressed), 3)]
+
+    assert b''.join(gunzip_chunks(chunks, chunk_size=4)) == b'first member\nsecond member\n'
+
+
+@pytest.mark.parametrize('chunk_size', [4, 256 * 1024])
+def test_gunzip_chunks_member_ending_on_a_chunk_boundary(chunk_size):
+    # the first member decompresses to exactly two chunks, then another member follows in the same input
+    first = b'a' * (2 * chunk_size)
+    compressed = _gzip(first) + _gzip(b'b' * 10)
+
+    assert b''.join(gunzip_chunks([compressed], chunk_size=chunk_size)) == first + b'b' * 10
+
+
+@pytest.mark.parametrize('cut', [1, 8, 50])
+def test_gunzip_chunks_truncated(cut):
+    truncated = _gzip(os.urandom(50000) * 2)[:-cut]
+    chunks = [truncated[i:i + 1000] for i in range(0, len(truncated), 1000)]
+
+    with pytest.raises(EOFError):
+        b''.join(gunzip_chunks(chunks))
+    assert b''.join(gunzip_chunks([b''])) == b''
+
+
+@pytest.mark.parametrize('compressed', [True, False])
+def test_iter_lines_from_s3(bucket, compressed):
+    save_to_s3(bucket, 'lines', u'caf\xe9\nsecond line\n', compress=compressed)
+
+    assert list(iter_lines_from_s3(bucket, 'lines', compressed=compressed)) == [u'caf\xe9', u'second line']
+
+
+def test_load_jsonfile_from_s3_streaming(bucket):
+    items = [{'a': 1}, {'b': [1, 2]}, 'text']
+    save_jsonfile_to_s3(bucket, 'items.json.gz', items, compress=True)
+
+    records = load_jsonfile_from_s3(bucket, 'items.json.gz', stream=True, compressed=True)
+
+    assert not isinstance(records, list)
+    assert list(records) == items
+    assert load_jsonfile_from_s3(bucket, 'items.json.gz', compressed=True) == items
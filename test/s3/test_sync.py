@@ -0,0 +1,155 @@
+import os
+
+import boto
+import boto3
+import moto
+import pytest
+
+from aws_utils.s3 import sync
+from aws_utils.s3.listing import KeyRecord
+from aws_utils.s3.s3_utils import sync_directory
+from aws_utils.s3.sync import COPY, DELETE, SyncAction, is_modified, plan_sync, sync_local_to_s3, \
+    sync_s3_to_local, sync_s3_to_s3
+
+TEST_BUCKET = 'sync-test'
+OTHER_BUCKET = 'sync-test-other'
+FILES = {
+    'models/latest/model.pkl': b'model',
+    'models/latest/vocab/words.txt': b'a b c',
+    'models/latest/vocab/ngrams.txt': b'ab bc',
+}
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        bucket = boto.connect_s3().create_bucket(TEST_BUCKET)
+        for name, content in FILES.items():
+            bucket.new_key(name).set_contents_from_string(content)
+        yield bucket
+
+
+@pytest.fixture
+def client(bucket):
+    return boto3.client('s3', region_name='us-east-1')
+
+
+def read_local(directory):
+    files = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            with open(os.path.join(root, filename), 'rb') as f:
+                files[os.path.relpath(os.path.join(root, filename), directory)] = f.read()
+    return files
+
+
+def read_s3(bucket, prefix):
+    return {key.name[len(prefix):]: key.get_contents_as_string() for key in bucket.list(prefix)}
+
+
+def test_is_modified():
+    record = KeyRecord('a', 4, '"abc"', '2017-05-30T12:00:00.000Z')
+    assert not is_modified(record, record)
+    assert is_modified(record, record._replace(size=5))
+    assert is_modified(record, record._replace(etag='"def"', last_modified='2017-05-31T12:00:00.000Z'))
+    assert not is_modified(record._replace(etag=None), record._replace(last_modified='2017-05-30T12:00:00.999Z'))
+    assert is_modified(record._replace(etag='"abc-2"', last_modified='2017-05-30T12:00:01.000Z'), record)
+
+
+def test_plan_sync():
+    old = KeyRecord('a', 4, None, '2017-05-30T12:00:00.000Z')
+    new = old._replace(last_modified='2017-05-31T12:00:00.000Z')
+    source = {'same': old, 'changed': new, 'added': old}
+    destination = {'same': old, 'changed': old, 'extra': old}
+
+    assert plan_sync(source, destination) == ([SyncAction(COPY, 'added', 4), SyncAction(COPY, 'changed', 4)], 1)
+    actions, skipped = plan_sync(source, destination, delete=True)
+    assert actions[-1] == SyncAction(DELETE, 'extra', 4)
+
+
+def test_sync_s3_to_local(bucket, tmpdir):
+    directory = str(tmpdir.join('models'))
+    progress = []
+    result = sync_s3_to_local(bucket, 'models/latest', directory, num_workers=1, progress=progress.append)
+    assert read_local(directory) == {os.path.join(*name.split('/')[2:]): content for name, content in FILES.items()}
+    assert (result.copied, result.deleted, result.skipped, result.bytes_copied) == (3, 0, 0, 15)
+    assert sorted(action.name for action in progress) == ['model.pkl', 'vocab/ngrams.txt', 'vocab/words.txt']
+
+    # downloaded files get the date of their key, so nothing is downloaded again
+    assert sync_s3_to_local(bucket, 'models/latest/', directory, num_workers=1).skipped == 3
+
+    bucket.new_key('models/latest/model.pkl').set_contents_from_string(b'model v2')
+    tmpdir.join('models', 'stale.txt').write('stale')
+    result = sync_s3_to_local(bucket, 'models/latest/', directory, delete=True, num_workers=1)
+    assert (result.copied, result.deleted, result.skipped) == (1, 1, 2)
+    assert tmpdir.join('models', 'model.pkl').read() == 'model v2'
+    assert not tmpdir.join('models', 'stale.txt').exists()
+
+
+def test_sync_s3_to_local_outside_of_directory(bucket, tmpdir, monkeypatch):
+    list_s3_files = sync.list_s3_files
+
+    def with_escaping_names(bucket, prefix):
+        files = list_s3_files(bucket, prefix)
+        for name in ('../escaped.txt', 'vocab/../../escaped.txt'):
+            files[name] = KeyRecord(prefix + name, 4, None, '2017-05-30T12:00:00.000Z')
+        return files
+
+    monkeypatch.setattr(sync, 'list_s3_files', with_escaping_names)
+    directory = str(tmpdir.join('models'))
+    result = sync_s3_to_local(bucket, 'models/latest/', directory, num_workers=1)
+    assert result.copied == 3
+    assert sorted(os.listdir(str(tmpdir))) == ['models']
+
+
+def test_sync_local_to_s3(bucket, client, tmpdir):
+    tmpdir.join('a.txt').write('a')
+    tmpdir.join('sub', 'b.txt').write('bb', ensure=True)
+    bucket.new_key('backup/extra.txt').set_contents_from_string('extra')
+
+    result = sync_local_to_s3(str(tmpdir), bucket, 'backup', num_workers=1)
+    assert (result.copied, result.deleted, result.bytes_copied) == (2, 0, 3)
+    assert read_s3(bucket, 'backup/') == {'a.txt': b'a', 'sub/b.txt': b'bb', 'extra.txt': b'extra'}
+
+    result = sync_local_to_s3(str(tmpdir), bucket, 'backup/', delete=True, checksum=True, client=client,
+                              num_workers=1)
+    assert (result.copied, result.deleted, result.skipped) == (0, 1, 2)
+    assert read_s3(bucket, 'backup/') == {'a.txt': b'a', 'sub/b.txt': b'bb'}
+
+    # same size and older than the key, only the checksum tells the file changed
+    tmpdir.join('a.txt').write('c')
+    os.utime(str(tmpdir.join('a.txt')), (0, 0))
+    assert sync_local_to_s3(str(tmpdir), bucket, 'backup/', num_workers=1).copied == 0
+    assert sync_local_to_s3(str(tmpdir), bucket, 'backup/', checksum=True, num_workers=1).copied == 1
+    assert read_s3(bucket, 'backup/')['a.txt'] == b'c'
+
+
+def test_sync_local_to_s3_missing_directory(bucket, client, tmpdir):
+    bucket.new_key('backup/a.txt').set_contents_from_string('a')
+
+    with pytest.raises(IOError):
+        sync_local_to_s3(str(tmpdir.join('missing')), bucket, 'backup/', delete=True, client=client, num_workers=1)
+    assert read_s3(bucket, 'backup/') == {'a.txt': b'a'}
+
+
+def test_sync_s3_to_s3(bucket, client):
+    other = boto.connect_s3().create_bucket(OTHER_BUCKET)
+    other.new_key('copy/extra').set_contents_from_string('extra')
+
+    result = sync_s3_to_s3(bucket, 'models/latest/', other, 'copy/', delete=True, client=client, num_workers=1)
+    assert (result.copied, result.deleted, result.skipped) == (3, 1, 0)
+    assert read_s3(other, 'copy/') == read_s3(bucket, 'models/latest/')
+
+    # copies have the etag of their source
+    result = sync_s3_to_s3(bucket, 'models/latest/', other, 'copy/', client=client, num_workers=1)
+    assert (result.copied, result.skipped) == (0, 3)
+
+
+def test_sync_directory(bucket, tmpdir):
+    directory = str(tmpdir)
+    assert sync_directory('s3n://{}/models/latest/'.format(TEST_BUCKET), directory, num_workers=1).copied == 3
+    tmpdir.join('new.txt').write('new')
+    assert sync_directory(directory, 's3n://{}/models/latest/'.format(TEST_BUCKET), num_workers=1).copied == 1
+    assert bucket.get_key('models/latest/new.txt').get_contents_as_string() == b'new'
+    with pytest.raises(ValueError):
+        sync_directory(directory, directory)
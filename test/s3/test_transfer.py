@@ -0,0 +1,207 @@
+import errno
+import hashlib
+import os
+import socket
+
+import boto
+import moto
+import pytest
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+
+from aws_utils.s3 import transfer
+from aws_utils.s3.s3_utils import get_from_s3, save_to_s3, upload_file
+from aws_utils.s3.transfer import MIN_PART_SIZE, BufferPool, MemoryViewReader, MultipartUpload, ObjectChangedError, \
+    download_to_buffer, download_to_file, get_part_size, is_retryable_part_error, iter_ranges, read_key_into
+
+TEST_BUCKET = 'transfer-test-bucket'
+BIG_CONTENT = b'0123456789' * (MIN_PART_SIZE // 10) + b'tail'
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        yield boto.connect_s3().create_bucket(TEST_BUCKET)
+
+
+@pytest.mark.parametrize(('total_size', 'part_size', 'expected'), [
+    (10, 1, MIN_PART_SIZE),
+    (10 * MIN_PART_SIZE, 2 * MIN_PART_SIZE, 2 * MIN_PART_SIZE),
+    (transfer.MAX_PARTS * 3 * MIN_PART_SIZE, MIN_PART_SIZE, 3 * MIN_PART_SIZE),
+])
+def test_get_part_size(total_size, part_size, expected):
+    assert get_part_size(total_size, part_size) == expected
+
+
+def test_get_part_size_too_big():
+    with pytest.raises(ValueError):
+        get_part_size(transfer.MAX_PARTS * transfer.MAX_PART_SIZE + 1)
+
+
+@pytest.mark.parametrize(('exception', 'expected'), [
+    (S3ResponseError(500, 'Internal Error'), True),
+    (S3ResponseError(400, 'Bad Request', '<Error><Code>RequestTimeout</Code></Error>'), True),
+    (S3ResponseError(403, 'Forbidden'), False),
+    (socket.timeout(), True),
+    (socket.error(errno.ECONNRESET, 'Connection reset by peer'), True),
+    (IOError(errno.ENOENT, 'No such file or directory'), False),
+    (IOError('big/file changed size, expected 10 bytes'), False),
+])
+def test_is_retryable_part_error(exception, expected):
+    assert is_retryable_part_error(exception) == expected
+
+
+def test_save_to_s3_above_threshold_uses_multipart(bucket):
+    save_to_s3(bucket, 'big/file', BIG_CONTENT, multipart_threshold=MIN_PART_SIZE)
+
+    assert get_from_s3(bucket, 'big/file') == BIG_CONTENT
+    # multipart uploads have an etag suffixed with the number of parts
+    assert bucket.get_key('big/file').etag.strip('"').endswith('-1')
+
+
+def test_save_to_s3_sizes_text_once_encoded(bucket):
+    # fewer characters than the threshold, but more bytes in UTF-8
+    text = u'\xe9' * (MIN_PART_SIZE // 2 + 1)
+    save_to_s3(bucket, 'big/text', text, multipart_threshold=MIN_PART_SIZE)
+
+    assert get_from_s3(bucket, 'big/text') == text.encode('utf-8')
+    assert bucket.get_key('big/text').etag.strip('"').endswith('-1')
+
+
+def test_upload_file_above_threshold_uses_multipart(bucket, tmpdir):
+    local_file = tmpdir.join('big_file')
+    local_file.write(BIG_CONTENT, mode='wb')
+
+    upload_file(bucket, str(local_file), 'big/uploaded', multipart_threshold=MIN_PART_SIZE)
+
+    assert get_from_s3(bucket, 'big/uploaded') == BIG_CONTENT
+
+
+def test_multipart_upload_retries_failed_parts(bucket, monkeypatch):
+    calls = []
+    original = MultipartUpload._upload_bytes
+
+    def flaky_upload(self, part_num, data):
+        calls.append(part_num)
+        if len(calls) == 1:
+            raise S3ResponseError(500, 'Internal Error')
+        return original(self, part_num, data)
+
+    monkeypatch.setattr(MultipartUpload, '_upload_bytes', flaky_upload)
+    monkeypatch.setattr(transfer, 'PART_RETRY_WAIT_MS', 0)
+
+    with MultipartUpload(bucket, 'retried') as upload:
+        upload.add_part(b'some data')
+
+    assert calls == [1, 1]
+    assert get_from_s3(bucket, 'retried') == b'some data'
+
+
+def test_multipart_upload_is_aborted_on_failure(bucket, monkeypatch):
+    def failing_upload(self, part_num, data):
+        raise S3ResponseError(403, 'Forbidden')
+
+    monkeypatch.setattr(MultipartUpload, '_upload_bytes', failing_upload)
+
+    with pytest.raises(S3ResponseError):
+        with MultipartUpload(bucket, 'aborted') as upload:
+            upload.add_part(b'some data')
+
+    assert not bucket.get_all_multipart_uploads()
+    assert bucket.get_key('aborted') is None
+
+
+@pytest.mark.parametrize('content', [b'', b'small', b'0123456789' * 10 + b'x'])
+def test_download_to_buffer(bucket, content):
+    save_to_s3(bucket, 'to/download', content)
+
+    assert bytes(download_to_buffer(bucket, 'to/download', part_size=7, num_workers=1)) == content
+
+
+@pytest.mark.parametrize('content', [b'', b'small', b'0123456789' * 10 + b'x'])
+def test_iter_ranges(bucket, content):
+    save_to_s3(bucket, 'to/download', content)
+
+    chunks = list(iter_ranges(bucket, 'to/download', part_size=7, num_workers=1))
+    assert b''.join(chunks) == content
+    assert all(len(chunk) <= 7 for chunk in chunks)
+
+
+@pytest.mark.parametrize('content', [b'', b'small', b'0123456789' * 10 + b'x'])
+def test_download_to_file(bucket, tmpdir, content):
+    save_to_s3(bucket, 'to/download', content)
+    local_file = tmpdir.join('downloaded')
+
+    download_to_file(bucket, 'to/download', str(local_file), part_size=7, num_workers=1)
+
+    assert local_file.read(mode='rb') == content
+
+
+def test_ranges_of_overwritten_object(bucket, monkeypatch):
+    save_to_s3(bucket, 'to/download', b'0123456789' * 3)
+    original = Key.get_contents_as_string
+    if_match = []
+
+    def get_contents_as_string(self, headers=None, **kwargs):
+        # S3 answers 412 Precondition Failed to a GET whose If-Match isn't the etag of the object
+        if 'If-Match' in headers:
+            if_match.append(headers['If-Match'])
+            if headers['If-Match'] != self.bucket.get_key(self.name).etag:
+                raise S3ResponseError(412, 'Precondition Failed')
+        data = original(self, headers=headers, **kwargs)
+        # S3 sends the etag of the object with ranges, the mock doesn't
+        self.etag = self.bucket.get_key(self.name).etag
+        if headers['Range'].startswith('bytes=0-'):
+            save_to_s3(bucket, 'to/download', b'abcdefghij' * 3)
+        return data
+
+    monkeypatch.setattr(Key, 'get_contents_as_string', get_contents_as_string)
+
+    with pytest.raises(ObjectChangedError):
+        download_to_buffer(bucket, 'to/download', part_size=7, num_workers=1)
+    assert if_match == ['"{}"'.format(hashlib.md5(b'0123456789' * 3).hexdigest())]
+
+
+def test_memory_view_reader():
+    reader = MemoryViewReader(memoryview(bytearray(b'0123456789'))[2:8])
+
+    assert reader.read(3) == b'234'
+    assert reader.tell() == 3
+    assert reader.read() == b'567'
+    reader.seek(0, os.SEEK_END)
+    assert reader.tell() == 6
+    reader.seek(1)
+    assert reader.read(100) == b'34567'
+
+
+def test_buffer_pool_reuses_buffers():
+    pool = BufferPool(1)
+
+    with pool.buffer(10) as view:
+        view[:] = b'x' * 10
+    with pool.buffer(4) as view:
+        # same buffer, not reallocated nor cleared
+        assert view.tobytes() == b'xxxx'
+    with pool.buffer(20) as view:
+        assert len(view) == 20
+
+
+def test_read_key_into(bucket):
+    save_to_s3(bucket, 'to/read', b'some content')
+    buf = bytearray(b'..' + b' ' * 12 + b'..')
+
+    read_key_into(bucket, 'to/read', memoryview(buf)[2:14])
+    assert buf == bytearray(b'..some content..')
+
+    with pytest.raises(IOError):
+        read_key_into(bucket, 'to/read', memoryview(bytearray(5)))
+
+
+def test_multipart_upload_filled_parts(bucket):
+    def fill(view):
+        view[:] = b'filled'
+
+    with MultipartUpload(bucket, 'filled', num_workers=1) as upload:
+        upload.add_filled_part(fill, 6)
+
+    assert get_from_s3(bucket, 'filled') == b'filled'
@@ -0,0 +1,126 @@
+import hashlib
+
+import boto
+import moto
+import pytest
+
+from aws_utils.s3 import verify
+from aws_utils.s3.streaming import S3Writer
+from aws_utils.s3.s3_utils import PklError, save_pickle_to_s3, verify_s3_pkl, verify_s3_pkls
+from aws_utils.s3.transfer import DEFAULT_PART_SIZE, upload_string_multipart
+from aws_utils.s3.verify import CONTENT, ETAG, MIB, MISSING, SIZE, EtagWriter, candidate_part_sizes, verify_key, \
+    verify_keys
+
+TEST_BUCKET = 'verify-test'
+DATA = {'ints': list(range(1000)), 'text': u'caf\xe9'}
+
+
+@pytest.fixture
+def bucket():
+    with moto.mock_s3():
+        yield boto.connect_s3().create_bucket(TEST_BUCKET)
+
+
+def writer_of(data):
+    return lambda f: f.write(data)
+
+
+def test_etag_writer():
+    writer = EtagWriter([4])
+    for chunk in (b'abc', b'defghi', b'', b'j'):
+        writer.write(chunk)
+
+    assert writer.size == 10
+    assert writer.etag() == '"{}"'.format(hashlib.md5(b'abcdefghij').hexdigest())
+    digests = b''.join(hashlib.md5(part).digest() for part in (b'abcd', b'efgh', b'ij'))
+    assert writer.etag(4) == '"{}-3"'.format(hashlib.md5(digests).hexdigest())
+    with pytest.raises(KeyError):
+        writer.etag(5)
+
+
+def test_candidate_part_sizes():
+    assert candidate_part_sizes(10, 1) == [10]
+    assert candidate_part_sizes(11 * MIB, 3) == [-(-11 * MIB // 3), 4 * MIB, 5 * MIB]
+    for part_size in candidate_part_sizes(100 * MIB + 1, 7):
+        assert -(-(100 * MIB + 1) // part_size) == 7
+
+
+@pytest.mark.parametrize('size, parts', [(20 * MIB, 2), (33 * MIB, 3), (50 * MIB, 4)])
+def test_candidate_part_sizes_common_first(size, parts):
+    assert candidate_part_sizes(size, parts)[0] == DEFAULT_PART_SIZE
+    assert candidate_part_sizes(12 * MIB, 2)[0] == 8 * MIB
+
+
+def test_verify_key(bucket):
+    bucket.new_key('single').set_contents_from_string(b'some content')
+    data = b'x' * (11 * MIB)
+    upload_string_multipart(bucket, 'multipart', data, part_size=5 * MIB, num_workers=1)
+    assert bucket.get_key('multipart').etag.endswith('-3"')
+
+    assert verify_key(bucket, 'single', writer_of(b'some content')) == ('single', True, ETAG)
+    assert verify_key(bucket, 'single', writer_of(b'some kontent')) == ('single', False, CONTENT)
+    assert verify_key(bucket, 'single', writer_of(b'some kontent'), stream_fallback=False) == ('single', False, ETAG)
+    assert verify_key(bucket, 'single', writer_of(b'other')) == ('single', False, SIZE)
+    assert verify_key(bucket, 'missing', writer_of(b'')) == ('missing', False, MISSING)
+    assert verify_key(bucket, 'multipart', writer_of(data)) == ('multipart', True, ETAG)
+
+
+def test_verify_key_unknown_part_size(bucket, monkeypatch):
+    data = b'x' * (11 * MIB)
+    upload_string_multipart(bucket, 'multipart', data, part_size=5 * MIB, num_workers=1)
+    monkeypatch.setattr(verify, 'MAX_PART_SIZE_CANDIDATES', 1)
+
+    assert verify_key(bucket, 'multipart', writer_of(data)) == ('multipart', True, CONTENT)
+
+
+def test_verify_key_default_part_size(bucket, monkeypatch):
+    data = b'x' * (20 * MIB)
+    with S3Writer(bucket, 'written') as writer:
+        writer.write(data)
+    assert bucket.get_key('written').etag.endswith('-2"')
+
+    def fail(bucket, path):
+        raise AssertionError('{} was downloaded'.format(path))
+    monkeypatch.setattr(verify, '_stream_md5', fail)
+
+    assert verify_key(bucket, 'written', writer_of(data)) == ('written', True, ETAG)
+
+
+def test_verify_keys(bucket):
+    for name in ('a', 'b'):
+        bucket.new_key(name).set_contents_from_string(name * 10)
+
+    results = verify_keys(bucket, {'a': writer_of(b'a' * 10), 'b': writer_of(b'c' * 10), 'c': writer_of(b'')},
+                          num_workers=1)
+    assert {name: (result.ok, result.method) for name, result in results.items()} == {
+        'a': (True, ETAG), 'b': (False, CONTENT), 'c': (False, MISSING)}
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_verify_s3_pkl_checksum(bucket, compression):
+    save_pickle_to_s3(bucket, 'data.pkl', DATA, protocol=2, compression=compression)
+
+    verify_s3_pkl(bucket, 'data.pkl', DATA, checksum=True, protocol=2, compression=compression)
+    with pytest.raises(PklError):
+        verify_s3_pkl(bucket, 'data.pkl', dict(DATA, text=u'cafe'), checksum=True, protocol=2,
+                      compression=compression)
+
+
+def test_verify_s3_pkl_pickled_differently(bucket):
+    # equal objects can pickle differently, e.g. sets under another hash seed
+    save_pickle_to_s3(bucket, 'data.pkl', DATA, protocol=0)
+
+    verify_s3_pkl(bucket, 'data.pkl', DATA, checksum=True, protocol=2)
+    verify_s3_pkls(bucket, {'data.pkl': DATA}, protocol=2, num_workers=1)
+    with pytest.raises(PklError):
+        verify_s3_pkl(bucket, 'missing.pkl', DATA, checksum=True, protocol=2)
+
+
+def test_verify_s3_pkls(bucket):
+    for name in ('a', 'b'):
+        save_pickle_to_s3(bucket, name + '.pkl', {name: 1}, protocol=2)
+
+    verify_s3_pkls(bucket, {'a.pkl': {'a': 1}, 'b.pkl': {'b': 1}}, protocol=2, num_workers=1)
+    with pytest.raises(PklError) as e:
+        verify_s3_pkls(bucket, {'a.pkl': {'a': 2}, 'b.pkl': {'b': 1}, 'c.pkl': {}}, protocol=2, num_workers=1)
+    assert 'a.pkl, c.pkl' in str(e.value)